@@ -0,0 +1,294 @@
+"""Benchmark the per-request overhead of SQLProfilerMiddleware.
+
+Drives a FastAPI app in process over an ASGI transport, against a local
+SQLite database, with no middleware, the default middleware and each
+capture option. Scenarios sweep the number of queries per request, the
+request body size and the concurrency. Each one reports p50/p99 latency,
+throughput, peak traced memory while serving requests one at a time
+(tracemalloc) and write statements issued to the profiler database per
+request.
+
+Overhead is compared as the ratio of a configuration's p50 latency to the
+p50 latency without middleware in the same scenario, which is far more
+stable across machines than absolute times. Run from the repository root:
+
+    python benchmarks/bench_overhead.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_overhead.py --baseline benchmarks/baseline.json
+
+The second form exits with status 1 when a configuration's overhead ratio,
+profiler writes per request or peak traced memory regress beyond
+`--tolerance`. Ratios are
+clamped to at least 1, as no configuration can be faster than no
+middleware, and an overhead regression must also exceed the noise measured
+across rounds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_db_dir = tempfile.mkdtemp()
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", "sqlite:///" + os.path.join(_db_dir, "profiler.db"))
+
+import httpx  # noqa: E402
+import sqlalchemy.event  # noqa: E402
+from fastapi import Body, FastAPI  # noqa: E402
+from sqlalchemy import create_engine, text  # noqa: E402
+
+from fastapi_sql_profiler.database import init  # noqa: E402
+from fastapi_sql_profiler.middleware import SQLProfilerMiddleware  # noqa: E402
+from fastapi_sql_profiler.storage import MemoryStore, SQLStore  # noqa: E402
+
+profiler_engine = init()
+
+CONFIGS = {
+    "none": None,
+    "default": {},
+    "no_body": {"capture_body": False},
+    "params": {"capture_params": True},
+    "shallow_stack": {"stack_depth": 1},
+    "memory_store": {"store": MemoryStore},
+    "sampled_out": {"sampler": "none"},
+}
+QUERY_COUNTS = (1, 10, 100, 1000)
+BODY_SIZES = (0, 1024, 65536)
+CONCURRENCY = (1, 10)
+PEAK_SLACK_KB = 64
+
+
+def scenarios(quick=False):
+    """Return the (queries, body size, concurrency) combinations to run.
+
+    Each dimension is swept with the other two held at a small value rather
+    than crossed, which keeps the run short.
+    """
+    query_counts = QUERY_COUNTS[:3] if quick else QUERY_COUNTS
+    combinations = [(queries, 0, 1) for queries in query_counts]
+    combinations += [(10, body_size, 1) for body_size in BODY_SIZES if body_size]
+    combinations += [(10, 0, concurrency) for concurrency in CONCURRENCY if concurrency > 1]
+    return combinations
+
+
+def make_app_engine():
+    """Create the application database with a table of items to query."""
+    app_engine = create_engine("sqlite:///" + os.path.join(_db_dir, "app.db"))
+    with app_engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS bench_item"))
+        conn.execute(text("CREATE TABLE bench_item (id INTEGER PRIMARY KEY, name VARCHAR)"))
+        conn.execute(text("INSERT INTO bench_item (id, name) VALUES (:id, :name)"),
+                     [{"id": index, "name": "item %d" % index} for index in range(1000)])
+    return app_engine
+
+
+def make_app(app_engine, config):
+    """Build the benchmarked app, with the middleware configured by `config`."""
+    app = FastAPI()
+
+    @app.post("/items")
+    def items(payload: dict = Body(None), queries: int = 1):
+        with app_engine.connect() as conn:
+            for index in range(queries):
+                conn.execute(text("SELECT name FROM bench_item WHERE id = :id"), {"id": index % 1000}).scalar()
+        return {"queries": queries}
+
+    if config is not None:
+        options = dict(config)
+        if options.get("store") is MemoryStore:
+            options["store"] = MemoryStore(capacity=1000)
+        if options.get("sampler") == "none":
+            from fastapi_sql_profiler.sampling import Sampler
+            options["sampler"] = Sampler(rate=0)
+        app.add_middleware(SQLProfilerMiddleware, engine=app_engine, flush_interval=0.05, **options)
+    return app
+
+
+def profiler(app):
+    """Return the SQLProfilerMiddleware of an app, or None."""
+    node = app.middleware_stack
+    while node is not None and not isinstance(node, SQLProfilerMiddleware):
+        node = getattr(node, "app", None)
+    return node
+
+
+async def drive(app, requests, queries, body_size, concurrency):
+    """Send `requests` requests and return their latencies in milliseconds and the wall time."""
+    path = "/items"
+    body = json.dumps({"data": "x" * max(body_size - 12, 0)}) if body_size else None
+    headers = {"content-type": "application/json"}
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # Warm up statement caches and the middleware stack.
+        await client.post(path, params={"queries": queries}, content=body, headers=headers)
+
+        async def one():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post(path, params={"queries": queries}, content=body, headers=headers)
+                latencies.append((time.perf_counter() - start) * 1000)
+                assert response.status_code == 200, response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def flush(app):
+    """Wait until the profiler of an app has persisted every captured request."""
+    middleware = profiler(app)
+    if middleware is not None and middleware.writer is not None:
+        middleware.writer.flush(timeout=60)
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of `values`."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))]
+
+
+def run_scenario(app_engine, config, requests, queries, body_size, concurrency):
+    """Measure one configuration in one scenario."""
+    writes = []
+
+    def count_writes(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+            writes.append(statement)
+
+    app = make_app(app_engine, config)
+    sqlalchemy.event.listen(profiler_engine, "after_cursor_execute", count_writes)
+    try:
+        latencies, elapsed = asyncio.run(drive(app, requests, queries, body_size, concurrency))
+        flush(app)
+    finally:
+        sqlalchemy.event.remove(profiler_engine, "after_cursor_execute", count_writes)
+
+    # Allocations are measured in a separate, smaller pass: tracing slows everything down.
+    traced_requests = max(requests // 5, 1)
+    tracemalloc.start()
+    asyncio.run(drive(app, traced_requests, queries, body_size, 1))
+    flush(app)
+    allocated = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    middleware = profiler(app)
+    if middleware is not None:
+        # Stops every background thread, so they do not run into the next measurements.
+        middleware.close(timeout=5)
+    return {
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "requests_per_second": round(requests / elapsed, 1),
+        "peak_kb": round(allocated / 1024, 1),
+        "profiler_writes_per_request": round(len(writes) / (requests + 1), 2),
+    }
+
+
+def run(args):
+    """Run every scenario and return the results keyed by scenario then configuration.
+
+    Configurations are run in interleaved rounds and the round with the
+    lowest p50 latency is kept for each, which filters out most scheduling
+    noise. The standard deviation of the p50 across rounds is kept as the
+    noise of the measurement.
+    """
+    app_engine = make_app_engine()
+    configs = args.configs or list(CONFIGS)
+    if "none" not in configs:
+        configs = ["none"] + configs
+    results = {}
+    for queries, body_size, concurrency in scenarios(args.quick):
+        requests = max(args.requests // max(queries // 100, 1), 5)
+        scenario = "queries=%d body=%d concurrency=%d" % (queries, body_size, concurrency)
+        best = {}
+        p50s = {name: [] for name in configs}
+        for _ in range(args.rounds):
+            for name in configs:
+                result = run_scenario(app_engine, CONFIGS[name], requests, queries, body_size, concurrency)
+                p50s[name].append(result["p50_ms"])
+                if name not in best or result["p50_ms"] < best[name]["p50_ms"]:
+                    best[name] = result
+                SQLStore().clear()
+        for name in configs:
+            result = best[name]
+            result["p50_stdev_ms"] = round(statistics.stdev(p50s[name]), 3) if len(p50s[name]) > 1 else 0.0
+            result["overhead"] = round(max(result["p50_ms"] / best["none"]["p50_ms"], 1.0), 3)
+            print("%-40s %-14s p50=%9.3f ms  p99=%9.3f ms  %8.1f req/s  peak %8.1f KB  writes/req=%6.2f  x%.2f" % (
+                scenario, name, result["p50_ms"], result["p99_ms"], result["requests_per_second"],
+                result["peak_kb"], result["profiler_writes_per_request"], result["overhead"]))
+        results[scenario] = best
+    return results
+
+
+def regressions(results, baseline, tolerance, noise=3.0):
+    """Return a description of every result that regressed from the baseline.
+
+    Writes per request and peak memory must not exceed the baseline by
+    `tolerance`, plus an absolute slack.
+
+    An overhead regression must exceed the baseline ratio by `tolerance`, and
+    the p50 latency above what the baseline ratio allows must exceed `noise`
+    standard deviations of the p50 across rounds, of the configuration and of
+    the run without middleware.
+    """
+    failures = []
+    for scenario, configs in results.items():
+        for name, result in configs.items():
+            expected = baseline.get(scenario, {}).get(name)
+            if expected is None or name == "none":
+                continue
+            expected_overhead = max(expected["overhead"], 1.0)
+            unprofiled = configs["none"]
+            excess_ms = result["p50_ms"] - unprofiled["p50_ms"] * expected_overhead
+            stdev_ms = result.get("p50_stdev_ms", 0.0) + unprofiled.get("p50_stdev_ms", 0.0)
+            if result["overhead"] > expected_overhead * (1 + tolerance) and excess_ms > noise * stdev_ms:
+                failures.append("%s %s: overhead x%.2f, baseline x%.2f, p50 %.3f ms over it, noise %.3f ms" % (
+                    scenario, name, result["overhead"], expected_overhead, excess_ms, stdev_ms))
+            # Writes depend on how requests fall into writer batches, hence the absolute slack.
+            if result["profiler_writes_per_request"] > expected["profiler_writes_per_request"] * (1 + tolerance) + 0.5:
+                failures.append("%s %s: %.2f profiler writes per request, baseline %.2f" % (
+                    scenario, name, result["profiler_writes_per_request"], expected["profiler_writes_per_request"]))
+            # The peak shifts with caches filled and objects collected during the traced pass.
+            if result["peak_kb"] > expected["peak_kb"] * (1 + tolerance) + PEAK_SLACK_KB:
+                failures.append("%s %s: peak %.1f KB, baseline %.1f KB" % (
+                    scenario, name, result["peak_kb"], expected["peak_kb"]))
+    return failures
+
+
+def main():
+    """Run the benchmark suite and compare it with a baseline."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100, help="requests per scenario and configuration")
+    parser.add_argument("--rounds", type=int, default=3, help="interleaved runs of each configuration")
+    parser.add_argument("--quick", action="store_true", help="skip the 1000 queries per request scenario")
+    parser.add_argument("--configs", nargs="*", choices=list(CONFIGS), help="configurations to run")
+    parser.add_argument("--baseline", help="JSON baseline to compare the results with")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed relative increase of overhead, writes per request and peak memory")
+    parser.add_argument("--noise", type=float, default=3.0,
+                        help="standard deviations of the p50 across rounds an overhead regression must exceed")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            failures = regressions(results, json.load(baseline_file), args.tolerance, args.noise)
+        for failure in failures:
+            print("REGRESSION " + failure)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
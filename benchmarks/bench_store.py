@@ -0,0 +1,108 @@
+"""Benchmark profiler persistence: commits per request and flush latency.
+
+Compares the previous per-query commit loop of `SQLProfilerMiddleware.store`
+(now `SQLStore.save`)
+with the current batched bulk insert. Run from the repository root:
+
+    python benchmarks/bench_store.py --requests 50 --queries 200
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_db_dir = tempfile.mkdtemp()
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", "sqlite:///" + os.path.join(_db_dir, "bench.db"))
+
+import sqlalchemy.event  # noqa: E402
+
+from fastapi_sql_profiler.database import get_session, init  # noqa: E402
+from fastapi_sql_profiler.models import QueryInfo, RequestInfo  # noqa: E402
+from fastapi_sql_profiler.storage import MemoryStore, SQLStore  # noqa: E402
+
+engine = init()
+
+
+def make_record(queries):
+    """Build a captured request record holding `queries` query entries."""
+    start_time = datetime.datetime.utcnow()
+    return {
+        "path": "/bench", "query_params": "", "raw_body": "", "body": "", "method": "GET",
+        "start_time": start_time, "end_time": start_time, "time_taken": 1.0,
+        "headers": {"host": "bench"},
+        "n_plus_one": 0, "repeated_queries": 0, "duplicate_queries": 0, "wasted_time": 0.0,
+        "queries": [
+            {"time_taken": 1.0, "compile_time": 0.05, "rowcount": 1, "batch_size": 1, "params": None,
+             "text": "SELECT %d" % i, "stack": (("app.py", i, "view"),), "statement": "SELECT ?", "fingerprint": "bench"}
+            for i in range(queries)
+        ],
+    }
+
+
+def legacy_store(record):
+    """Persist a record the way `store` did before batching: one commit per query."""
+    session = get_session()
+    request_info = RequestInfo(path=record["path"], query_params=record["query_params"],
+                               raw_body=record["raw_body"], body=record["body"], method=record["method"],
+                               start_time=record["start_time"], headers=record["headers"])
+    session.add(request_info)
+    session.commit()
+    session.refresh(request_info)
+    request_id = request_info.id
+    for query_obj in record["queries"]:
+        session.add(QueryInfo(query=str(query_obj['text']), request_id=request_id,
+                              time_taken=query_obj['time_taken'], traceback=repr(query_obj['stack'])))
+        session.commit()
+        session.close()
+    request_obj = session.get(RequestInfo, request_id)
+    request_obj.end_time = record["end_time"]
+    request_obj.time_taken = record["time_taken"]
+    request_obj.total_queries = len(record["queries"])
+    session.add(request_obj)
+    session.commit()
+    session.refresh(request_obj)
+    session.close()
+
+
+def run(name, persist, requests, queries, batch_size):
+    """Persist `requests` records and print commits per request and flush latency."""
+    commits = []
+
+    def on_commit(conn):
+        commits.append(conn)
+
+    sqlalchemy.event.listen(engine, "commit", on_commit)
+    records = [make_record(queries) for _ in range(requests)]
+    start = time.perf_counter()
+    for i in range(0, requests, batch_size):
+        persist(records[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+    sqlalchemy.event.remove(engine, "commit", on_commit)
+    print("%-8s commits/request=%8.2f  flush latency/request=%8.3f ms" % (
+        name, len(commits) / requests, elapsed * 1000 / requests))
+
+
+def main():
+    """Run the before/after comparison."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=10)
+    args = parser.parse_args()
+
+    def before(records):
+        for record in records:
+            legacy_store(record)
+
+    print("%d requests x %d queries, sqlite at %s" % (args.requests, args.queries, engine.url))
+    run("before", before, args.requests, args.queries, args.batch_size)
+    run("after", SQLStore().save, args.requests, args.queries, args.batch_size)
+    run("memory", MemoryStore(capacity=args.requests).save, args.requests, args.queries, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,6 @@
 from .middleware import SQLProfilerMiddleware
-from .add_request import router
\ No newline at end of file
+from .add_request import router
+from .baselines import BaselineTracker
+from .retention import RetentionPolicy
+from .sampling import Sampler
+from .storage import BaseStore, MemoryStore, SQLStore
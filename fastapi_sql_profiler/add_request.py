@@ -1,98 +1,405 @@
+import csv
+import datetime
+import json
 import os
-import math
+import sys
 from pathlib import Path
-from fastapi import APIRouter, Request, status
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import APIRouter, Query, Request, status
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 
-from .database import session
-from .models import QueryInfo, RequestInfo
+from .baselines import get_baselines
+from .hotspots import build_call_tree
+from .live import get_live_feed
+from .metrics import get_metrics
+from .stack import format_stack
+from .storage import EXPORT_FIELDS, REQUEST_SORTS, get_store, page_cursor, parse_cursor
 
 router = APIRouter()
 
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_CHUNK_SIZE = 65536
+LIVE_HEARTBEAT_SECONDS = 15.0
+MAX_PAGE_SIZE = 500
+MAX_CALL_PATHS = 5000
+
 
 BASE_PATH = Path(__file__).resolve().parent
 templates = Jinja2Templates(directory=str(BASE_PATH / "templates"))
 
 
+def split_traceback(traceback_text):
+    """Split a traceback stored as text by older versions into one string per frame."""
+    traceback_contents = traceback_text.strip().splitlines()
+    traceback_groups = []
+    current_group = []
+
+    for traceback_content in traceback_contents:
+        if 'File "<string>"' not in traceback_content:
+            if traceback_content.startswith("  File"):
+                if current_group:
+                    traceback_groups.append(current_group)
+                    current_group = []
+            current_group.append(traceback_content)
+
+    if current_group:
+        traceback_groups.append(current_group)
+    traceback = []
+    for traceback_group in traceback_groups:
+        traceback_string = '\n'.join(traceback_group)
+        traceback.append(traceback_string)
+    return traceback
+
+
+def parse_filter(value, parse):
+    """Parse a filter sent by the dashboard form, where a blank field means no filter.
+
+    :raises ValueError: If `parse` rejects the value.
+    """
+    if value is None or not value.strip():
+        return None
+    return parse(value.strip())
+
+
+class LineBuffer(object):
+    """File-like object returning what is written, so csv.writer produces one line at a time."""
+
+    def write(self, value):
+        """Return the written value."""
+        return value
+
+
+def json_default(value):
+    """Serialize the values json does not handle, such as datetimes."""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def export_lines(rows, export_format):
+    """Format exported rows as NDJSON or CSV lines, starting with the CSV header."""
+    if export_format == "csv":
+        writer = csv.writer(LineBuffer())
+        yield writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            yield writer.writerow(value.isoformat() if isinstance(value, datetime.datetime) else value
+                                  for value in row)
+        return
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_FIELDS, row)), default=json_default) + "\n"
+
+
+def chunked(lines, size=EXPORT_CHUNK_SIZE):
+    """Join lines into chunks of about `size` characters.
+
+    The first line is sent on its own so the response starts immediately.
+    """
+    lines = iter(lines)
+    for line in lines:
+        yield line
+        break
+    chunk = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield "".join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield "".join(chunk)
+
+
+async def live_events(live_feed, subscription, heartbeat=LIVE_HEARTBEAT_SECONDS):
+    """Yield the Server-Sent Events of a live feed subscription until the viewer disconnects.
+
+    Each request summary is a `request` event. A `dropped` event tells the
+    viewer how many summaries were dropped because it fell behind, and a
+    comment is sent after `heartbeat` idle seconds to keep the connection open.
+    """
+    try:
+        yield ": connected\n\n"
+        while True:
+            events, dropped = await subscription.get(heartbeat)
+            if dropped:
+                yield "event: dropped\ndata: %s\n\n" % json.dumps({"dropped": dropped})
+            for summary in events:
+                yield "event: request\ndata: %s\n\n" % json.dumps(summary)
+            if not events and not dropped:
+                yield ": heartbeat\n\n"
+    finally:
+        live_feed.unsubscribe(subscription)
+
+
 @router.get("/all_request", response_class=HTMLResponse)
-async def all_request(request: Request,  page: int = 1, limit: int = 20):
-    """Get all request."""
-    all_request_info = session.query(
-        RequestInfo).order_by(-RequestInfo.id).all()
-    total_request_info = len(all_request_info)
-    total_pages = math.ceil(total_request_info / limit)
-
-    start_index = (page - 1) * limit
-    end_index = start_index + limit
-    request_info = all_request_info[start_index:end_index]
+async def all_request(request: Request, limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE), sort: str = "recent",
+                      before: str = None, after: str = None, path: str = None, method: str = None, min_time: str = None,
+                      min_queries: str = None, repeated: bool = False, regressed: bool = False,
+                      start: str = None, end: str = None, count: bool = True):
+    """Get all request.
+
+    Requests are paginated with `before`/`after` cursors and filtered by the
+    store; the total is only counted when `count` is set. Store calls run in
+    the threadpool so they never block the event loop. The filter form sends
+    its blank fields too, so the numeric and time filters are parsed here,
+    and a malformed filter or cursor is answered with a 400.
+    """
+    if sort not in REQUEST_SORTS:
+        sort = "recent"
+    store = get_store()
+    try:
+        min_time = parse_filter(min_time, float)
+        min_queries = parse_filter(min_queries, int)
+        start = parse_filter(start, datetime.datetime.fromisoformat)
+        end = parse_filter(end, datetime.datetime.fromisoformat)
+    except ValueError as error:
+        return JSONResponse(content={"message": "Invalid filter: %s" % error},
+                            status_code=status.HTTP_400_BAD_REQUEST)
+    before = before or None
+    after = after or None
+    try:
+        if before or after:
+            parse_cursor(before or after)
+    except ValueError:
+        return JSONResponse(content={"message": "Invalid page cursor: %s" % (before or after)},
+                            status_code=status.HTTP_400_BAD_REQUEST)
+    path = path or None
+    method = method or None
+    filters = {"path": path, "method": method, "min_time": min_time, "min_queries": min_queries,
+               "repeated": repeated, "regressed": regressed, "start": start, "end": end}
+    request_info, has_previous, has_next = await run_in_threadpool(store.list_requests, sort, limit, before, after,
+                                                                   **filters)
+    total_request_info = None
+    if count:
+        total_request_info = await run_in_threadpool(store.count_requests, **filters)
     context = {"request": request, "request_info": request_info, "current_api": "all_request",
-                                                            "page": page,
                                                             "limit": limit,
-                                                            "total_pages": total_pages,
-                                                            "total_request_info":total_request_info,
+                                                            "total_request_info": total_request_info,
+                                                            "sort": sort,
+                                                            "repeated": repeated,
+                                                            "regressed": regressed,
+                                                            "filters": {"path": path, "method": method,
+                                                                        "min_time": min_time,
+                                                                        "min_queries": min_queries,
+                                                                        "start": start, "end": end},
+                                                            "previous_cursor": page_cursor(request_info[0], REQUEST_SORTS[sort])
+                                                            if has_previous and request_info else None,
+                                                            "next_cursor": page_cursor(request_info[-1], REQUEST_SORTS[sort])
+                                                            if has_next and request_info else None,
                                                             }
     return templates.TemplateResponse("request_show.html", context)
 
 
+@router.get("/statements", response_class=HTMLResponse)
+async def statements(request: Request, limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+    """Get statement fingerprints ranked by total time."""
+    statement_stats = []
+    for statement_info in await run_in_threadpool(get_store().top_statements, limit):
+        statement_stats.append({
+            "statement_info": statement_info,
+            "average": statement_info.average,
+            "p50": statement_info.histogram.percentile(50),
+            "p95": statement_info.histogram.percentile(95),
+            "p99": statement_info.histogram.percentile(99),
+        })
+    context = {"request": request, "statement_stats": statement_stats, "current_api": "statements", "limit": limit}
+    return templates.TemplateResponse("statements.html", context)
+
+
+@router.get("/hotspots", response_class=HTMLResponse)
+async def hotspots(request: Request, limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+                   paths: int = Query(500, ge=1, le=MAX_CALL_PATHS)):
+    """Get the application source lines ranked by database time, and their call tree.
+
+    Both are read from aggregates maintained as requests are saved; the
+    tree merges the `paths` call paths with the most database time.
+    """
+    store = get_store()
+    call_sites = await run_in_threadpool(store.top_call_sites, limit)
+    call_tree = build_call_tree(await run_in_threadpool(store.top_call_paths, paths))
+    context = {"request": request, "call_sites": call_sites, "call_tree": call_tree, "current_api": "hotspots",
+               "limit": limit}
+    return templates.TemplateResponse("hotspots.html", context)
+
+
+@router.get("/live")
+async def live(path: str = None, method: str = None, min_time: float = None, min_queries: int = None,
+               buffer: int = 100):
+    """Stream summaries of the requests saved from now on as Server-Sent Events.
+
+    Summaries are published in process by the middleware and filtered
+    before they are buffered, so viewers add no database load. A viewer
+    more than `buffer` summaries behind loses the oldest ones.
+    """
+    live_feed = get_live_feed()
+    if live_feed is None:
+        return JSONResponse(content={"message": "The live feed is disabled"},
+                            status_code=status.HTTP_404_NOT_FOUND)
+    subscription = live_feed.subscribe(path=path, method=method, min_time=min_time, min_queries=min_queries,
+                                       maxsize=max(1, min(buffer, 1000)))
+    if subscription is None:
+        return JSONResponse(content={"message": "Too many live viewers"},
+                            status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(live_events(live_feed, subscription), media_type="text/event-stream", headers=headers)
+
+
+@router.get("/live_tail", response_class=HTMLResponse)
+async def live_tail(request: Request, path: str = None, method: str = None, min_time: float = None,
+                    min_queries: int = None):
+    """Get the page following the live feed in the browser."""
+    filters = {"path": path, "method": method, "min_time": min_time, "min_queries": min_queries}
+    context = {"request": request, "current_api": "live_tail",
+               "filters": {name: value for name, value in filters.items() if value is not None}}
+    return templates.TemplateResponse("live_tail.html", context)
+
+
+@router.get("/baselines", response_class=HTMLResponse)
+async def baselines(request: Request):
+    """Get the per-route baselines, the flagged routes first, and the saved baselines."""
+    tracker = get_baselines()
+    routes = await run_in_threadpool(tracker.report) if tracker is not None else []
+    saved = await run_in_threadpool(get_store().list_baselines)
+    context = {"request": request, "tracker": tracker, "routes": routes, "saved": saved, "current_api": "baselines"}
+    return templates.TemplateResponse("baselines.html", context)
+
+
+@router.post("/baselines/{name}")
+async def save_baseline(name: str):
+    """Save the current per-route baselines under `name`, such as a deploy version.
+
+    The baselines of the worker serving the request are saved at once; the
+    other workers add theirs the next time they sync with the store.
+    """
+    tracker = get_baselines()
+    if tracker is None:
+        return JSONResponse(content={"message": "Baselines are disabled"}, status_code=status.HTTP_404_NOT_FOUND)
+    routes = await run_in_threadpool(tracker.save, get_store(), name)
+    return JSONResponse(content={"message": "Baseline saved", "name": name, "routes": routes},
+                        status_code=status.HTTP_200_OK)
+
+
+@router.post("/baselines/{name}/load")
+async def load_baseline(name: str):
+    """Compare the requests of every worker to the saved baseline `name` instead of the rolling baselines."""
+    tracker = get_baselines()
+    if tracker is None:
+        return JSONResponse(content={"message": "Baselines are disabled"}, status_code=status.HTTP_404_NOT_FOUND)
+    if not await run_in_threadpool(tracker.load_reference, get_store(), name):
+        return JSONResponse(content={"message": "Baseline not found"}, status_code=status.HTTP_404_NOT_FOUND)
+    return JSONResponse(content={"message": "Baseline loaded", "name": name}, status_code=status.HTTP_200_OK)
+
+
+@router.delete("/baselines/reference")
+async def reset_baseline():
+    """Compare the requests of every worker to the rolling baselines again."""
+    tracker = get_baselines()
+    if tracker is not None:
+        await run_in_threadpool(tracker.load_reference, get_store(), None)
+    return JSONResponse(content={"message": "Using the rolling baselines"}, status_code=status.HTTP_200_OK)
+
+
+@router.get("/regressions")
+async def regressions(limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE)):
+    """Get the regressed routes and the most recent regressed requests as JSON.
+
+    Routes are compared from the in-process baselines; requests are read
+    from the store, where each one keeps the flags it was given when captured.
+    """
+    tracker = get_baselines()
+    if tracker is None:
+        return JSONResponse(content={"message": "Baselines are disabled"}, status_code=status.HTTP_404_NOT_FOUND)
+    routes = await run_in_threadpool(tracker.report)
+    request_info, _, _ = await run_in_threadpool(get_store().list_requests, "recent", limit, regressed=True)
+    content = {
+        "reference": tracker.reference_name,
+        "flagged": tracker.flagged,
+        "routes": [route for route in routes if route["flags"]],
+        "requests": [{"id": info.id, "path": info.path, "method": info.method,
+                      "start_time": info.start_time.isoformat() if info.start_time else None,
+                      "time_taken": info.time_taken, "total_queries": info.total_queries,
+                      "regression": info.regression.split(",")} for info in request_info],
+    }
+    return JSONResponse(content=content, status_code=status.HTTP_200_OK)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Get the per-route histograms in the Prometheus text format.
+
+    Only in-process aggregates are read, never the profiler tables.
+    """
+    aggregator = get_metrics()
+    content = aggregator.render() if aggregator is not None else ""
+    return PlainTextResponse(content, media_type="text/plain; version=0.0.4")
+
+
+@router.get("/export")
+async def export(format: str = "ndjson", path: str = None, method: str = None, min_time: float = None,
+                 min_queries: int = None, start: datetime.datetime = None, end: datetime.datetime = None):
+    """Stream the captured requests joined with their queries as NDJSON or CSV.
+
+    Rows are read from the store in batches by a generator running in the
+    threadpool and sent as they are formatted, so exports of any size use
+    constant memory and start immediately.
+    """
+    if format not in EXPORT_MEDIA_TYPES:
+        return JSONResponse(content={"message": "format must be one of %s" % ", ".join(EXPORT_MEDIA_TYPES)},
+                            status_code=status.HTTP_400_BAD_REQUEST)
+    rows = get_store().export(path=path, method=method, min_time=min_time, min_queries=min_queries,
+                              start=start, end=end)
+    headers = {"Content-Disposition": 'attachment; filename="requests.%s"' % format}
+    return StreamingResponse(chunked(export_lines(rows, format)), media_type=EXPORT_MEDIA_TYPES[format],
+                             headers=headers)
+
+
 @router.get("/request_detail/{id}", response_class=HTMLResponse)
-def request_show(id: int, request: Request):
+async def request_show(id: int, request: Request):
     """Get single request."""
-    request_query = session.query(RequestInfo).get(id)
-    query_detail = session.query(QueryInfo).filter_by(request_id=id)
-    sum_on_query = 0
-    for query_details in query_detail:
-        sum_on_query = sum_on_query + query_details.time_taken
+    store = get_store()
+    request_query = await run_in_threadpool(store.get_request, id)
+    sum_on_query = await run_in_threadpool(store.query_time, id)
     templates.env.globals['current_id'] = id
     context = {"request": request, "request_query": request_query, "sum_on_query": sum_on_query}
     return templates.TemplateResponse("request.html", context)
 
 
 @router.get("/request_query/{id}", response_class=HTMLResponse)
-def request_query(id: int, request: Request):
+async def request_query(id: int, request: Request):
     """Get single request."""
-    request_query = session.query(RequestInfo).get(id)
-    query_detail = session.query(QueryInfo).filter_by(request_id=id)
-    sum_on_query = 0
-    for query_details in query_detail:
-        sum_on_query = sum_on_query + query_details.time_taken
+    store = get_store()
+    request_query = await run_in_threadpool(store.get_request, id)
+    query_detail = await run_in_threadpool(store.get_queries, id)
+    sum_on_query = await run_in_threadpool(store.query_time, id)
     templates.env.globals['current_id'] = id
     context = {"request": request, "request_query": request_query, "query_detail": query_detail, "sum_on_query": sum_on_query}
     return templates.TemplateResponse("sql_query.html", context)
 
 
 @router.get("/request_query_details/{id}", response_class=HTMLResponse)
-def request_query_details(id: int, request: Request):
+async def request_query_details(id: int, request: Request):
     """Get single request."""
-    query_detail = session.query(QueryInfo).get(id)
-    traceback_contents = query_detail.traceback.strip().splitlines()
-    traceback_groups = []
-    current_group = []
-
-    for traceback_content in traceback_contents:
-        if 'File "<string>"' not in traceback_content:
-            if traceback_content.startswith("  File"):
-                if current_group:
-                    traceback_groups.append(current_group)
-                    current_group = []
-            current_group.append(traceback_content)
-
-    if current_group:
-        traceback_groups.append(current_group)
-    traceback = []
-    for traceback_group in traceback_groups:
-        traceback_string = '\n'.join(traceback_group)
-        traceback.append(traceback_string)
-    virtualenv_path = os.environ.get('VIRTUAL_ENV')
-    context = {"request": request,"query_detail":query_detail,"traceback":traceback,"virtualenv_path":virtualenv_path,"current_api": "request_query_details"}
+    store = get_store()
+    query_detail = await run_in_threadpool(store.get_query, id)
+    frames = await run_in_threadpool(store.get_stack, query_detail)
+    if frames is not None:
+        traceback = format_stack(frames)
+    else:
+        traceback = split_traceback(query_detail.traceback or '')
+    plan = None
+    if query_detail.fingerprint:
+        plan = await run_in_threadpool(store.get_plan, query_detail.fingerprint)
+    virtualenv_path = os.environ.get('VIRTUAL_ENV', sys.prefix)
+    context = {"request": request,"query_detail":query_detail,"traceback":traceback,"plan":plan,"virtualenv_path":virtualenv_path,"current_api": "request_query_details",
+               "current_id": query_detail.request_id}
     return templates.TemplateResponse("sql_query_detail.html", context)
 
 
 @router.delete('/clear_db')
-def destory(requset: Request):
+async def destory(requset: Request):
     """Clear DB."""
-    session.query(RequestInfo).delete()
-    session.query(QueryInfo).delete()
-    session.commit()
+    await run_in_threadpool(get_store().clear)
     return JSONResponse(content={"message": "Clear Db Successfully"},
                         status_code=status.HTTP_200_OK)
@@ -0,0 +1,382 @@
+import collections
+import datetime
+import logging
+import threading
+import time
+
+from .stats import Histogram
+
+logger = logging.getLogger(__name__)
+
+REGRESSION_FLAGS = ("queries", "db_time")
+
+
+class RouteStats(object):
+    """Mergeable aggregates of the requests of one route and method.
+
+    Latency, database time and query count are each kept in a
+    :class:`Histogram`, so the stats of several windows, or of several
+    processes, are combined by adding bucket counts.
+
+    Args:
+    ----
+        count (int): Number of requests counted.
+        latency (Histogram, optional): Request times in milliseconds.
+        db_time (Histogram, optional): Total query times of the requests in milliseconds.
+        queries (Histogram, optional): Query counts of the requests.
+
+    """
+
+    __slots__ = ("count", "latency", "db_time", "queries")
+
+    def __init__(self, count=0, latency=None, db_time=None, queries=None):
+        """Initialize a RouteStats object."""
+        self.count = count
+        self.latency = latency or Histogram()
+        self.db_time = db_time or Histogram()
+        self.queries = queries or Histogram()
+
+    def add(self, time_taken, db_time, queries):
+        """Count one request."""
+        self.count += 1
+        self.latency.add(time_taken)
+        self.db_time.add(db_time)
+        self.queries.add(queries)
+
+    def merge(self, other):
+        """Add the aggregates of another RouteStats to this one."""
+        self.count += other.count
+        self.latency.merge(other.latency)
+        self.db_time.merge(other.db_time)
+        self.queries.merge(other.queries)
+        return self
+
+    def summary(self):
+        """Return the request count and the p50 and p95 of each aggregate."""
+        summary = {"count": self.count}
+        for name in ("latency", "db_time", "queries"):
+            histogram = getattr(self, name)
+            for percent in (50, 95):
+                value = histogram.percentile(percent)
+                if name == "queries" and value is not None:
+                    value = round(value, 1)
+                summary["%s_p%d" % (name, percent)] = value
+        return summary
+
+
+def regression_limit(value, ratio, margin):
+    """Return the value above which `value` counts as regressed."""
+    return max(value * ratio, value + margin)
+
+
+class RouteBaseline(object):
+    """Rolling aggregates of one route and method, kept in time windows.
+
+    Requests are counted in the `current` window; once it is `window`
+    seconds old it joins the completed windows, of which the newest
+    `windows` are kept.
+
+    Args:
+    ----
+        start (float): Monotonic time the current window started.
+        windows (int): Number of completed windows kept.
+
+    """
+
+    __slots__ = ("current", "start", "completed", "limits")
+
+    def __init__(self, start, windows):
+        """Initialize a RouteBaseline object."""
+        self.current = RouteStats()
+        self.start = start
+        self.completed = collections.deque(maxlen=windows)
+        # Per-request regression limits, cached until the baseline they derive from changes.
+        self.limits = None
+
+    def rolling(self):
+        """Return the merged stats of the completed windows."""
+        stats = RouteStats()
+        for window in self.completed:
+            stats.merge(window)
+        return stats
+
+    def total(self):
+        """Return the merged stats of every window, including the current one."""
+        return self.rolling().merge(self.current)
+
+
+class BaselineTracker(object):
+    """Per-route performance baselines and regression flags.
+
+    Each request is compared to the baseline of its route template and
+    method, then counted in the rolling baseline. The baseline is the named
+    reference loaded with :meth:`set_reference`, typically snapshotted from
+    the previous deploy, or else the completed rolling windows. A request is
+    flagged `queries` or `db_time` when its query count or database time
+    exceeds the baseline's `percentile` by both `ratio` and `margin`, once
+    the baseline counts `min_samples` requests. The limits are cached per
+    route and recomputed only when a window completes, so the check costs
+    O(1) per request.
+
+    Routes are flagged by :meth:`report` when the median of the current
+    window regresses against the median of the baseline by the same rules.
+
+    Each worker process has its own tracker, and the trackers share their
+    baselines through the store. A baseline saved by one worker with
+    :meth:`save` is completed by every other running worker, which adds its
+    own snapshot to it the next time it syncs. The reference is chosen in
+    the store too, and each tracker follows it. The sync runs every
+    `sync_interval` seconds on a daemon thread started by :meth:`start`.
+
+    The middleware calls :meth:`observe` from the event loop; the dashboard
+    reads the baselines from the threadpool, so both take a lock.
+
+    Args:
+    ----
+        window (float): Seconds covered by one rolling window.
+        windows (int): Number of completed windows in the rolling baseline.
+        min_samples (int): Minimum number of requests in a baseline, or in the current
+            window for route flags, before anything is flagged.
+        percentile (float): Percentile of the baseline a request is compared to.
+        query_ratio (float): Factor by which the query count must exceed the baseline.
+        query_margin (float): Number of queries by which the query count must exceed the baseline.
+        db_time_ratio (float): Factor by which the database time must exceed the baseline.
+        db_time_margin (float): Milliseconds by which the database time must exceed the baseline.
+        max_routes (int): Maximum number of routes tracked.
+        sync_interval (float): Seconds between two syncs with the store.
+
+    Attributes:
+    ----------
+        reference_name (str): Name of the reference baseline, or None for the rolling one.
+        flagged (int): Number of requests flagged.
+
+    """
+
+    def __init__(self, window=600.0, windows=6, min_samples=20, percentile=95, query_ratio=1.5, query_margin=2,
+                 db_time_ratio=2.0, db_time_margin=5.0, max_routes=1000, sync_interval=30.0):
+        """Initialize a BaselineTracker object."""
+        self.window = window
+        self.windows = windows
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.query_ratio = query_ratio
+        self.query_margin = query_margin
+        self.db_time_ratio = db_time_ratio
+        self.db_time_margin = db_time_margin
+        self.max_routes = max_routes
+        self.sync_interval = sync_interval
+        self.reference_name = None
+        self.flagged = 0
+        self.routes = {}
+        self.reference = {}
+        self.started_at = datetime.datetime.utcnow()
+        # The saves this tracker has added its snapshot to, as `(name, created_at)`.
+        self._contributed = set()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def limits(self, stats, percentile):
+        """Return the query count and database time limits derived from `stats`, or an empty tuple."""
+        if stats is None or stats.count < self.min_samples:
+            return ()
+        return (regression_limit(stats.queries.percentile(percentile), self.query_ratio, self.query_margin),
+                regression_limit(stats.db_time.percentile(percentile), self.db_time_ratio, self.db_time_margin))
+
+    def flags(self, limits, queries, db_time):
+        """Return the names of the aggregates exceeding `limits`."""
+        if not limits:
+            return ()
+        return tuple(name for name, value, limit in (("queries", queries, limits[0]), ("db_time", db_time, limits[1]))
+                     if value > limit)
+
+    def observe(self, route, method, time_taken, db_time, queries, now=None):
+        """Check a finished request against its baseline, then count it.
+
+        Args:
+        ----
+        route (str): The route template of the request.
+        method (str): The HTTP method.
+        time_taken (float): The request time in milliseconds.
+        db_time (float): The total time of its queries in milliseconds.
+        queries (int): The number of queries.
+        now (float, optional): The monotonic time; defaults to `time.monotonic()`.
+
+        Returns:
+        -------
+        tuple: The regression flags of the request, from `REGRESSION_FLAGS`.
+
+        """
+        now = time.monotonic() if now is None else now
+        key = (route, method)
+        with self._lock:
+            baseline = self.routes.get(key)
+            if baseline is None:
+                if len(self.routes) >= self.max_routes:
+                    return ()
+                baseline = self.routes[key] = RouteBaseline(now, self.windows)
+            if now - baseline.start >= self.window:
+                baseline.completed.append(baseline.current)
+                baseline.current = RouteStats()
+                baseline.start = now
+                baseline.limits = None
+            if baseline.limits is None:
+                reference = self.reference.get(key)
+                baseline.limits = self.limits(reference if reference is not None else baseline.rolling(),
+                                              self.percentile)
+            flags = self.flags(baseline.limits, queries, db_time)
+            baseline.current.add(time_taken, db_time, queries)
+            if flags:
+                self.flagged += 1
+        return flags
+
+    def snapshot(self):
+        """Return the merged stats of every window of every route, keyed by `(route, method)`."""
+        with self._lock:
+            return {key: baseline.total() for key, baseline in self.routes.items()}
+
+    def set_reference(self, name, routes):
+        """Compare requests to a named baseline instead of the rolling one.
+
+        Args:
+        ----
+        name (str): The name of the baseline, or None to go back to the rolling baseline.
+        routes (dict): RouteStats keyed by `(route, method)`, as returned by :meth:`snapshot`.
+
+        """
+        with self._lock:
+            self.reference_name = name
+            self.reference = dict(routes) if name is not None else {}
+            for baseline in self.routes.values():
+                baseline.limits = None
+
+    def save(self, store, name):
+        """Save the snapshot of this tracker in `store` as the baseline `name`.
+
+        The other workers add their snapshots the next time they sync.
+
+        Returns
+        -------
+        int: The number of routes saved.
+
+        """
+        routes = self.snapshot()
+        with self._sync_lock:
+            self._contributed.add((name, store.save_baseline(name, routes)))
+        return len(routes)
+
+    def load_reference(self, store, name):
+        """Make the baseline `name` saved in `store` the reference of every worker.
+
+        Pass None to go back to the rolling baselines.
+
+        Returns
+        -------
+        bool: Whether a baseline of that name was found.
+
+        """
+        with self._sync_lock:
+            if not store.set_reference_baseline(name):
+                return False
+            self.set_reference(name, store.get_baseline(name) if name is not None else {})
+        return True
+
+    def sync(self, store):
+        """Add this tracker's snapshot to the baselines saved since it started, then follow the reference.
+
+        The reference is reloaded on every sync, as the other workers keep
+        adding to it until they have all synced.
+        """
+        with self._sync_lock:
+            for name, created_at, _ in store.list_baselines():
+                if created_at >= self.started_at and (name, created_at) not in self._contributed:
+                    self._contributed.add((name, created_at))
+                    store.merge_baseline(name, created_at, self.snapshot())
+            name = store.get_reference_baseline()
+            self.set_reference(name, store.get_baseline(name) if name is not None else {})
+
+    @property
+    def started(self):
+        """Return whether the sync thread has been started."""
+        return self._thread is not None
+
+    def start(self, store, reference_name=None):
+        """Start syncing with `store` from a daemon thread.
+
+        Args:
+        ----
+        store (BaseStore): The store the baselines are shared through.
+        reference_name (str, optional): Name of a saved baseline made the reference first.
+
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, args=(store, reference_name),
+                                            name="sql-profiler-baselines", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the sync thread."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopped.set()
+        thread.join(timeout)
+        self._thread = None
+
+    def _run(self, store, reference_name):
+        """Sync every `sync_interval` seconds until stopped."""
+        if reference_name is not None:
+            try:
+                if not self.load_reference(store, reference_name):
+                    logger.warning("No saved profiling baseline is named %r", reference_name)
+            except Exception:
+                logger.exception("Failed to load the profiling baseline %r", reference_name)
+        while not self._stopped.is_set():
+            try:
+                self.sync(store)
+            except Exception:
+                logger.exception("Failed to sync the profiling baselines")
+            self._stopped.wait(self.sync_interval)
+
+    def report(self):
+        """Return the current and baseline stats of every route, flagged routes first.
+
+        Returns
+        -------
+        list: One dictionary per route with its `route`, `method`, the `current`
+            window and `baseline` summaries, and the `flags` of the route.
+
+        """
+        with self._lock:
+            # The current window keeps counting requests, so it is copied before the lock is released.
+            routes = [(key, RouteStats().merge(baseline.current), self.reference.get(key, baseline.rolling()))
+                      for key, baseline in self.routes.items()]
+        report = []
+        for (route, method), current, reference in routes:
+            flags = ()
+            if current.count >= self.min_samples:
+                flags = self.flags(self.limits(reference, 50), current.queries.percentile(50),
+                                   current.db_time.percentile(50))
+            report.append({"route": route, "method": method, "current": current.summary(),
+                           "baseline": reference.summary() if reference.count else None, "flags": list(flags)})
+        report.sort(key=lambda route_report: (not route_report["flags"], route_report["route"],
+                                              route_report["method"]))
+        return report
+
+
+_baselines = None
+
+
+def get_baselines():
+    """Return the tracker behind `/baselines` and `/regressions`, or None."""
+    return _baselines
+
+
+def set_baselines(baselines):
+    """Set the tracker behind `/baselines` and `/regressions`."""
+    global _baselines
+    _baselines = baselines
@@ -1,32 +1,173 @@
 import os
+import threading
 
 from dotenv import load_dotenv
-
-# from dotenv import dotenv_values
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, literal_column
+from sqlalchemy.schema import CreateColumn, DDL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-load_dotenv()
-SQLALCHEMY_DATABASE_URL = os.getenv("SQLALCHEMY_DATABASE_URL")
+Base = declarative_base()
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-)
-SessionLocal = sessionmaker(
-    autocommit=False, autoflush=False, bind=engine)
-session = SessionLocal()
+# Bound to the profiler engine once it is created; see `get_engine`.
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
 
+_settings = {"url": None, "pool_size": None, "create_schema": True, "engine_options": {}}
+_engine = None
+_lock = threading.Lock()
 
-Base = declarative_base()
+
+def configure(url=None, pool_size=None, create_schema=None, **engine_options):
+    """Set how the profiler database is opened, without connecting to it.
+
+    Options left to None keep their current value. An engine created
+    earlier is disposed of, and the next unit of work opens the new one.
+
+    Args:
+    ----
+    url (str, optional): The profiler database URL. Defaults to the
+        `SQLALCHEMY_DATABASE_URL` environment variable, read from `.env` too.
+    pool_size (int, optional): Number of pooled connections to the profiler database.
+    create_schema (bool, optional): Whether the profiler tables are created if missing. Defaults to True.
+    engine_options: Other keyword arguments of `sqlalchemy.create_engine`.
+
+    """
+    global _engine
+    with _lock:
+        for name, value in (("url", url), ("pool_size", pool_size), ("create_schema", create_schema)):
+            if value is not None:
+                _settings[name] = value
+        if engine_options:
+            _settings["engine_options"] = engine_options
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+
+
+def init(url=None, pool_size=None, create_schema=None, **engine_options):
+    """Open the profiler database now, typically from the application's lifespan.
+
+    Takes the options of :func:`configure`. Without a call to `init`, the
+    database is opened by the first unit of work that needs it.
+
+    Returns
+    -------
+    sqlalchemy.engine.Engine: The profiler engine.
+
+    """
+    configure(url, pool_size, create_schema, **engine_options)
+    return get_engine()
+
+
+def get_engine():
+    """Return the profiler engine, creating or upgrading its tables on first use.
+
+    :raises RuntimeError: If no database URL is configured, or if schema creation is
+        disabled and the profiler tables lack columns.
+    """
+    global _engine
+    if _engine is not None:
+        return _engine
+    with _lock:
+        if _engine is None:
+            url = _settings["url"]
+            if url is None:
+                load_dotenv()
+                url = os.getenv("SQLALCHEMY_DATABASE_URL")
+            if not url:
+                msg = "The profiler database URL is not set: pass it to init() or set SQLALCHEMY_DATABASE_URL"
+                raise RuntimeError(msg)
+            options = dict(_settings["engine_options"])
+            if _settings["pool_size"] is not None:
+                options["pool_size"] = _settings["pool_size"]
+            engine = create_engine(url, **options)
+            if _settings["create_schema"]:
+                upgrade_schema(engine)
+            else:
+                check_schema(engine)
+            SessionLocal.configure(bind=engine)
+            _engine = engine
+    return _engine
+
+
+def missing_columns(engine):
+    """Return the columns of the existing profiler tables that the database lacks."""
+    from . import models  # noqa: F401 - registers the tables on Base
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name in tables:
+            names = {column["name"] for column in inspector.get_columns(table.name)}
+            missing.extend(column for column in table.columns if column.name not in names)
+    return missing
+
+
+def upgrade_schema(engine):
+    """Create the missing profiler tables, then add the columns and indexes older versions lack.
+
+    `create_all` skips tables that already exist, so the columns added since
+    they were created are added with `ALTER TABLE ... ADD COLUMN`, and their
+    indexes are created if missing. NULLs left in columns that are now
+    `NOT NULL` are set to the column's server default; the column itself
+    keeps accepting NULL, as not every database can alter it in place.
+    """
+    from . import models  # noqa: F401 - registers the tables on Base
+    Base.metadata.create_all(bind=engine)
+    missing = missing_columns(engine)
+    inspector = inspect(engine)
+    relaxed = [
+        column for table in Base.metadata.sorted_tables
+        for column_info in inspector.get_columns(table.name)
+        if column_info["nullable"] and column_info["name"] in table.columns
+        for column in (table.columns[column_info["name"]],)
+        if not column.nullable and not column.primary_key and column.server_default is not None
+    ]
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as conn:
+        for column in missing:
+            conn.execute(DDL("ALTER TABLE %s ADD COLUMN %s" % (
+                preparer.format_table(column.table), CreateColumn(column).compile(dialect=engine.dialect))))
+        for column in relaxed:
+            conn.execute(column.table.update().where(column.is_(None)).values(
+                {column.name: literal_column(str(column.server_default.arg))}))
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def check_schema(engine):
+    """Fail with the names of the profiler columns the database lacks, if any.
+
+    :raises RuntimeError: If a profiler table lacks columns.
+    """
+    missing = missing_columns(engine)
+    if missing:
+        msg = ("The profiler tables were created by an older version and lack the columns %s: "
+               "enable create_schema to add them, or add them by hand"
+               % ", ".join("%s.%s" % (column.table.name, column.name) for column in missing))
+        raise RuntimeError(msg)
+
+
+def get_session():
+    """Return a new session of the profiler database for one unit of work.
+
+    Usage:
+    ```
+    with get_session() as db:
+        # Use the database session `db` here
+    # The session is closed and its connection returned to the pool
+    ```
+    """
+    get_engine()
+    return SessionLocal()
 
 
 def get_db():
     """Coroutine generator function for getting a database session.
 
-    This function returns a generator that yields a database session object.
-    The session is retrieved from the `SessionLocal` object, which represents
-    a thread-local session.
+    This function returns a generator that yields a database session object
+    from :func:`get_session`, and closes it once the caller is done.
 
     Usage:
     ```
@@ -35,8 +176,8 @@ def get_db():
     # The session is automatically closed and returned to the connection pool
     ```
     """
+    db = get_session()
     try:
-        db = SessionLocal()
         yield db
     finally:
         db.close()
@@ -0,0 +1,191 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+EXPLAIN_PREFIXES = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "postgresql": "EXPLAIN ",
+    "mysql": "EXPLAIN ",
+    "mariadb": "EXPLAIN ",
+}
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+MAX_SHAPES = 10000
+
+
+def explain_prefix(dialect_name):
+    """Return the statement prefix producing a plan without running the query, or None."""
+    return EXPLAIN_PREFIXES.get(dialect_name)
+
+
+def format_plan(dialect_name, keys, rows):
+    """Format the rows returned by an EXPLAIN statement as text."""
+    if dialect_name == "sqlite":
+        # EXPLAIN QUERY PLAN rows are (id, parent, notused, detail) nodes of a tree.
+        depths = {0: -1}
+        lines = []
+        for node_id, parent, _, detail in rows:
+            depths[node_id] = depths.get(parent, -1) + 1
+            lines.append("  " * depths[node_id] + detail)
+        return "\n".join(lines)
+    if len(keys) == 1:
+        return "\n".join(str(row[0]) for row in rows)
+    lines = [" | ".join(keys)]
+    lines.extend(" | ".join("" if value is None else str(value) for value in row) for row in rows)
+    return "\n".join(lines)
+
+
+class ExplainCapture(object):
+    """Capture the plans of slow statements in the background.
+
+    Queries taking at least `slow_query_ms` are handed to :meth:`submit`, which never blocks. Each
+    statement shape, identified by its fingerprint, is submitted at most once
+    per `interval` seconds. A daemon thread runs EXPLAIN (or EXPLAIN QUERY
+    PLAN on SQLite) on its own connection of `engine`, at most `max_rate`
+    times per second, and saves the plan to the store with :meth:`save_plan`.
+    Plain EXPLAIN only plans the statement, it never executes it.
+
+    Args:
+    ----
+        engine (sqlalchemy.engine.Engine): The engine the statements ran on.
+        store (BaseStore): Where plans are saved.
+        slow_query_ms (float): Minimum query time, in milliseconds, of the statements explained.
+        interval (float): Minimum seconds between two plans of one statement shape.
+        max_rate (float): Maximum number of EXPLAIN statements per second.
+        maxsize (int): Maximum number of statements waiting to be explained.
+
+    Attributes:
+    ----------
+        submitted (int): Number of statements queued.
+        explained (int): Number of plans saved.
+        dropped (int): Number of statements rejected because the queue was full.
+        errors (int): Number of EXPLAIN statements that failed.
+
+    """
+
+    def __init__(self, engine, store, slow_query_ms=100, interval=3600.0, max_rate=5.0, maxsize=100):
+        """Initialize an ExplainCapture object."""
+        self.engine = engine
+        self.store = store
+        self.slow_query_ms = slow_query_ms
+        self.interval = interval
+        self.max_rate = max_rate
+        self.prefix = explain_prefix(engine.dialect.name)
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.submitted = 0
+        self.explained = 0
+        self.dropped = 0
+        self.errors = 0
+        self._last_explained = {}
+        self._shapes_lock = threading.Lock()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    @property
+    def enabled(self):
+        """Return whether plans can be captured for the engine's dialect."""
+        return self.prefix is not None
+
+    def start(self):
+        """Start the worker thread if it is not already running."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="sql-profiler-explain", daemon=True)
+            self._thread.start()
+
+    def submit(self, query_fingerprint, statement, parameters):
+        """Queue a slow statement to be explained, unless its shape was explained recently.
+
+        Returns
+        -------
+        bool: Whether the statement was queued.
+
+        """
+        if self.prefix is None or not statement.lstrip()[:6].upper().startswith(EXPLAINABLE):
+            return False
+        now = time.monotonic()
+        # Called from the hooks of concurrent queries: the check and the update are atomic.
+        with self._shapes_lock:
+            last = self._last_explained.get(query_fingerprint)
+            if last is not None and now - last < self.interval:
+                return False
+            if len(self._last_explained) >= MAX_SHAPES:
+                self._last_explained.clear()
+            self._last_explained[query_fingerprint] = now
+        if self._thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait((query_fingerprint, statement, parameters))
+        except queue.Full:
+            with self._shapes_lock:
+                self.dropped += 1
+                self._last_explained.pop(query_fingerprint, None)
+            return False
+        with self._shapes_lock:
+            self.submitted += 1
+        return True
+
+    def explain(self, statement, parameters):
+        """Run EXPLAIN for a statement on a separate connection and return the plan text."""
+        with self.engine.connect() as conn:
+            result = conn.exec_driver_sql(self.prefix + statement, parameters)
+            keys = list(result.keys())
+            rows = result.fetchall()
+            conn.rollback()
+        return format_plan(self.engine.dialect.name, keys, rows)
+
+    def flush(self, timeout=None):
+        """Block until every queued statement has been explained."""
+        if self._thread is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        """Explain pending statements and stop the worker thread."""
+        thread = self._thread
+        if thread is None:
+            return
+        self.flush(timeout)
+        self._stopping = True
+        thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        """Return the explain counters as a dictionary."""
+        return {
+            "pending": self.queue.qsize(),
+            "submitted": self.submitted,
+            "explained": self.explained,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    def _run(self):
+        """Explain queued statements, at most `max_rate` per second, until stopped."""
+        while not self._stopping:
+            try:
+                query_fingerprint, statement, parameters = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            started = time.monotonic()
+            try:
+                self.store.save_plan(query_fingerprint, self.explain(statement, parameters))
+                self.explained += 1
+            except Exception:
+                self.errors += 1
+                logger.exception("Failed to explain statement %s", query_fingerprint)
+            finally:
+                self.queue.task_done()
+            time.sleep(max(1.0 / self.max_rate - (time.monotonic() - started), 0))
@@ -0,0 +1,120 @@
+import collections
+import hashlib
+import re
+import threading
+
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_POSTCOMPILE = re.compile(r"\(?__\[POSTCOMPILE_\w+\]\)?")
+_PLACEHOLDERS = re.compile(r"%\(\w+\)s|%s|(?<!:):\w+|\$\d+|\?")
+_NUMBERS = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.I)
+_IN_LISTS = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.I)
+_VALUES_LISTS = re.compile(r"(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+")
+_WHITESPACE = re.compile(r"\s+")
+
+MAX_CACHE_SIZE = 10000
+_cache = {}
+
+
+def normalize(statement):
+    """Reduce a SQL statement to its shape.
+
+    Comments are removed, literals and bound parameters become `?`, IN lists
+    become `IN (...)`, repeated VALUES tuples collapse into one, and runs of
+    whitespace become a single space.
+    """
+    statement = _COMMENTS.sub(" ", statement)
+    statement = _STRINGS.sub("?", statement)
+    statement = _POSTCOMPILE.sub("(?)", statement)
+    statement = _PLACEHOLDERS.sub("?", statement)
+    statement = _NUMBERS.sub("?", statement)
+    statement = _IN_LISTS.sub("IN (...)", statement)
+    statement = _VALUES_LISTS.sub(r"\1", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+def fingerprint(statement):
+    """Return the normalized shape of a statement and its fingerprint key.
+
+    Results are cached by statement text, so repeated statements are only
+    normalized once.
+    """
+    result = _cache.get(statement)
+    if result is None:
+        shape = normalize(statement)
+        result = (shape, hashlib.sha1(shape.encode()).hexdigest())
+        if len(_cache) >= MAX_CACHE_SIZE:
+            _cache.clear()
+        _cache[statement] = result
+    return result
+
+
+class StatementCache(object):
+    """LRU cache of the display text and fingerprint of executed statements.
+
+    SQLAlchemy reuses one compiled object for every execution of a cached
+    statement, so entries are keyed on the compiled object of the execution
+    context; statements executed as plain SQL strings are keyed on their
+    text. A repeated statement then costs one dictionary lookup instead of
+    a compilation and a normalization.
+
+    The compiled string of a statement with expanding IN or literal-execute
+    parameters holds `POSTCOMPILE` placeholders, which are rendered per
+    execution. Such statements are displayed with the text passed to the
+    cursor; their cached shape and fingerprint are the same for every
+    rendering.
+
+    Args:
+    ----
+        maxsize (int): Maximum number of statements kept.
+
+    Attributes:
+    ----------
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups that had to fingerprint the statement.
+
+    """
+
+    def __init__(self, maxsize=1000):
+        """Initialize a StatementCache object."""
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, compiled, statement):
+        """Return the display text, normalized shape and fingerprint key of a statement.
+
+        Args:
+        ----
+        compiled (sqlalchemy.engine.Compiled, optional): The compiled object of the execution context.
+        statement (str): The SQL string passed to the cursor.
+
+        """
+        key = statement if compiled is None else compiled
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None:
+            sql = statement if compiled is None else compiled.string
+            entry = (sql,) + fingerprint(sql)
+            if compiled is not None and (getattr(compiled, "post_compile_params", None)
+                                         or getattr(compiled, "literal_execute_params", None)):
+                # Displayed with the cursor text of each execution instead.
+                entry = (None,) + entry[1:]
+            with self._lock:
+                self._entries[key] = entry
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        if entry[0] is None:
+            return (statement,) + entry[1:]
+        return entry
+
+    def stats(self):
+        """Return the cache counters as a dictionary."""
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,149 @@
+MAX_CALL_SITE_STATEMENTS = 100
+
+
+class CallSiteStats(object):
+    """Running aggregates of the queries issued from one application source line.
+
+    A query is attributed to the innermost application frame of its stack.
+
+    Args:
+    ----
+        filename (str): The source file.
+        lineno (int): The line number.
+        function (str): The function name.
+
+    """
+
+    __slots__ = ("filename", "lineno", "function", "count", "total_time", "statements")
+
+    def __init__(self, filename, lineno, function):
+        """Initialize a CallSiteStats object."""
+        self.filename = filename
+        self.lineno = lineno
+        self.function = function
+        self.count = 0
+        self.total_time = 0.0
+        self.statements = set()
+
+    @property
+    def frame(self):
+        """Return the `(filename, lineno, function)` frame of the call site."""
+        return (self.filename, self.lineno, self.function)
+
+    @property
+    def average(self):
+        """Return the average time of a query in milliseconds."""
+        return round(self.total_time / self.count, 3) if self.count else 0
+
+    def add_statements(self, fingerprints):
+        """Record statement fingerprints, keeping at most `MAX_CALL_SITE_STATEMENTS`."""
+        for query_fingerprint in fingerprints:
+            if len(self.statements) >= MAX_CALL_SITE_STATEMENTS:
+                break
+            self.statements.add(query_fingerprint)
+
+    def add(self, time_taken, query_fingerprint):
+        """Count one query taking `time_taken` milliseconds."""
+        self.count += 1
+        self.total_time += time_taken
+        if query_fingerprint is not None:
+            self.add_statements((query_fingerprint,))
+
+    def merge(self, other):
+        """Add the aggregates of another CallSiteStats to this one."""
+        self.count += other.count
+        self.total_time += other.total_time
+        self.add_statements(other.statements)
+        return self
+
+
+class CallPathStats(object):
+    """Running aggregates of the queries issued through one application call path.
+
+    Args:
+    ----
+        frames (tuple): The application frames of the path, outermost first.
+
+    """
+
+    __slots__ = ("frames", "count", "total_time")
+
+    def __init__(self, frames):
+        """Initialize a CallPathStats object."""
+        self.frames = frames
+        self.count = 0
+        self.total_time = 0.0
+
+    def add(self, time_taken):
+        """Count one query taking `time_taken` milliseconds."""
+        self.count += 1
+        self.total_time += time_taken
+
+
+def aggregate_call_sites(query_objs):
+    """Aggregate captured queries by innermost application frame and by call path.
+
+    Queries without application frames are not counted.
+
+    Args:
+    ----
+    query_objs (list): Dictionaries with `stack`, `time_taken` and `fingerprint` keys.
+
+    Returns:
+    -------
+    tuple: CallSiteStats keyed by frame, and CallPathStats keyed by stack.
+
+    """
+    sites = {}
+    paths = {}
+    for query_obj in query_objs:
+        frames = query_obj["stack"]
+        if not frames:
+            continue
+        call_site = sites.get(frames[-1])
+        if call_site is None:
+            call_site = sites[frames[-1]] = CallSiteStats(*frames[-1])
+        call_site.add(query_obj["time_taken"], query_obj["fingerprint"])
+        call_path = paths.get(frames)
+        if call_path is None:
+            call_path = paths[frames] = CallPathStats(frames)
+        call_path.add(query_obj["time_taken"])
+    return sites, paths
+
+
+def build_call_tree(call_paths):
+    """Merge call paths into a tree weighted by database time.
+
+    Args:
+    ----
+    call_paths (list): CallPathStats.
+
+    Returns:
+    -------
+    dict: The root node. Every node has a `frame` (None for the root), the
+        `count` and `total_time` of the queries issued through it, the `self_time`
+        of the queries issued by the frame itself, and its `children` sorted by time.
+
+    """
+    root = {"frame": None, "count": 0, "total_time": 0.0, "self_time": 0.0, "children": {}}
+    for call_path in call_paths:
+        node = root
+        node["count"] += call_path.count
+        node["total_time"] += call_path.total_time
+        for frame in call_path.frames:
+            child = node["children"].get(frame)
+            if child is None:
+                child = node["children"][frame] = {"frame": frame, "count": 0, "total_time": 0.0,
+                                                   "self_time": 0.0, "children": {}}
+            child["count"] += call_path.count
+            child["total_time"] += call_path.total_time
+            node = child
+        node["self_time"] += call_path.total_time
+
+    def finish(node):
+        node["total_time"] = round(node["total_time"], 3)
+        node["self_time"] = round(node["self_time"], 3)
+        node["children"] = sorted((finish(child) for child in node["children"].values()),
+                                  key=lambda child: child["total_time"], reverse=True)
+        return node
+    return finish(root)
@@ -0,0 +1,162 @@
+import asyncio
+import collections
+import threading
+
+
+class Subscription(object):
+    """A viewer of the live feed, with its filters and bounded buffer.
+
+    Events are appended by :meth:`LiveFeed.publish`, from any thread, and
+    read by :meth:`get` on the event loop the subscription was created in.
+    When the viewer falls `maxsize` events behind, the oldest ones are
+    dropped and counted, so a slow viewer never holds back the publisher.
+
+    Args:
+    ----
+        path (str, optional): Path prefix of the requests kept.
+        method (str, optional): HTTP method of the requests kept.
+        min_time (float, optional): Minimum request time in milliseconds.
+        min_queries (int, optional): Minimum number of queries.
+        maxsize (int): Maximum number of events buffered.
+
+    Attributes:
+    ----------
+        dropped (int): Number of events dropped since the last :meth:`get`.
+
+    """
+
+    def __init__(self, path=None, method=None, min_time=None, min_queries=None, maxsize=100):
+        """Initialize a Subscription object; must be called from the event loop reading it."""
+        self.path = path
+        self.method = method.upper() if method else None
+        self.min_time = min_time
+        self.min_queries = min_queries
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.events = collections.deque()
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+
+    def matches(self, summary):
+        """Return whether a request summary passes the subscription's filters."""
+        return ((not self.path or summary["path"].startswith(self.path))
+                and (not self.method or summary["method"] == self.method)
+                and (self.min_time is None or summary["time_taken"] >= self.min_time)
+                and (self.min_queries is None or summary["total_queries"] >= self.min_queries))
+
+    def push(self, summary):
+        """Buffer an event, dropping the oldest one if the buffer is full."""
+        if len(self.events) >= self.maxsize:
+            self.events.popleft()
+            self.dropped += 1
+        self.events.append(summary)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._ready.set()
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            # The viewer's event loop is closed; it is unsubscribed when its stream ends.
+            pass
+
+    async def get(self, timeout=None):
+        """Wait for events and return them with the number dropped since the last call.
+
+        Returns
+        -------
+        tuple: The buffered events, oldest first, and the number of dropped events.
+            Both are empty once `timeout` seconds pass without an event.
+
+        """
+        if not self.events:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        dropped, self.dropped = self.dropped, 0
+        return events, dropped
+
+
+class LiveFeed(object):
+    """In-process publish/subscribe feed of completed request summaries.
+
+    The middleware publishes a summary of every saved request; viewers of
+    the `/live` endpoint subscribe with server-side filters. Publishing is
+    a loop over the subscriptions, skipped entirely when there is none, and
+    never touches the profiler database.
+
+    Args:
+    ----
+        max_subscribers (int): Maximum number of simultaneous subscriptions.
+
+    """
+
+    def __init__(self, max_subscribers=100):
+        """Initialize a LiveFeed object."""
+        self.max_subscribers = max_subscribers
+        self.subscriptions = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, **filters):
+        """Add a subscription taking the filters and buffer size of :class:`Subscription`.
+
+        Returns
+        -------
+        Subscription: The new subscription, or None if `max_subscribers` are connected.
+
+        """
+        with self._lock:
+            if len(self.subscriptions) >= self.max_subscribers:
+                return None
+            subscription = Subscription(**filters)
+            self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Remove a subscription."""
+        with self._lock:
+            self.subscriptions = [other for other in self.subscriptions if other is not subscription]
+
+    def publish(self, summary):
+        """Deliver a request summary to every subscription it matches."""
+        for subscription in self.subscriptions:
+            if subscription.matches(summary):
+                subscription.push(summary)
+
+
+def request_summary(record):
+    """Return the live feed summary of a finished request record."""
+    return {
+        "path": record["path"],
+        "route": record.get("route"),
+        "method": record["method"],
+        "start_time": record["start_time"].isoformat(),
+        "time_taken": record["time_taken"],
+        "total_queries": len(record["queries"]),
+        "db_time": round(sum(query_obj["time_taken"] for query_obj in record["queries"]), 3),
+        "n_plus_one": record["n_plus_one"],
+        "duplicate_queries": record["duplicate_queries"],
+        "regression": record.get("regression"),
+    }
+
+
+_live_feed = None
+
+
+def get_live_feed():
+    """Return the feed streamed on `/live`, or None."""
+    return _live_feed
+
+
+def set_live_feed(live_feed):
+    """Set the feed streamed on `/live`."""
+    global _live_feed
+    _live_feed = live_feed
@@ -0,0 +1,162 @@
+import bisect
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class FixedHistogram(object):
+    """Prometheus style histogram with fixed bucket upper bounds.
+
+    Args:
+    ----
+        bounds (tuple): Sorted upper bounds of the buckets, without `+Inf`.
+
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        """Initialize a FixedHistogram object."""
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Count a value."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return `(upper bound, cumulative count)` pairs, ending with `+Inf`."""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class RouteMetrics(object):
+    """The histograms of one route and method."""
+
+    __slots__ = ("latency", "db_time", "queries")
+
+    def __init__(self):
+        """Initialize a RouteMetrics object."""
+        self.latency = FixedHistogram(LATENCY_BUCKETS)
+        self.db_time = FixedHistogram(LATENCY_BUCKETS)
+        self.queries = FixedHistogram(QUERY_BUCKETS)
+
+
+class MetricsAggregator(object):
+    """In-process aggregates of the profiled requests, per route template and method.
+
+    The middleware calls :meth:`observe` once per captured request, from the
+    event loop, so updates need no lock. :meth:`render` reads only these
+    aggregates, never the profiler tables, and costs O(number of routes).
+    Routes are labeled with their template, such as `/users/{user_id}`, to
+    keep the number of series bounded.
+    """
+
+    HISTOGRAMS = (
+        ("latency", "sql_profiler_request_duration_seconds", "Time taken by profiled requests."),
+        ("db_time", "sql_profiler_request_db_duration_seconds", "Database time of profiled requests."),
+        ("queries", "sql_profiler_request_queries", "Number of queries issued by profiled requests."),
+    )
+
+    def __init__(self):
+        """Initialize a MetricsAggregator object."""
+        self.routes = {}
+
+    def observe(self, route, method, time_taken, db_time, queries):
+        """Count a finished request.
+
+        Args:
+        ----
+        route (str): The route template of the request.
+        method (str): The HTTP method.
+        time_taken (float): The request time in milliseconds.
+        db_time (float): The total time of its queries in milliseconds.
+        queries (int): The number of queries.
+
+        """
+        route_metrics = self.routes.get((route, method))
+        if route_metrics is None:
+            route_metrics = self.routes[(route, method)] = RouteMetrics()
+        route_metrics.latency.observe(time_taken / 1000)
+        route_metrics.db_time.observe(db_time / 1000)
+        route_metrics.queries.observe(queries)
+
+    def clear(self):
+        """Forget every aggregate."""
+        self.routes = {}
+
+    def render(self):
+        """Return the aggregates in the Prometheus text exposition format."""
+        routes = sorted(self.routes.items())
+        lines = []
+        for attribute, name, description in self.HISTOGRAMS:
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s histogram" % name)
+            for (route, method), route_metrics in routes:
+                histogram = getattr(route_metrics, attribute)
+                labels = 'route="%s",method="%s"' % (escape_label(route), escape_label(method))
+                for bound, count in histogram.cumulative():
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, format_bound(bound), count))
+                lines.append("%s_sum{%s} %s" % (name, labels, repr(round(histogram.sum, 6))))
+                lines.append("%s_count{%s} %d" % (name, labels, histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    """Escape a Prometheus label value."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_bound(bound):
+    """Format a bucket upper bound as a Prometheus `le` label."""
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(float(bound))
+
+
+def route_template(scope, root_path=""):
+    """Return the route template matched for an ASGI request, once it was handled.
+
+    Routes of mounted sub-applications are prefixed with the path they were
+    mounted under, read from the `root_path` the mounts extended.
+
+    Args:
+    ----
+    scope: The ASGI connection scope, updated by the application's routing.
+    root_path (str): The `root_path` of the scope before it reached the application.
+
+    Returns:
+    -------
+    str: The route template, or `UNMATCHED_ROUTE`.
+
+    """
+    path = getattr(scope.get("route"), "path", None)
+    if not path:
+        return UNMATCHED_ROUTE
+    mount_path = scope.get("root_path", "")
+    if mount_path.startswith(root_path):
+        mount_path = mount_path[len(root_path):]
+    return mount_path.rstrip("/") + path
+
+
+_metrics = None
+
+
+def get_metrics():
+    """Return the aggregator exposed on `/metrics`, or None."""
+    return _metrics
+
+
+def set_metrics(metrics):
+    """Set the aggregator exposed on `/metrics`."""
+    global _metrics
+    _metrics = metrics
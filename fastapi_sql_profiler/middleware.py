@@ -1,84 +1,264 @@
+import atexit
+import contextvars
 import datetime
 import time
-import traceback
+import weakref
 
 import sqlalchemy.event
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
 
-from .database import session
-from .models import QueryInfo, RequestInfo
+from . import database
+from .add_request import router as dashboard_router
+from .baselines import BaselineTracker, set_baselines
+from .explain import ExplainCapture
+from .fingerprint import StatementCache
+from .live import LiveFeed, request_summary, set_live_feed
+from .metrics import UNMATCHED_ROUTE, MetricsAggregator, route_template, set_metrics
+from .params import DEFAULT_REDACT, ParamCapture
+from .retention import Pruner
+from .sampling import Sampler
+from .stack import StackCapture
+from .storage import SQLStore, set_store
+from .writer import ProfileWriter
+
+
+_current_handler = contextvars.ContextVar("sql_profiler_session_handler", default=None)
+_instrumented_engines = weakref.WeakSet()
+_open_middlewares = weakref.WeakSet()
+_default_stack_capture = StackCapture()
+_default_statement_cache = StatementCache()
+
+
+def _before_execute(conn, clause, multiparams, params, execution_options):
+    """Engine-wide `before_execute` hook routing to the current request's handler."""
+    handler = _current_handler.get()
+    if handler is not None:
+        handler._before_exec(conn, clause, multiparams, params)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Engine-wide `before_cursor_execute` hook routing to the current request's handler."""
+    handler = _current_handler.get()
+    if handler is not None:
+        handler._before_cursor_exec(conn, context)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Engine-wide `after_cursor_execute` hook routing to the current request's handler."""
+    handler = _current_handler.get()
+    if handler is not None:
+        handler._after_cursor_exec(conn, cursor, statement, parameters, context, executemany)
+
+
+@atexit.register
+def _close_middlewares():
+    """Persist the records still queued by every middleware when the interpreter exits."""
+    for middleware in list(_open_middlewares):
+        middleware.close()
+
+
+def install_listeners(engine):
+    """Install the profiler's execution hooks on an engine, once.
+
+    The hooks stay registered for the lifetime of the engine. Each execution
+    is routed to the :class:`SessionHandler` stored in a context variable by
+    :meth:`SessionHandler.start`, so concurrent requests only ever see their
+    own queries and starting a session does not touch the engine's listeners.
+    The context variable is inherited by the handler's task and by the
+    threadpool running sync endpoints.
+
+    An `AsyncEngine` is profiled through its `sync_engine`: SQLAlchemy runs
+    its statements in a greenlet that shares the awaiting task's context, so
+    queries are attributed to the right request across awaits.
+
+    Args:
+    ----
+    engine (sqlalchemy.engine.Engine or sqlalchemy.ext.asyncio.AsyncEngine): The SQLAlchemy engine to profile.
+
+    """
+    engine = getattr(engine, "sync_engine", engine)
+    if engine in _instrumented_engines:
+        return
+    sqlalchemy.event.listen(engine, "before_execute", _before_execute)
+    sqlalchemy.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    sqlalchemy.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    _instrumented_engines.add(engine)
 
 
 class SessionHandler(object):
     """Handler for SQLAlchemy session profiling.
 
+    A handler collects the queries executed in the context it was started
+    from. Queries are routed to it by the hooks of :func:`install_listeners`.
+
+    Each query is timed with `time.perf_counter_ns` around the DBAPI cursor
+    call, so its time is the driver and database time only. The time spent
+    by SQLAlchemy between `execute` and the cursor call, compiling the
+    statement and processing its parameters, is recorded separately as its
+    compile time.
+
     Args:
     ----
         engine (sqlalchemy.engine.Engine, optional): SQLAlchemy Engine object to use for database operations.
             Defaults to `sqlalchemy.engine.Engine`.
+        stack_capture (StackCapture, optional): Captures the call stack of each query.
+        param_capture (ParamCapture, optional): Formats the bound parameters of each query.
+            Parameters are not recorded when it is not set.
+        statement_cache (StatementCache, optional): Caches the text and fingerprint of each statement.
+        explain_capture (ExplainCapture, optional): Explains the statements of slow queries.
 
     Attributes:
     ----------
         started (bool): Indicates whether the session profiling has been started.
         engine (sqlalchemy.engine.Engine): The SQLAlchemy Engine object used for database operations.
         query_objs (list): List to store query objects during profiling.
+        query_groups (dict): Query count, time, first time and duplicate time, in milliseconds,
+            keyed by statement fingerprint and call site.
+        duplicate_queries (int): Number of executions repeating an earlier query with the same parameters.
 
     """
 
-    def __init__(self, engine=sqlalchemy.engine.Engine):
+    def __init__(self, engine=sqlalchemy.engine.Engine, stack_capture=None, param_capture=None,
+                 statement_cache=None, explain_capture=None):
         """Initialize a SessionHandler object.
 
         Args:
         ----
         engine (sqlalchemy.engine.Engine): The SQLAlchemy engine to be used for the session.
             Defaults to `sqlalchemy.engine.Engine`.
+        stack_capture (StackCapture, optional): Captures the call stack of each query.
+            Defaults to keeping application frames only.
+        param_capture (ParamCapture, optional): Formats the bound parameters of each query.
+        statement_cache (StatementCache, optional): Caches the text and fingerprint of each statement.
+            Defaults to a cache shared by every handler.
+        explain_capture (ExplainCapture, optional): Explains the statements of slow queries.
 
         """
         self.started = False
         self.engine = engine
+        self.stack_capture = stack_capture or _default_stack_capture
+        self.param_capture = param_capture
+        self.statement_cache = statement_cache or _default_statement_cache
+        self.explain_capture = explain_capture
         self.query_objs = []
+        self.query_groups = {}
+        self.duplicate_queries = 0
+        self._executed = set()
+        self._token = None
 
     def _before_exec(self, conn, clause, multiparams, params):  # noqa: ARG002
         """SQLAlchemy event hook for handling before query execution.
 
-        This method is called as an event hook by SQLAlchemy before a query is executed.
-        It sets the start time of the query execution on the connection object.
+        This method is called as an event hook by SQLAlchemy before a statement is compiled.
+        It sets the start time of the statement execution on the connection object.
         """
-        conn._sqltap_query_start_time = time.time()
+        conn._sqltap_execute_start = time.perf_counter_ns()
 
-    def _after_exec(self, conn, clause, multiparams, params, results):  # noqa: ARG002
-        """SQLAlchemy event hook called after query execution.
+    def _before_cursor_exec(self, conn, context):  # noqa: ARG002
+        """SQLAlchemy event hook called just before the DBAPI cursor executes the statement."""
+        context._sqltap_cursor_start = time.perf_counter_ns()
 
-        This method is an event hook that is called after the execution of a database query.
-        It captures the end time of the query execution, retrieves the start time from the connection object,
-        compiles the query text, captures the stack trace, and appends the query information
-        to the list of query objects.
+    def _after_cursor_exec(self, conn, cursor, statement, parameters, context, executemany):
+        """SQLAlchemy event hook called after the DBAPI cursor executed the statement.
+
+        This method measures the driver time of the query and the compile time that
+        preceded it, reads the row count and executemany batch size, looks up the query
+        text and fingerprint in the statement cache, captures the application frames of the call stack, and appends the query
+        information to the list of query objects. The query is also counted in its
+        group of identical statement shape and call site, and flagged if an identical query
+        with the same parameters already ran. A slow query is handed to the explain capture.
 
         Args:
         ----
         conn (sqlalchemy.engine.Connection): The SQLAlchemy connection object.
-        clause (sqlalchemy.sql.ClauseElement or str): The SQLAlchemy statement or clause that was executed.
-        multiparams (tuple or dict): The multiparams passed to the executed statement.
-        params (dict): The params passed to the executed statement.
-        results: The results of the query execution.
+        cursor: The DBAPI cursor.
+        statement (str): The SQL string passed to the cursor.
+        parameters: The parameters passed to the cursor.
+        context (sqlalchemy.engine.ExecutionContext): The execution context of the statement.
+        executemany (bool): Whether the statement was executed once per parameter set.
         """
-        end_time = time.time()
-        start_time = getattr(conn, '_sqltap_query_start_time', end_time)
-
-        try:
-            text = clause.compile(dialect=conn.engine.dialect)
-        except AttributeError:
-            text = clause
-        stack = traceback.extract_stack()
-        stack_string = ''.join(traceback.format_list(stack))
+        end = time.perf_counter_ns()
+        cursor_start = getattr(context, '_sqltap_cursor_start', end)
+        execute_start = getattr(conn, '_sqltap_execute_start', None)
+        # Further cursor calls of the same execution have no compile time of their own.
+        conn._sqltap_execute_start = None
+        time_taken = (end - cursor_start) / 1e6
+        compile_time = (cursor_start - execute_start) / 1e6 if execute_start is not None else 0.0
+
+        sql, query_statement, query_fingerprint = self.statement_cache.lookup(context.compiled, statement)
+        stack = self.stack_capture.capture()
+        rowcount = cursor.rowcount
         d = {
-            "start_time": start_time,
-            "end_time": end_time,
-            "text": text,
-            "stack": stack_string,
+            "time_taken": round(time_taken, 3),
+            "compile_time": round(compile_time, 3),
+            "rowcount": rowcount if rowcount is not None and rowcount >= 0 else None,
+            "batch_size": len(parameters) if executemany else 1,
+            "params": self.param_capture.format(parameters, context, executemany) if self.param_capture else None,
+            "text": sql,
+            "stack": stack,
+            "statement": query_statement,
+            "fingerprint": query_fingerprint,
         }
         self.query_objs.append(d)
+        # An executemany batch is not checked for duplicates: its key would copy every parameter set.
+        self._count_repeats(query_fingerprint, stack, statement, None if executemany else repr(parameters),
+                            time_taken)
+        if (self.explain_capture is not None and not executemany
+                and time_taken >= self.explain_capture.slow_query_ms):
+            self.explain_capture.submit(query_fingerprint, statement, parameters)
+
+    def _count_repeats(self, query_fingerprint, stack, text, parameters, time_taken):
+        """Count a query in its fingerprint and call site group, and flag exact duplicates.
+
+        Queries whose `parameters` are None are grouped but never flagged as duplicates.
+        """
+        group = self.query_groups.get((query_fingerprint, stack))
+        if group is None:
+            group = self.query_groups[(query_fingerprint, stack)] = [0, 0.0, time_taken, 0.0]
+        group[0] += 1
+        group[1] += time_taken
+        if parameters is None:
+            return
+        key = (text, parameters)
+        if key in self._executed:
+            self.duplicate_queries += 1
+            group[3] += time_taken
+        else:
+            self._executed.add(key)
+
+    def repeats(self, threshold=3):
+        """Summarize the repeated queries of the session.
+
+        A statement shape issued at least `threshold` times from the same call
+        site is an N+1 pattern. Wasted time is the time of every execution of
+        such a pattern after the first, plus the time of any other exact duplicate.
+
+        Args:
+        ----
+        threshold (int): Minimum number of executions of a pattern.
+
+        Returns:
+        -------
+        dict: `n_plus_one` patterns, `repeated_queries`, `duplicate_queries` and `wasted_time` in ms.
+
+        """
+        n_plus_one = 0
+        repeated_queries = 0
+        wasted_time = 0.0
+        for count, total_time, first_time, duplicate_time in self.query_groups.values():
+            if count >= threshold:
+                n_plus_one += 1
+                repeated_queries += count - 1
+                wasted_time += total_time - first_time
+            else:
+                wasted_time += duplicate_time
+        return {
+            "n_plus_one": n_plus_one,
+            "repeated_queries": repeated_queries,
+            "duplicate_queries": self.duplicate_queries,
+            "wasted_time": round(wasted_time, 3),
+        }
 
     def start(self):
         """Start profiling.
@@ -90,9 +270,8 @@ class SessionHandler(object):
             msg = "Profiling session is already started!"
             raise AssertionError(msg)
         self.started = True
-        sqlalchemy.event.listen(self.engine, "before_execute",
-                                self._before_exec)
-        sqlalchemy.event.listen(self.engine, "after_execute", self._after_exec)
+        install_listeners(self.engine)
+        self._token = _current_handler.set(self)
 
     def stop(self):
         """Stop profiling.
@@ -105,162 +284,466 @@ class SessionHandler(object):
             raise AssertionError(msg)
 
         self.started = False
-        sqlalchemy.event.remove(self.engine, "before_execute",
-                                self._before_exec)
-        sqlalchemy.event.remove(self.engine, "after_execute", self._after_exec)
+        _current_handler.reset(self._token)
+        self._token = None
+
+
+class QueryCounter(SessionHandler):
+    """Session handler only counting the queries of a request and their driver time.
+
+    It is started for the requests outside the head sample, so they are
+    counted in the metrics and baselines without capturing their statements,
+    stacks or parameters.
+
+    Attributes:
+    ----------
+        queries (int): Number of queries executed.
+        db_time (float): Total driver time of the queries in milliseconds.
+
+    """
+
+    def __init__(self, engine=sqlalchemy.engine.Engine):
+        """Initialize a QueryCounter object."""
+        super().__init__(engine)
+        self.queries = 0
+        self.db_time = 0.0
+
+    def _before_exec(self, conn, clause, multiparams, params):  # noqa: ARG002
+        """Compile time is not measured."""
+
+    def _after_cursor_exec(self, conn, cursor, statement, parameters, context, executemany):  # noqa: ARG002
+        """Count a query and its driver time."""
+        end = time.perf_counter_ns()
+        self.queries += 1
+        self.db_time += (end - getattr(context, '_sqltap_cursor_start', end)) / 1e6
 
 
-class SQLProfilerMiddleware(BaseHTTPMiddleware):
-    """Middleware for database profiling.
+class SQLProfilerMiddleware(object):
+    """ASGI middleware for database profiling.
+
+    Captured requests and queries are saved to a storage backend, which the
+    dashboard router reads from. With the default :class:`SQLStore` they are
+    not written while serving the request: they are handed to a bounded
+    :class:`ProfileWriter` queue and persisted in batches by a background
+    thread, so profiling never waits on the profiler database. A
+    :class:`MemoryStore` is appended to directly. The profiler database is
+    opened by the first write or read that needs it, or by
+    :func:`database.init`, never when the middleware is created. Records
+    still queued are persisted when the application shuts down, see :meth:`close`.
+
+    The request body is never buffered for the application: JSON and
+    multipart bodies are copied chunk by chunk into a capture buffer of at
+    most `max_body_size` bytes as the application reads them, and responses
+    are passed through untouched.
 
     Args:
     ----
         app (ASGIApp): The ASGI application to wrap the middleware around.
-        Base: The SQLAlchemy Base class for table creation.
-        engine (sqlalchemy.engine.Engine): The SQLAlchemy Engine object for database operations.
+        engine (sqlalchemy.engine.Engine or sqlalchemy.ext.asyncio.AsyncEngine): The SQLAlchemy
+            engine whose queries are profiled.
+        queue_size (int): Maximum number of captured requests waiting to be persisted.
+            Requests captured while the queue is full are dropped and counted.
+        batch_size (int): Maximum number of captured requests persisted per transaction.
+        flush_interval (float): Maximum seconds a captured request waits before being persisted.
+        capture_body (bool): Whether JSON and multipart request bodies are recorded.
+        max_body_size (int): Maximum number of body bytes recorded per request.
+        parse_multipart (bool): Whether a recorded multipart body is parsed into its fields
+            after the response is sent. Otherwise the raw bytes are recorded.
+        sampler (Sampler, optional): Decides which requests are captured and persisted.
+            Defaults to profiling every request. Requests outside the sample are still
+            counted in the metrics and baselines.
+        stack_include (tuple, optional): Path prefixes of the application frames kept in query stacks.
+        stack_exclude (tuple, optional): Path prefixes of the frames dropped from query stacks.
+            Defaults to the standard library, installed packages and the profiler.
+        stack_depth (int): Maximum number of frames kept per query stack.
+        n_plus_one_threshold (int): Minimum number of executions of one statement shape
+            from one call site flagged as an N+1 pattern.
+        capture_params (bool): Whether the bound parameters of each query are recorded.
+        param_redact (tuple): Words marking a parameter name as sensitive; its value is
+            recorded as `<redacted>`.
+        max_param_size (int): Maximum number of characters of parameters recorded per query.
+        statement_cache_size (int): Maximum number of distinct statements whose text and
+            fingerprint are cached.
+        store (BaseStore, optional): Where captured requests are saved. Defaults to
+            a :class:`SQLStore` writing to the profiler database.
+        retention (RetentionPolicy, optional): Limits enforced on the store by a background
+            :class:`Pruner`. Defaults to keeping every request.
+        prune_interval (float): Seconds between two pruning runs.
+        metrics (bool): Whether per-route latency, database time and query count
+            histograms are kept in memory and exposed on `/metrics`.
+        explain_slow_ms (float, optional): Minimum time of the queries whose plan is captured,
+            in milliseconds. Plans are not captured when it is not set.
+        explain_interval (float): Minimum seconds between two plans of one statement shape.
+        explain_engine (sqlalchemy.engine.Engine, optional): The synchronous engine EXPLAIN
+            statements run on. Defaults to `engine`; required to capture plans when `engine`
+            is an `AsyncEngine`.
+        database_url (str, optional): The profiler database URL. Defaults to the
+            `SQLALCHEMY_DATABASE_URL` environment variable.
+        database_pool_size (int, optional): Number of pooled connections to the profiler database.
+        create_schema (bool, optional): Whether the profiler tables are created if missing. Defaults to True.
+        live (bool): Whether summaries of the saved requests are published to viewers of `/live`.
+        baselines (BaselineTracker, optional): Per-route baselines each request is compared to;
+            regressed requests are flagged. Defaults to rolling baselines with the default
+            thresholds; pass False to disable.
+        baseline_name (str, optional): Name of a saved baseline made the reference of every worker
+            at startup, such as the previous deploy version. Defaults to the reference chosen on
+            the dashboard, or the rolling baselines.
 
     Attributes:
     ----------
         app (ASGIApp): The ASGI application to wrap the middleware around.
-        Base: The SQLAlchemy Base class for table creation.
         engine (sqlalchemy.engine.Engine): The SQLAlchemy Engine object for database operations.
-        Session (sqlalchemy.orm.session.sessionmaker): The SQLAlchemy sessionmaker for creating database sessions.
-        RequestInfo (class): The SQLAlchemy model class representing the 'middleware_requests' table.
-        QueryInfo (class): The SQLAlchemy model class representing the 'middleware_query' table.
-        queries (list): List to store query information during profiling.
+        store (BaseStore): Where captured requests are saved.
+        writer (ProfileWriter): The background queue persisting captured requests,
+            or None when the store is written to directly.
+        pruner (Pruner): The background thread enforcing `retention`, or None.
+        statement_cache (StatementCache): The statement text and fingerprint cache, with its
+            hit and miss counters.
+        metrics (MetricsAggregator): The per-route histograms, or None.
+        explain_capture (ExplainCapture): The background thread capturing query plans, or None.
+        live_feed (LiveFeed): The feed of saved request summaries, or None.
+        baselines (BaselineTracker): The per-route baselines, or None.
+        sampled_out (int): Number of captured requests discarded by the sampler's tail rules.
 
     """
 
-    def __init__(self, app, engine) -> None:
+    def __init__(self, app, engine, queue_size=10000, batch_size=100, flush_interval=1.0,
+                 capture_body=True, max_body_size=65536, parse_multipart=False, sampler=None,
+                 stack_include=None, stack_exclude=None, stack_depth=20, n_plus_one_threshold=3,
+                 capture_params=False, param_redact=DEFAULT_REDACT, max_param_size=1024, statement_cache_size=1000,
+                 store=None, retention=None, prune_interval=60.0, metrics=True, explain_slow_ms=None,
+                 explain_interval=3600.0, explain_engine=None, database_url=None, database_pool_size=None,
+                 create_schema=None, live=True, baselines=None, baseline_name=None) -> None:
         """Initialize a SQLProfilerMiddleware object.
 
         Args:
         ----
         app: The Starlette application instance.
-        base: The SQLAlchemy Base class.
         engine: The SQLAlchemy engine to be used for the database connection.
+        queue_size: Maximum number of captured requests waiting to be persisted.
+        batch_size: Maximum number of captured requests persisted per transaction.
+        flush_interval: Maximum seconds a captured request waits before being persisted.
+        capture_body: Whether JSON and multipart request bodies are recorded.
+        max_body_size: Maximum number of body bytes recorded per request.
+        parse_multipart: Whether a recorded multipart body is parsed into its fields.
+        sampler: Decides which requests are captured and persisted.
+        stack_include: Path prefixes of the application frames kept in query stacks.
+        stack_exclude: Path prefixes of the frames dropped from query stacks.
+        stack_depth: Maximum number of frames kept per query stack.
+        n_plus_one_threshold: Minimum number of executions flagged as an N+1 pattern.
+        capture_params: Whether the bound parameters of each query are recorded.
+        param_redact: Words marking a parameter name as sensitive.
+        max_param_size: Maximum number of characters of parameters recorded per query.
+        statement_cache_size: Maximum number of distinct statements whose text and fingerprint are cached.
+        store: Where captured requests are saved; also used by the dashboard router.
+        retention: Limits enforced on the store by a background pruner.
+        prune_interval: Seconds between two pruning runs.
+        metrics: Whether per-route histograms are kept and exposed on `/metrics`.
+        explain_slow_ms: Minimum time in milliseconds of the queries whose plan is captured.
+        explain_interval: Minimum seconds between two plans of one statement shape.
+        explain_engine: The synchronous engine EXPLAIN statements run on.
+        database_url: The profiler database URL.
+        database_pool_size: Number of pooled connections to the profiler database.
+        create_schema: Whether the profiler tables are created if missing.
+        live: Whether summaries of the saved requests are published to viewers of `/live`.
+        baselines: Per-route baselines each request is compared to, or False.
+        baseline_name: Name of a saved baseline loaded as the reference.
 
         """
         self.app = app
         self.engine = engine
-        self.dispatch_func = self.dispatch
-        self.queries = []
-
-    def add_request(self, request, raw_body, body):
-        """Add a new request to the 'middleware_requests' table.
+        self.capture_body = capture_body
+        self.max_body_size = max_body_size
+        self.parse_multipart = parse_multipart
+        self.sampler = sampler or Sampler()
+        self.sampled_out = 0
+        self.stack_capture = StackCapture(stack_include, stack_exclude, stack_depth)
+        if database_url is not None or database_pool_size is not None or create_schema is not None:
+            database.configure(database_url, database_pool_size, create_schema)
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.param_capture = ParamCapture(param_redact, max_param_size) if capture_params else None
+        self.statement_cache = StatementCache(statement_cache_size)
+        self.store = store or SQLStore()
+        set_store(self.store)
+        install_listeners(engine)
+        self.writer = None
+        if self.store.write_behind:
+            self.writer = ProfileWriter(self.store.save, maxsize=queue_size, batch_size=batch_size,
+                                        flush_interval=flush_interval)
+        self.metrics = MetricsAggregator() if metrics else None
+        set_metrics(self.metrics)
+        self.live_feed = LiveFeed() if live else None
+        set_live_feed(self.live_feed)
+        self.baselines = None
+        if baselines is not False:
+            self.baselines = baselines or BaselineTracker()
+        set_baselines(self.baselines)
+        # Made the reference once the baselines start syncing with the store on the first request,
+        # as the profiler database is not opened before.
+        self._baseline_name = baseline_name if self.baselines is not None else None
+        self._dashboard_patterns = None
+        self.pruner = None
+        if retention is not None:
+            self.pruner = Pruner(self.store, retention, interval=prune_interval)
+        self.explain_capture = None
+        if explain_engine is None and not hasattr(engine, "sync_engine"):
+            explain_engine = engine
+        if explain_slow_ms is not None and explain_engine is not None:
+            self.explain_capture = ExplainCapture(explain_engine, self.store, explain_slow_ms, explain_interval)
+        _open_middlewares.add(self)
+
+    def add_request(self, request):
+        """Build the record of a new request.
 
         Args:
         ----
         request (Request): The incoming Starlette Request object.
-        raw_body (str): The raw body of the request.
-        body (str): The processed body of the request.
 
         Returns:
         -------
-        RequestInfo: The newly added request object.
+        dict: The request fields, completed by :meth:`finish_request` once the response is ready.
 
         """
-        method = request.method
-        path = request.url.path
-        query_params = str(request.query_params)
-        headers_json = dict(request.headers)
-        request_info = RequestInfo(path=path, query_params=query_params, raw_body=raw_body,
-                                   body=body, method=method, start_time=datetime.datetime.utcnow(), headers=headers_json)
-        session.add(request_info)
-        session.commit()
-        session.refresh(request_info)
-        return request_info
-
-    def store(self, session_handler, request_id):
-        """Store the profiling information into the database.
+        return {
+            "path": request.url.path,
+            "query_params": str(request.query_params),
+            "raw_body": '',
+            "body": '',
+            "method": request.method,
+            "start_time": datetime.datetime.utcnow(),
+            "headers": dict(request.headers),
+        }
+
+    def finish_request(self, record, session_handler, sampled=True):
+        """Complete a request record and hand it to the writer, or save it directly.
 
         Args:
         ----
+        record (dict): The record returned by :meth:`add_request`.
         session_handler (SessionHandler): The SessionHandler object containing the query information.
-        request_id (int): The ID of the request being profiled.
+        sampled (bool): Whether the request was head-sampled. Otherwise it is
+            only persisted if it matches one of the sampler's tail rules. It is
+            counted in the metrics and baselines either way.
 
         """
-        for query_obj in session_handler.query_objs:
-            time_taken = query_obj['end_time'] - query_obj['start_time']
-            mstimetaken = round(time_taken*1000, 3)
-            query_data = QueryInfo(query=str(
-                query_obj['text']), request_id=request_id, time_taken=mstimetaken, traceback=query_obj['stack'])
-            session.add(query_data)
-            session.commit()
-            session.close()
         end_time = datetime.datetime.utcnow()
-        request_obj = session.get(RequestInfo, request_id)
-        time_taken = end_time - request_obj.start_time
-        time_taken_second = time_taken.total_seconds()
-        time_taken_ms = round(time_taken_second*1000, 3)
-        request_obj.end_time = end_time
-        request_obj.time_taken = time_taken_ms
-        request_obj.total_queries = len(session_handler.query_objs)
-        session.add(request_obj)
-        session.commit()
-        session.refresh(request_obj)
-        session.close()
-
-    async def set_body(self, request: Request, body: bytes):
-        """Set the body of the request.
-
-        This method is used to set the body of the request to the provided bytes.
-        It updates the `request._receive` attribute with an asynchronous function
-        that returns a dictionary containing the request type and body.
+        time_taken = end_time - record["start_time"]
+        record["end_time"] = end_time
+        record["time_taken"] = round(time_taken.total_seconds()*1000, 3)
+        record["queries"] = session_handler.query_objs
+        record.update(session_handler.repeats(self.n_plus_one_threshold))
+        db_time = sum(query_obj["time_taken"] for query_obj in record["queries"])
+        flags = self.observe(record.get("route", UNMATCHED_ROUTE), record["method"], record["time_taken"], db_time,
+                             len(record["queries"]))
+        if self.baselines is not None:
+            record["regression"] = ",".join(flags) or None
+        if not sampled and not self.sampler.keep(record):
+            self.sampled_out += 1
+            return
+        if self.live_feed is not None and self.live_feed.subscriptions:
+            self.live_feed.publish(request_summary(record))
+        if self.pruner is not None and not self.pruner.started:
+            self.pruner.start()
+        if self.writer is None:
+            self.store.save([record])
+        else:
+            self.writer.put(record)
+
+    def observe(self, route, method, time_taken, db_time, queries):
+        """Count a finished request in the metrics and baselines.
 
         Args:
         ----
-        request: The Starlette Request object.
-        body: The bytes representing the body of the request.
+        route (str): The route template of the request.
+        method (str): The HTTP method.
+        time_taken (float): The request time in milliseconds.
+        db_time (float): The total time of its queries in milliseconds.
+        queries (int): The number of queries.
 
+        Returns:
+        -------
+        tuple: The regression flags of the request.
+
+        """
+        if self.metrics is not None:
+            self.metrics.observe(route, method, time_taken, db_time, queries)
+        if self.baselines is None:
+            return ()
+        if not self.baselines.started:
+            self.baselines.start(self.store, self._baseline_name)
+            self._baseline_name = None
+        return self.baselines.observe(route, method, time_taken, db_time, queries)
+
+    async def count_request(self, scope, receive, send):
+        """Pass a request outside the head sample to the application, only counting it.
+
+        Its queries are counted by a :class:`QueryCounter`, and the request is
+        observed in the metrics and baselines like captured requests, but
+        nothing else is recorded.
         """
-        async def receive():
-            """Asynchronous function to return the request type and body.
+        root_path = scope.get("root_path", "")
+        counter = QueryCounter(self.engine)
+        start = time.perf_counter_ns()
+        counter.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            counter.stop()
+            time_taken = round((time.perf_counter_ns() - start) / 1e6, 3)
+            self.observe(route_template(scope, root_path), scope["method"], time_taken, round(counter.db_time, 3),
+                         counter.queries)
+
+    def close(self, timeout=10.0):
+        """Persist the queued records, stop the background threads and close the store.
+
+        Called when the application's lifespan shuts down, and otherwise when
+        the interpreter exits. The middleware keeps working if requests are
+        still served afterwards: the threads are restarted when needed.
 
-            Returns
-            -------
-            A dictionary with keys 'type' and 'body' containing the request type and body, respectively.
+        Args:
+        ----
+        timeout (float): Maximum seconds waited for each background thread.
+
+        """
+        if self.pruner is not None:
+            self.pruner.stop(timeout)
+        if self.explain_capture is not None:
+            self.explain_capture.stop(timeout)
+        if self.baselines is not None:
+            self.baselines.stop(timeout)
+        if self.writer is not None:
+            self.writer.stop(timeout)
+        self.store.close()
+
+    async def lifespan(self, scope, receive, send):
+        """Pass a lifespan connection to the application, closing the profiler once it shut down."""
+        async def shutdown_send(message):
+            if message["type"] in ("lifespan.shutdown.complete", "lifespan.shutdown.failed"):
+                await run_in_threadpool(self.close)
+            await send(message)
+        await self.app(scope, receive, shutdown_send)
+
+    def is_profiled(self, scope):
+        """Return whether a request is profiled.
+
+        The routes of the profiler's dashboard router are never profiled,
+        whatever prefix it is included under, and neither are favicon requests.
+        """
+        path = scope["path"]
+        if path.startswith("/favicon"):
+            return False
+        return not any(pattern.match(path) for pattern in self.dashboard_patterns(scope.get("app")))
 
-            """
-            return {"type": "http.request", "body": body}
-        request._receive = receive
+    def dashboard_patterns(self, app):
+        """Return the path patterns of the dashboard routes included in `app`.
 
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint):
-        """Process the incoming request and generate a response while profiling the database queries.
+        They are looked up in the application's routes once, and again only
+        if routes are added.
+        """
+        routes = getattr(app, "routes", None)
+        if not routes:
+            return ()
+        if self._dashboard_patterns is None or self._dashboard_patterns[0] != (id(routes), len(routes)):
+            endpoints = {route.endpoint for route in dashboard_router.routes}
+            patterns = tuple(route.path_regex for route in routes if getattr(route, "endpoint", None) in endpoints)
+            self._dashboard_patterns = ((id(routes), len(routes)), patterns)
+        return self._dashboard_patterns[1]
+
+    def body_capture(self, receive, buffer):
+        """Wrap an ASGI `receive` callable to copy body chunks into `buffer`.
+
+        At most `max_body_size` bytes are copied; the application still
+        receives every chunk unchanged.
 
         Args:
         ----
-        request (Request): The incoming Starlette Request object.
-        call_next (RequestResponseEndpoint): The endpoint to call to get the response.
+        receive: The ASGI receive callable.
+        buffer (bytearray): The capture buffer.
 
         Returns:
         -------
-        Response: The generated response.
+        The wrapped receive callable.
 
         """
-        # print("Before Request")
-        await self.set_body(request, await request.body())
-        content_type = request.headers.get("Content-Type", "")
-        if "multipart/form-data" in content_type:
-            raw_body = await request.form()
-            body = str(dict(raw_body))
-            raw_body = str(raw_body)
-        elif "application/json" in content_type:
-            raw_body = await request.body()
-            body = raw_body.decode()
-        else:
-            raw_body = ''
-            body = ''
-        request_path = request.url.path
-        if request_path == '/all_request' or request_path.startswith(('/request_detail', '/request_query','/favicon','/clear_db')):
-            response = await call_next(request)
-        else:
-            requset_data = self.add_request(request, raw_body, body)
-            request_id = requset_data.id
-            session_handler = SessionHandler(self.engine)
-            session_handler.start()
-            response = await call_next(request)
+        limit = self.max_body_size
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "http.request" and len(buffer) < limit:
+                buffer.extend(message.get("body", b"")[:limit - len(buffer)])
+            return message
+        return capture_receive
+
+    async def read_body(self, scope, content_type, buffer):
+        """Turn a captured body into the `raw_body` and `body` stored for the request.
+
+        Args:
+        ----
+        scope: The ASGI connection scope.
+        content_type (str): The request Content-Type header.
+        buffer (bytearray): The captured body bytes.
+
+        Returns:
+        -------
+        tuple: The raw body and processed body as strings.
+
+        """
+        raw_body = bytes(buffer).decode(errors="replace")
+        if "multipart/form-data" not in content_type:
+            return raw_body, raw_body
+        if not self.parse_multipart or len(buffer) >= self.max_body_size:
+            return raw_body, ''
+
+        async def replay():
+            return {"type": "http.request", "body": bytes(buffer), "more_body": False}
+        try:
+            form = await Request(scope, replay).form()
+        except Exception:
+            return raw_body, ''
+        try:
+            return str(form), str(dict(form))
+        finally:
+            await form.close()
+
+    async def __call__(self, scope, receive, send):
+        """Profile the database queries of an HTTP request.
+
+        Args:
+        ----
+        scope: The ASGI connection scope.
+        receive: The ASGI receive callable.
+        send: The ASGI send callable.
+
+        """
+        if scope["type"] == "lifespan":
+            await self.lifespan(scope, receive, send)
+            return
+        if scope["type"] != "http" or not self.is_profiled(scope):
+            await self.app(scope, receive, send)
+            return
+        sampled = self.sampler.head(scope["method"], scope["path"])
+        if not sampled and not self.sampler.tail_enabled:
+            if self.metrics is None and self.baselines is None:
+                await self.app(scope, receive, send)
+            else:
+                await self.count_request(scope, receive, send)
+            return
+        root_path = scope.get("root_path", "")
+        request = Request(scope)
+        record = self.add_request(request)
+        content_type = request.headers.get("content-type", "")
+        buffer = None
+        if self.capture_body and ("application/json" in content_type or "multipart/form-data" in content_type):
+            buffer = bytearray()
+            receive = self.body_capture(receive, buffer)
+        session_handler = SessionHandler(self.engine, self.stack_capture, self.param_capture, self.statement_cache,
+                                         self.explain_capture)
+        session_handler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
             session_handler.stop()
-            # print("After Request")
-            self.store(session_handler, request_id)
-        return response
+            if buffer is not None:
+                record["raw_body"], record["body"] = await self.read_body(scope, content_type, buffer)
+            record["route"] = route_template(scope, root_path)
+            self.finish_request(record, session_handler, sampled)
@@ -1,22 +1,34 @@
-from sqlalchemy import JSON, Column, DateTime, Float, ForeignKey, Integer, String, Text
+from sqlalchemy import JSON, BigInteger, Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, String, Text
 
-from .database import Base, engine
+from .database import Base
 
 
 class RequestInfo(Base):
     __tablename__ = 'middleware_requests'
 
     id = Column(Integer, primary_key=True, index=True)
-    path = Column(String(200))
+    path = Column(String(200), index=True)
     query_params = Column(Text, default='')
     raw_body = Column(Text, default='')
     body = Column(Text, default='')
-    method = Column(String(10))
-    start_time = Column(DateTime, nullable=True)
+    method = Column(String(10), index=True)
+    start_time = Column(DateTime, nullable=True, index=True)
     end_time = Column(DateTime, nullable=True)
-    time_taken = Column(Float, nullable=True)
-    total_queries = Column(Integer)
+    # The dashboard sort columns are never NULL, so each sort and its keyset
+    # cursor are served by the (column, id) index below.
+    time_taken = Column(Float, nullable=False, default=0, server_default="0")
+    total_queries = Column(Integer, nullable=False, default=0, server_default="0")
     headers = Column(JSON)
+    n_plus_one = Column(Integer, nullable=False, default=0, server_default="0")
+    repeated_queries = Column(Integer, nullable=False, default=0, server_default="0")
+    duplicate_queries = Column(Integer, nullable=False, default=0, server_default="0")
+    wasted_time = Column(Float, nullable=False, default=0, server_default="0")
+    regression = Column(String(50), nullable=True, index=True)
+
+    __table_args__ = tuple(
+        Index("ix_middleware_requests_%s_id" % name, name, "id")
+        for name in ("time_taken", "total_queries", "repeated_queries", "duplicate_queries", "wasted_time")
+    )
 
 
 class QueryInfo(Base):
@@ -24,10 +36,83 @@ class QueryInfo(Base):
     id = Column(Integer, primary_key=True, index=True)
     query = Column(Text, nullable=True)
     time_taken = Column(Float, nullable=True)
+    compile_time = Column(Float, nullable=True)
+    rowcount = Column(Integer, nullable=True)
+    batch_size = Column(Integer, default=1)
+    params = Column(Text, nullable=True)
     traceback = Column(Text, nullable=True)
+    stack_key = Column(String(40), nullable=True, index=True)
+    fingerprint = Column(String(40), nullable=True, index=True)
 
     request_id = Column(Integer, ForeignKey(
         'middleware_requests.id'), nullable=False, index=True)
 
 
-Base.metadata.create_all(bind=engine)
+class StackInfo(Base):
+    __tablename__ = 'middleware_stack'
+    key = Column(String(40), primary_key=True)
+    frames = Column(JSON)
+
+
+class StatementInfo(Base):
+    __tablename__ = 'middleware_statement'
+    fingerprint = Column(String(40), primary_key=True)
+    statement = Column(Text)
+    count = Column(Integer, default=0)
+    total_time = Column(Float, default=0)
+    min_time = Column(Float, nullable=True)
+    max_time = Column(Float, nullable=True)
+    histogram = Column(JSON)
+    last_seen = Column(DateTime, nullable=True)
+
+
+class CallSiteInfo(Base):
+    __tablename__ = 'middleware_call_site'
+    key = Column(String(40), primary_key=True)
+    filename = Column(Text)
+    lineno = Column(Integer)
+    function = Column(String(200))
+    count = Column(Integer, default=0)
+    total_time = Column(Float, default=0, index=True)
+    statements = Column(JSON)
+    last_seen = Column(DateTime, nullable=True)
+
+
+class CallPathInfo(Base):
+    __tablename__ = 'middleware_call_path'
+    stack_key = Column(String(40), primary_key=True)
+    count = Column(Integer, default=0)
+    total_time = Column(Float, default=0, index=True)
+    last_seen = Column(DateTime, nullable=True)
+
+
+class PlanInfo(Base):
+    __tablename__ = 'middleware_plan'
+    fingerprint = Column(String(40), primary_key=True)
+    plan = Column(Text)
+    explained_at = Column(DateTime, nullable=True)
+
+
+class BaselineSetInfo(Base):
+    __tablename__ = 'middleware_baseline_set'
+    name = Column(String(100), primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+    reference = Column(Boolean, nullable=False, default=False)
+
+
+class BaselineInfo(Base):
+    __tablename__ = 'middleware_baseline'
+    name = Column(String(100), primary_key=True)
+    route = Column(String(200), primary_key=True)
+    method = Column(String(10), primary_key=True)
+    count = Column(Integer, default=0)
+    latency = Column(JSON)
+    db_time = Column(JSON)
+    queries = Column(JSON)
+    created_at = Column(DateTime, nullable=True)
+
+
+class SpoolOffsetInfo(Base):
+    __tablename__ = 'middleware_spool_offset'
+    spool_file = Column(String(255), primary_key=True)
+    offset = Column(BigInteger, nullable=False, default=0)
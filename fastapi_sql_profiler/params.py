@@ -0,0 +1,62 @@
+DEFAULT_REDACT = ("password", "passwd", "secret", "token", "api_key", "apikey", "authorization", "credential")
+REDACTED = "<redacted>"
+
+
+class ParamCapture(object):
+    """Format the bound parameters of a query for display.
+
+    Parameters are read by name from the execution context when the
+    statement was compiled, so positional drivers are redacted too. Values of
+    parameters whose name contains one of the `redact` words are replaced,
+    only the first `max_rows` parameter sets of an executemany batch are
+    kept, and the result is cut to `max_size` characters.
+
+    Args:
+    ----
+        redact (tuple): Lower case words marking a parameter name as sensitive.
+        max_size (int): Maximum number of characters kept per query.
+        max_rows (int): Maximum number of executemany parameter sets kept.
+
+    """
+
+    def __init__(self, redact=DEFAULT_REDACT, max_size=1024, max_rows=10):
+        """Initialize a ParamCapture object."""
+        self.redact = tuple(word.lower() for word in redact)
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self._names = {}
+
+    def is_redacted(self, name):
+        """Return whether the value of parameter `name` is hidden."""
+        redacted = self._names.get(name)
+        if redacted is None:
+            lowered = str(name).lower()
+            redacted = self._names[name] = any(word in lowered for word in self.redact)
+        return redacted
+
+    def redact_row(self, row):
+        """Return a parameter set with its sensitive values replaced."""
+        if isinstance(row, dict):
+            return {name: REDACTED if self.is_redacted(name) else value for name, value in row.items()}
+        return row
+
+    def format(self, parameters, context, executemany):
+        """Return the displayed parameters of a cursor execution.
+
+        Args:
+        ----
+        parameters: The parameters passed to the DBAPI cursor.
+        context: The SQLAlchemy execution context.
+        executemany (bool): Whether `parameters` holds one set per row.
+
+        """
+        rows = getattr(context, "compiled_parameters", None) if getattr(context, "compiled", None) else None
+        if not rows:
+            rows = parameters if executemany else [parameters]
+        shown = [self.redact_row(row) for row in rows[:self.max_rows]]
+        text = repr(shown if executemany else shown[0])
+        if len(rows) > self.max_rows:
+            text += " ... %d more" % (len(rows) - self.max_rows)
+        if len(text) > self.max_size:
+            text = text[:self.max_size] + "..."
+        return text
@@ -0,0 +1,133 @@
+import datetime
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy(object):
+    """Limits on how much profiling data a store keeps.
+
+    A request is expired when it breaks any of the limits. The oldest
+    requests are always expired first.
+
+    Args:
+    ----
+        max_age (float or datetime.timedelta, optional): Maximum age of a request, in seconds.
+        max_requests (int, optional): Maximum number of requests kept.
+        max_queries_per_path (int, optional): Maximum number of query rows kept per request path.
+
+    """
+
+    def __init__(self, max_age=None, max_requests=None, max_queries_per_path=None):
+        """Initialize a RetentionPolicy object."""
+        if max_age is not None and not isinstance(max_age, datetime.timedelta):
+            max_age = datetime.timedelta(seconds=max_age)
+        self.max_age = max_age
+        self.max_requests = max_requests
+        self.max_queries_per_path = max_queries_per_path
+
+    def cutoff(self):
+        """Return the start time before which requests are expired, or None."""
+        if self.max_age is None:
+            return None
+        return datetime.datetime.utcnow() - self.max_age
+
+
+class Pruner(object):
+    """Background thread deleting the requests expired by a retention policy.
+
+    Every `interval` seconds the pruner asks the store to delete expired
+    requests, at most `batch_size` at a time, each batch in its own short
+    transaction, pausing `pause` seconds between batches so the profiler
+    tables are never locked for long. The limits are read once per run,
+    and the stacks and aggregates left unused are deleted after the requests
+    in the same way.
+
+    Args:
+    ----
+        store (BaseStore): The store to prune.
+        policy (RetentionPolicy): The limits to enforce.
+        batch_size (int): Maximum number of requests deleted per batch.
+        pause (float): Seconds to wait between two batches.
+        interval (float): Seconds to wait between two pruning runs.
+
+    Attributes:
+    ----------
+        deleted (int): Number of requests deleted.
+        runs (int): Number of pruning runs.
+        errors (int): Number of runs interrupted by an error.
+
+    """
+
+    def __init__(self, store, policy, batch_size=500, pause=0.1, interval=60.0):
+        """Initialize a Pruner object."""
+        self.store = store
+        self.policy = policy
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.deleted = 0
+        self.runs = 0
+        self.errors = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    @property
+    def started(self):
+        """Return whether the pruning thread has been started."""
+        return self._thread is not None
+
+    def start(self):
+        """Start the pruning thread if it is not already running."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="sql-profiler-pruner", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the pruning thread, letting the current batch finish."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopped.set()
+        thread.join(timeout)
+        self._thread = None
+
+    def prune(self):
+        """Delete expired requests batch by batch until none is left.
+
+        Returns
+        -------
+        int: The number of requests deleted.
+
+        """
+        total = 0
+        try:
+            cutoffs = self.store.prune_cutoffs(self.policy)
+            while True:
+                deleted = self.store.prune(self.policy, self.batch_size, cutoffs)
+                total += deleted
+                self.deleted += deleted
+                if not deleted or self._stopped.wait(self.pause):
+                    break
+            while self.store.prune_unused(self.policy, self.batch_size) and not self._stopped.wait(self.pause):
+                pass
+        except Exception:
+            self.errors += 1
+            logger.exception("Failed to prune profiling records")
+        self.runs += 1
+        return total
+
+    def stats(self):
+        """Return the pruner counters as a dictionary."""
+        return {"deleted": self.deleted, "runs": self.runs, "errors": self.errors}
+
+    def _run(self):
+        """Prune every `interval` seconds until stopped."""
+        while not self._stopped.is_set():
+            self.prune()
+            self._stopped.wait(self.interval)
@@ -0,0 +1,72 @@
+import random
+
+
+class Sampler(object):
+    """Decide which requests are profiled and persisted.
+
+    A request is first head-sampled with a probability taken from the most
+    specific matching rate: the longest matching `path_rates` prefix, then
+    `method_rates`, then `rate`. Head-sampled requests are always persisted.
+
+    When any tail rule is set, requests that were not head-sampled are still
+    captured in memory, and persisted only if they turn out to be slow: the
+    request took at least `slow_request_ms`, issued at least `min_queries`
+    queries, or any single query took at least `slow_query_ms`. Without tail
+    rules, requests that are not head-sampled are not captured at all: the
+    middleware only counts their queries for its metrics and baselines.
+
+    Args:
+    ----
+        rate (float): Default probability of profiling a request, from 0 to 1.
+        path_rates (dict, optional): Probabilities keyed by path prefix.
+        method_rates (dict, optional): Probabilities keyed by HTTP method.
+        slow_request_ms (float, optional): Keep requests taking at least this many milliseconds.
+        min_queries (int, optional): Keep requests issuing at least this many queries.
+        slow_query_ms (float, optional): Keep requests with a query taking at least this many milliseconds.
+
+    """
+
+    def __init__(self, rate=1.0, path_rates=None, method_rates=None,
+                 slow_request_ms=None, min_queries=None, slow_query_ms=None):
+        """Initialize a Sampler object."""
+        self.rate = rate
+        self.path_rates = sorted((path_rates or {}).items(), key=lambda item: len(item[0]), reverse=True)
+        self.method_rates = {method.upper(): value for method, value in (method_rates or {}).items()}
+        self.slow_request_ms = slow_request_ms
+        self.min_queries = min_queries
+        self.slow_query_ms = slow_query_ms
+        self.tail_enabled = any(rule is not None for rule in (slow_request_ms, min_queries, slow_query_ms))
+        self._random = random.random
+
+    def rate_for(self, method, path):
+        """Return the head sampling probability of a request."""
+        for prefix, value in self.path_rates:
+            if path.startswith(prefix):
+                return value
+        return self.method_rates.get(method, self.rate)
+
+    def head(self, method, path):
+        """Return whether a request is head-sampled."""
+        rate = self.rate_for(method, path)
+        if rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        return self._random() < rate
+
+    def keep(self, record):
+        """Return whether a captured request matches a tail rule.
+
+        Args:
+        ----
+        record (dict): A finished request record, with its `time_taken` and `queries`.
+
+        """
+        if self.slow_request_ms is not None and record["time_taken"] >= self.slow_request_ms:
+            return True
+        queries = record["queries"]
+        if self.min_queries is not None and len(queries) >= self.min_queries:
+            return True
+        if self.slow_query_ms is not None:
+            return any(query_obj["time_taken"] >= self.slow_query_ms for query_obj in queries)
+        return False
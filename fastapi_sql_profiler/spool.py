@@ -0,0 +1,369 @@
+"""Per-process spool files for profiling multi-worker deployments.
+
+Each worker process appends its captured requests to its own spool file,
+so capture never contends on the profiler database. A single
+:class:`SpoolCollector`, either a thread in whichever worker holds the
+collector lock or the command line, tails every spool file and bulk-loads
+the records into the profiler tables:
+
+    python -m fastapi_sql_profiler.spool /var/spool/sql-profiler
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+from .storage import SQLStore
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_SUFFIX = ".active"
+SEALED_SUFFIX = ".spool"
+LOCK_NAME = "collector.lock"
+DATETIME_FIELDS = ("start_time", "end_time")
+
+
+def encode_record(record):
+    """Encode a captured request record as one line of JSON."""
+    record = dict(record, **{field: record[field].isoformat() for field in DATETIME_FIELDS if record.get(field)})
+    return json.dumps(record, separators=(",", ":"), default=str).encode() + b"\n"
+
+
+def decode_record(line):
+    """Decode a line written by :func:`encode_record`."""
+    record = json.loads(line)
+    for field in DATETIME_FIELDS:
+        if record.get(field):
+            record[field] = datetime.datetime.fromisoformat(record[field])
+    for query_obj in record["queries"]:
+        query_obj["stack"] = tuple(tuple(frame) for frame in query_obj["stack"] or ())
+    return record
+
+
+def pid_alive(pid):
+    """Return whether a process of this host is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def acquire_lock(directory):
+    """Take the collector lock of a spool directory without blocking.
+
+    Returns
+    -------
+    file: The open lock file, to keep open while collecting, or None if another
+        process holds the lock or locks are not supported.
+
+    """
+    if fcntl is None:
+        return None
+    lock_file = open(os.path.join(directory, LOCK_NAME), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+class SpoolStore(SQLStore):
+    """Append captured requests to a per-process spool file.
+
+    Records are written as JSON lines to `<pid>-<id>.active` in `directory`
+    through a buffered file, flushed and, when `fsync` is set, synced to disk
+    once per batch handed over by the writer thread. A file reaching
+    `max_file_size` bytes is sealed by renaming it to `.spool` and a new one
+    is started. Nothing is written to the profiler database while serving
+    requests, so the cost of profiling does not grow with the number of
+    workers.
+
+    The dashboard reads the profiler tables, like :class:`SQLStore`, once a
+    :class:`SpoolCollector` has loaded the records. With `collect` set, the
+    first worker to save a batch takes the collector lock of the directory
+    and runs the collector in a thread; otherwise run it from the command line.
+    The other workers try to take the lock again every `collect_interval`
+    seconds while saving, so one of them takes over when the collecting
+    worker exits.
+
+    Args:
+    ----
+        directory (str): The local spool directory, shared by the workers of one host.
+        fsync (bool): Whether every batch is synced to disk.
+        max_file_size (int): Size in bytes at which a spool file is sealed.
+        collect (bool): Whether one of the workers runs the collector.
+        collect_interval (float): Seconds between two collector passes.
+
+    Attributes:
+    ----------
+        collector (SpoolCollector): The collector run by this process, or None.
+
+    """
+
+    def __init__(self, directory, fsync=True, max_file_size=64 * 1024 * 1024, collect=True, collect_interval=1.0):
+        """Initialize a SpoolStore object."""
+        super().__init__()
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        self.max_file_size = max_file_size
+        self.collect = collect
+        self.collect_interval = collect_interval
+        self.collector = None
+        self._file = None
+        self._path = None
+        self._pid = None
+        self._next_collect = 0.0
+        self._lock = threading.Lock()
+
+    def save(self, records):
+        """Append a batch of records to this process's spool file."""
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked worker writes its own file; the parent's buffer is always flushed.
+                self._file = None
+                self._pid = os.getpid()
+                self._next_collect = 0.0
+            if self.collect and time.monotonic() >= self._next_collect:
+                self._next_collect = time.monotonic() + self.collect_interval
+                self.start_collector()
+            if self._file is None:
+                self._path = os.path.join(self.directory, "%d-%d%s" % (self._pid, time.time_ns(), ACTIVE_SUFFIX))
+                self._file = open(self._path, "ab", buffering=1024 * 1024)
+            for record in records:
+                self._file.write(encode_record(record))
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            if self._file.tell() >= self.max_file_size:
+                self._seal()
+
+    def _seal(self):
+        """Close the spool file and mark it complete; the caller holds the lock."""
+        self._file.close()
+        os.replace(self._path, self._path[:-len(ACTIVE_SUFFIX)] + SEALED_SUFFIX)
+        self._file = None
+        self._path = None
+
+    def start_collector(self):
+        """Run the collector in this process if no other process does.
+
+        Returns
+        -------
+        bool: Whether this process runs the collector.
+
+        """
+        if self.collector is not None and self.collector.owner == os.getpid():
+            return True
+        lock_file = acquire_lock(self.directory)
+        if lock_file is None:
+            return False
+        self.collector = SpoolCollector(self.directory, self, interval=self.collect_interval,
+                                        lock_file=lock_file)
+        self.collector.start()
+        return True
+
+    def close(self):
+        """Seal this process's spool file, then stop its collector after a last pass and release the lock."""
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._seal()
+            collector, self.collector = self.collector, None
+        if collector is not None and collector.owner == os.getpid():
+            collector.stop()
+            collector.collect()
+            collector.lock_file.close()
+
+
+class SpoolCollector(object):
+    """Bulk-load the records of every spool file of a directory.
+
+    Each pass reads the complete lines appended since the previous pass,
+    `batch_size` records at a time, and stores them with
+    :meth:`SQLStore.save_spooled`. The offset reached in each file is stored
+    in the transaction of its batch, so a collector restarted after a crash
+    resumes after the last batch stored, neither loading it twice nor
+    skipping any.
+    Sealed files are deleted once fully loaded, and so are active files whose
+    process has exited, dropping any line it left incomplete.
+
+    Args:
+    ----
+        directory (str): The spool directory.
+        store (SQLStore): The store the records and offsets are saved to.
+        batch_size (int): Maximum number of records loaded at once.
+        interval (float): Seconds to wait between two passes.
+        lock_file (file, optional): The collector lock, held for the life of the process.
+
+    Attributes:
+    ----------
+        loaded (int): Number of records loaded.
+        files (int): Number of spool files deleted once loaded.
+        runs (int): Number of passes.
+        errors (int): Number of unreadable lines and failed passes.
+
+    """
+
+    def __init__(self, directory, store, batch_size=500, interval=1.0, lock_file=None):
+        """Initialize a SpoolCollector object."""
+        self.directory = directory
+        self.store = store
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock_file = lock_file
+        self.owner = os.getpid()
+        self.loaded = 0
+        self.files = 0
+        self.runs = 0
+        self.errors = 0
+        self._offsets = {}
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start the collector thread if it is not already running."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="sql-profiler-collector", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the collector thread, letting the current pass finish."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopped.set()
+        thread.join(timeout)
+        self._thread = None
+
+    def collect(self):
+        """Load every record appended to the spool files since the previous pass.
+
+        Returns
+        -------
+        int: The number of records loaded.
+
+        """
+        total = 0
+        try:
+            for name in sorted(os.listdir(self.directory)):
+                stem, suffix = os.path.splitext(name)
+                if suffix in (ACTIVE_SUFFIX, SEALED_SUFFIX):
+                    total += self.collect_file(stem, suffix)
+        except Exception:
+            self.errors += 1
+            logger.exception("Failed to collect spooled profiling records")
+        self.runs += 1
+        return total
+
+    def collect_file(self, stem, suffix):
+        """Load the complete lines of one spool file past its saved offset."""
+        path = os.path.join(self.directory, stem + suffix)
+        offset = self.read_offset(stem)
+        total = 0
+        try:
+            spool_file = open(path, "rb")
+        except FileNotFoundError:
+            # Sealed since it was listed; the next pass reads it under its new name.
+            return 0
+        with spool_file:
+            spool_file.seek(offset)
+            complete = True
+            while complete:
+                batch = []
+                while len(batch) < self.batch_size:
+                    line = spool_file.readline()
+                    if not line.endswith(b"\n"):
+                        complete = False
+                        break
+                    offset += len(line)
+                    try:
+                        batch.append(decode_record(line))
+                    except ValueError:
+                        self.errors += 1
+                        logger.warning("Skipping unreadable spool line in %s", path)
+                if offset != self._offsets[stem]:
+                    self.store.save_spooled(batch, self.spool_file(stem), offset)
+                    self._offsets[stem] = offset
+                    self.loaded += len(batch)
+                    total += len(batch)
+            finished = not line
+        owner_exited = suffix == ACTIVE_SUFFIX and not pid_alive(int(stem.split("-")[0]))
+        if owner_exited and not finished:
+            self.errors += 1
+            logger.warning("Dropping the incomplete last line of %s", path)
+        if suffix == SEALED_SUFFIX and finished or owner_exited:
+            os.remove(path)
+            self.remove_offset(stem)
+            self.files += 1
+        return total
+
+    def spool_file(self, stem):
+        """Return the name a spool file's offset is stored under, unique across hosts and directories."""
+        return "%s:%s" % (socket.gethostname(), os.path.join(os.path.abspath(self.directory), stem))
+
+    def read_offset(self, stem):
+        """Return the offset loaded so far in a spool file."""
+        offset = self._offsets.get(stem)
+        if offset is None:
+            offset = self._offsets[stem] = self.store.spool_offset(self.spool_file(stem))
+        return offset
+
+    def remove_offset(self, stem):
+        """Forget the offset of a deleted spool file."""
+        self._offsets.pop(stem, None)
+        self.store.forget_spool_offset(self.spool_file(stem))
+
+    def stats(self):
+        """Return the collector counters as a dictionary."""
+        return {"loaded": self.loaded, "files": self.files, "runs": self.runs, "errors": self.errors}
+
+    def _run(self):
+        """Collect every `interval` seconds until stopped."""
+        while not self._stopped.is_set():
+            self.collect()
+            self._stopped.wait(self.interval)
+
+
+def main():
+    """Collect the spool files of a directory into the profiler database."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="the spool directory of the workers")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between two passes")
+    parser.add_argument("--batch-size", type=int, default=500, help="records loaded per transaction")
+    parser.add_argument("--once", action="store_true", help="load the pending records and exit")
+    args = parser.parse_args()
+
+    os.makedirs(args.directory, exist_ok=True)
+    lock_file = acquire_lock(args.directory)
+    if lock_file is None and fcntl is not None:
+        parser.exit(1, "Another collector is running for %s\n" % args.directory)
+    collector = SpoolCollector(args.directory, SQLStore(), args.batch_size, args.interval, lock_file)
+    if args.once:
+        collector.collect()
+    else:
+        try:
+            collector._run()
+        except KeyboardInterrupt:
+            pass
+    print("Loaded %d records from %d spool files" % (collector.loaded, collector.files))
+
+
+if __name__ == "__main__":
+    main()
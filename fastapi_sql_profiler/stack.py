@@ -0,0 +1,112 @@
+import hashlib
+import os
+import sys
+import sysconfig
+import traceback
+
+try:
+    import greenlet
+except ImportError:  # pragma: no cover - greenlet is only needed for AsyncEngine
+    greenlet = None
+
+PACKAGE_PATH = os.path.dirname(os.path.abspath(__file__))
+MAX_STACK_KEYS = 10000
+_stack_keys = {}
+
+
+def default_exclude():
+    """Return the path prefixes of frames that are not application code.
+
+    These are the standard library, installed packages and the profiler itself.
+    """
+    paths = {PACKAGE_PATH}
+    for name in ("stdlib", "platstdlib", "purelib", "platlib"):
+        path = sysconfig.get_paths().get(name)
+        if path:
+            paths.add(path)
+    return tuple(sorted(paths))
+
+
+class StackCapture(object):
+    """Capture the application frames of the current call stack.
+
+    Frames are read with `sys._getframe` and kept as compact
+    `(filename, lineno, function)` tuples; they are only formatted when a
+    query is displayed. Queries of an `AsyncEngine` run in a greenlet whose
+    stack stops at SQLAlchemy, so the walk continues into the parent
+    greenlet, where the awaiting coroutines are.
+
+    Args:
+    ----
+        include (tuple, optional): Path prefixes of application frames. When set,
+            only frames under one of these prefixes are kept.
+        exclude (tuple, optional): Path prefixes of frames to drop. Defaults to the
+            profiler itself, plus the standard library and installed packages
+            unless `include` is set.
+        max_depth (int): Maximum number of frames kept, innermost first.
+
+    """
+
+    def __init__(self, include=None, exclude=None, max_depth=20):
+        """Initialize a StackCapture object."""
+        self.include = tuple(include) if include else None
+        if exclude is None:
+            exclude = (PACKAGE_PATH,) if include else default_exclude()
+        self.exclude = tuple(exclude)
+        self.max_depth = max_depth
+        self._paths = {}
+
+    def is_application(self, filename):
+        """Return whether frames of `filename` are kept."""
+        kept = self._paths.get(filename)
+        if kept is None:
+            kept = not filename.startswith("<") and not filename.startswith(self.exclude)
+            if kept and self.include is not None:
+                kept = filename.startswith(self.include)
+            self._paths[filename] = kept
+        return kept
+
+    def capture(self, skip=1):
+        """Return the application frames of the caller's stack, outermost first.
+
+        Args:
+        ----
+        skip (int): Number of innermost frames to ignore.
+
+        """
+        frames = []
+        frame = sys._getframe(skip)
+        parent = greenlet.getcurrent().parent if greenlet is not None else None
+        while len(frames) < self.max_depth:
+            if frame is None:
+                if parent is None:
+                    break
+                frame, parent = parent.gr_frame, parent.parent
+                continue
+            code = frame.f_code
+            if self.is_application(code.co_filename):
+                frames.append((code.co_filename, frame.f_lineno, code.co_name))
+            frame = frame.f_back
+        frames.reverse()
+        return tuple(frames)
+
+
+def stack_key(frames):
+    """Return the storage key of a captured stack.
+
+    Identical stacks share one key, so a call site is stored once however
+    many queries it issues.
+    """
+    key = _stack_keys.get(frames)
+    if key is None:
+        if len(_stack_keys) >= MAX_STACK_KEYS:
+            _stack_keys.clear()
+        key = hashlib.sha1(repr(frames).encode()).hexdigest()
+        _stack_keys[frames] = key
+    return key
+
+
+def format_stack(frames):
+    """Format captured frames like `traceback.format_list`, one string per frame."""
+    summary = traceback.StackSummary.from_list([(filename, lineno, name, None) for filename, lineno, name in frames])
+    return summary.format()
@@ -0,0 +1,134 @@
+import math
+
+
+class Histogram(object):
+    """Mergeable log-scale latency histogram.
+
+    Values in milliseconds are counted in buckets whose bounds grow by
+    `GROWTH`, so percentiles are accurate to within about 5% whatever the
+    range. Only non-empty buckets are stored, and two histograms are merged
+    by adding their bucket counts.
+
+    Args:
+    ----
+        buckets (dict, optional): Bucket counts keyed by bucket index, as returned by :meth:`to_dict`.
+
+    """
+
+    GROWTH = 1.1
+    MIN_VALUE = 0.001
+
+    def __init__(self, buckets=None):
+        """Initialize a Histogram object."""
+        self.buckets = {int(index): count for index, count in (buckets or {}).items()}
+
+    @classmethod
+    def bucket(cls, value):
+        """Return the index of the bucket counting `value`."""
+        if value <= cls.MIN_VALUE:
+            return 0
+        return int(math.log(value / cls.MIN_VALUE, cls.GROWTH)) + 1
+
+    def add(self, value, count=1):
+        """Count a value."""
+        index = self.bucket(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other):
+        """Add the counts of another histogram to this one."""
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    @property
+    def count(self):
+        """Return the number of values counted."""
+        return sum(self.buckets.values())
+
+    def percentile(self, percent):
+        """Return an estimate of the given percentile, or None if empty."""
+        total = self.count
+        if not total:
+            return None
+        rank = percent / 100 * total
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        if index == 0:
+            return self.MIN_VALUE
+        return round(self.MIN_VALUE * self.GROWTH ** (index - 0.5), 3)
+
+    def to_dict(self):
+        """Return the bucket counts in a JSON serializable form."""
+        return {str(index): count for index, count in self.buckets.items()}
+
+
+class StatementStats(object):
+    """Running aggregates of one statement fingerprint.
+
+    Args:
+    ----
+        fingerprint (str): The statement fingerprint.
+        statement (str): The normalized statement.
+
+    """
+
+    __slots__ = ("fingerprint", "statement", "count", "total_time", "min_time", "max_time", "histogram")
+
+    def __init__(self, fingerprint, statement):
+        """Initialize a StatementStats object."""
+        self.fingerprint = fingerprint
+        self.statement = statement
+        self.count = 0
+        self.total_time = 0.0
+        self.min_time = None
+        self.max_time = None
+        self.histogram = Histogram()
+
+    @property
+    def average(self):
+        """Return the average time of an execution in milliseconds."""
+        return round(self.total_time / self.count, 3) if self.count else 0
+
+    def merge(self, other):
+        """Add the aggregates of another StatementStats to this one."""
+        self.count += other.count
+        self.total_time += other.total_time
+        if other.min_time is not None:
+            self.min_time = other.min_time if self.min_time is None else min(self.min_time, other.min_time)
+        if other.max_time is not None:
+            self.max_time = other.max_time if self.max_time is None else max(self.max_time, other.max_time)
+        self.histogram.merge(other.histogram)
+        return self
+
+    def add(self, time_taken):
+        """Count one execution taking `time_taken` milliseconds."""
+        self.count += 1
+        self.total_time += time_taken
+        self.min_time = time_taken if self.min_time is None else min(self.min_time, time_taken)
+        self.max_time = time_taken if self.max_time is None else max(self.max_time, time_taken)
+        self.histogram.add(time_taken)
+
+
+def aggregate_statements(query_rows):
+    """Aggregate query rows by fingerprint.
+
+    Args:
+    ----
+    query_rows (list): Dictionaries with `fingerprint`, `statement` and `time_taken` keys.
+
+    Returns:
+    -------
+    dict: StatementStats keyed by fingerprint.
+
+    """
+    stats = {}
+    for query_row in query_rows:
+        statement_stats = stats.get(query_row["fingerprint"])
+        if statement_stats is None:
+            statement_stats = stats[query_row["fingerprint"]] = StatementStats(query_row["fingerprint"],
+                                                                                query_row["statement"])
+        statement_stats.add(query_row["time_taken"])
+    return stats
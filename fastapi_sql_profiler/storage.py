@@ -0,0 +1,1156 @@
+import collections
+import datetime
+import itertools
+import threading
+import time
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from .baselines import RouteStats
+from .database import get_session
+from .hotspots import CallPathStats, CallSiteStats, aggregate_call_sites
+from .models import (BaselineInfo, BaselineSetInfo, CallPathInfo, CallSiteInfo, PlanInfo, QueryInfo, RequestInfo,
+                     SpoolOffsetInfo, StackInfo, StatementInfo)
+from .stack import MAX_STACK_KEYS, stack_key
+from .stats import Histogram, StatementStats, aggregate_statements
+
+REQUEST_SORTS = {
+    "recent": "id",
+    "slowest": "time_taken",
+    "queries": "total_queries",
+    "repeated": "repeated_queries",
+    "duplicates": "duplicate_queries",
+    "wasted": "wasted_time",
+}
+COUNT_CACHE_SECONDS = 30
+# Stacks known to be stored are checked again after this long, as the pruner may have deleted them.
+STACK_CACHE_SECONDS = 60
+EXPORT_FIELDS = ("request_id", "path", "method", "start_time", "request_time_taken", "total_queries", "query_id",
+                 "query", "time_taken", "compile_time", "rowcount", "batch_size", "params", "fingerprint")
+
+
+def page_cursor(row, sort_attribute):
+    """Return the `value:id` keyset cursor of a request row."""
+    return "%s:%s" % (getattr(row, sort_attribute) or 0, row.id)
+
+
+def parse_cursor(cursor):
+    """Split a :func:`page_cursor` into its sort value and id."""
+    value, _, cursor_id = cursor.rpartition(":")
+    return float(value), int(cursor_id)
+
+
+def baseline_row(name, key, stats, created_at):
+    """Return the `middleware_baseline` row of the RouteStats of one route of a baseline."""
+    route, method = key
+    return {"name": name, "route": route, "method": method, "count": stats.count,
+            "latency": stats.latency.to_dict(), "db_time": stats.db_time.to_dict(),
+            "queries": stats.queries.to_dict(), "created_at": created_at}
+
+
+def baseline_stats(baseline_info):
+    """Return the RouteStats of a BaselineInfo row."""
+    return RouteStats(baseline_info.count, Histogram(baseline_info.latency), Histogram(baseline_info.db_time),
+                      Histogram(baseline_info.queries))
+
+
+def query_rows(record):
+    """Yield the stored fields of each query of a captured request record."""
+    for query_obj in record["queries"]:
+        yield query_obj, {
+            "query": str(query_obj['text']),
+            "time_taken": query_obj['time_taken'],
+            "compile_time": query_obj['compile_time'],
+            "rowcount": query_obj['rowcount'],
+            "batch_size": query_obj['batch_size'],
+            "params": query_obj['params'],
+            "fingerprint": query_obj['fingerprint'],
+        }
+
+
+class BaseStore(object):
+    """Storage interface of the profiler.
+
+    The middleware hands finished request records to :meth:`save`, and the
+    dashboard reads them back through the other methods. Request and query
+    objects returned by a store expose the attributes of
+    :class:`RequestInfo` and :class:`QueryInfo`.
+
+    Attributes
+    ----------
+        write_behind (bool): Whether :meth:`save` is slow enough to run on the
+            writer thread rather than in the request.
+
+    """
+
+    write_behind = True
+
+    def save(self, records):
+        """Store a batch of records built by the middleware."""
+        raise NotImplementedError
+
+    def list_requests(self, sort="recent", limit=20, before=None, after=None, **filters):
+        """Return one page of requests, newest or largest first.
+
+        Args:
+        ----
+        sort (str): One of `REQUEST_SORTS`.
+        limit (int): Number of requests per page.
+        before (str, optional): Cursor of the row preceding the page.
+        after (str, optional): Cursor of the row following the page.
+        filters: `path` prefix, `method`, `min_time`, `min_queries`, `repeated`, `regressed`,
+            `start` and `end`.
+
+        Returns:
+        -------
+        tuple: The requests of the page, and whether there is a previous and a next page.
+
+        """
+        raise NotImplementedError
+
+    def count_requests(self, **filters):
+        """Return the number of requests matching `filters`."""
+        raise NotImplementedError
+
+    def get_request(self, request_id):
+        """Return a request, or None."""
+        raise NotImplementedError
+
+    def get_queries(self, request_id):
+        """Return the queries of a request in execution order."""
+        raise NotImplementedError
+
+    def query_time(self, request_id):
+        """Return the total time of a request's queries in ms."""
+        raise NotImplementedError
+
+    def get_query(self, query_id):
+        """Return a query, or None."""
+        raise NotImplementedError
+
+    def get_stack(self, query):
+        """Return the captured frames of a query, or None."""
+        raise NotImplementedError
+
+    def top_statements(self, limit=50):
+        """Return StatementStats ranked by total time."""
+        raise NotImplementedError
+
+    def top_call_sites(self, limit=50):
+        """Return CallSiteStats ranked by total time."""
+        raise NotImplementedError
+
+    def top_call_paths(self, limit=500):
+        """Return CallPathStats ranked by total time."""
+        raise NotImplementedError
+
+    def export(self, batch_size=1000, **filters):
+        """Yield the matching requests joined with their queries, oldest first.
+
+        Args:
+        ----
+        batch_size (int): Number of rows fetched from the store at a time.
+        filters: `path` prefix, `method`, `min_time`, `min_queries`, `repeated`, `regressed`,
+            `start` and `end`.
+
+        Returns:
+        -------
+        iterator: One tuple of `EXPORT_FIELDS` values per query, and one per request without queries.
+
+        """
+        raise NotImplementedError
+
+    def save_plan(self, fingerprint, plan):
+        """Store the query plan of a statement shape, replacing any earlier one."""
+        raise NotImplementedError
+
+    def get_plan(self, fingerprint):
+        """Return the PlanInfo of a statement shape, or None."""
+        raise NotImplementedError
+
+    def save_baseline(self, name, routes):
+        """Store a named baseline, replacing any earlier one of that name.
+
+        The other processes add their own stats to it with :meth:`merge_baseline`.
+
+        Args:
+        ----
+        name (str): The name of the baseline, such as a deploy version.
+        routes (dict): RouteStats keyed by `(route, method)`.
+
+        Returns:
+        -------
+        datetime.datetime: The creation time identifying this save of the baseline.
+
+        """
+        raise NotImplementedError
+
+    def merge_baseline(self, name, created_at, routes):
+        """Add RouteStats keyed by `(route, method)` to a saved baseline.
+
+        Returns
+        -------
+        bool: Whether the baseline saved at `created_at` was found; False once
+            it has been deleted or saved again.
+
+        """
+        raise NotImplementedError
+
+    def get_baseline(self, name):
+        """Return the RouteStats of a named baseline keyed by `(route, method)`, empty if unknown."""
+        raise NotImplementedError
+
+    def list_baselines(self):
+        """Return `(name, created_at, routes)` tuples of the saved baselines, newest first."""
+        raise NotImplementedError
+
+    def set_reference_baseline(self, name):
+        """Make a saved baseline the reference of every process, or none when `name` is None.
+
+        Returns
+        -------
+        bool: Whether a baseline of that name was found.
+
+        """
+        raise NotImplementedError
+
+    def get_reference_baseline(self):
+        """Return the name of the reference baseline, or None."""
+        raise NotImplementedError
+
+    def prune_cutoffs(self, policy):
+        """Return the bounds of the requests expired by a policy, computed once per pruning pass.
+
+        The result is handed to each :meth:`prune` batch of the pass, so the
+        limits are not recomputed from the whole table for every batch.
+        """
+        return None
+
+    def prune(self, policy, batch_size=500, cutoffs=None):
+        """Delete one batch of the oldest requests expired by a retention policy.
+
+        Args:
+        ----
+        policy (RetentionPolicy): The limits to enforce.
+        batch_size (int): Maximum number of requests deleted.
+        cutoffs (optional): The bounds returned by :meth:`prune_cutoffs` for this pass.
+            Computed for this batch alone when not given.
+
+        Returns:
+        -------
+        int: The number of requests deleted; 0 once nothing is expired.
+
+        """
+        raise NotImplementedError
+
+    def prune_unused(self, policy, batch_size=500):
+        """Delete one batch of the stacks and aggregates left behind by pruned requests.
+
+        Returns
+        -------
+        int: The number of rows deleted; 0 once nothing is left.
+
+        """
+        return 0
+
+    def clear(self):
+        """Delete every stored record; saved baselines are kept."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the resources of the store at application shutdown."""
+
+
+class SQLStore(BaseStore):
+    """Store profiling records in the profiler database tables.
+
+    Each batch is written in one transaction: the request rows first to
+    obtain their ids, then every query row with a single executemany INSERT.
+    Query stacks are stored once per distinct stack in `middleware_stack`
+    and referenced by key. The per-fingerprint statement aggregates are
+    merged into `middleware_statement`, and the per source line and per call
+    path aggregates into `middleware_call_site` and `middleware_call_path`.
+    """
+
+    def __init__(self):
+        """Initialize a SQLStore object."""
+        self._stored_stacks = set()
+        self._stacks_checked_at = time.monotonic()
+        # Held by a save from its stack lookup to its commit, and by the deletion of unused stacks.
+        self._stacks_lock = threading.Lock()
+        self._count_cache = {}
+
+    def save(self, records):
+        """Store a batch of profiling records into the database."""
+        try:
+            self._save(records)
+        except IntegrityError:
+            # Another process stored one of the batch's stacks, statements or call sites first.
+            self._stored_stacks.clear()
+            self._save(records)
+
+    def save_spooled(self, records, spool_file, offset):
+        """Store a batch of records read from a spool file, with the offset reached in the file.
+
+        The offset is written in the transaction of the batch, so a collector
+        restarted after a crash resumes after the last batch stored, without
+        loading it twice.
+        """
+        try:
+            self._save(records, (spool_file, offset))
+        except IntegrityError:
+            self._stored_stacks.clear()
+            self._save(records, (spool_file, offset))
+
+    def spool_offset(self, spool_file):
+        """Return the offset of a spool file stored by :meth:`save_spooled`, or 0."""
+        with get_session() as db:
+            return db.scalar(select(SpoolOffsetInfo.offset).where(SpoolOffsetInfo.spool_file == spool_file)) or 0
+
+    def forget_spool_offset(self, spool_file):
+        """Delete the offset of a spool file once the file is deleted."""
+        with get_session() as db:
+            db.query(SpoolOffsetInfo).filter(SpoolOffsetInfo.spool_file == spool_file).delete()
+            db.commit()
+
+    def _save(self, records, spool_offset=None):
+        """Write a batch of profiling records, and the `(spool_file, offset)` it was read up to, in one transaction."""
+        request_infos = [
+            RequestInfo(path=record["path"], query_params=record["query_params"],
+                        raw_body=record["raw_body"], body=record["body"],
+                        method=record["method"], start_time=record["start_time"],
+                        end_time=record["end_time"], time_taken=record["time_taken"],
+                        total_queries=len(record["queries"]), headers=record["headers"],
+                        n_plus_one=record["n_plus_one"], repeated_queries=record["repeated_queries"],
+                        duplicate_queries=record["duplicate_queries"], wasted_time=record["wasted_time"],
+                        regression=record.get("regression"))
+            for record in records
+        ]
+        with self._stacks_lock:
+            if time.monotonic() - self._stacks_checked_at >= STACK_CACHE_SECONDS:
+                self._stored_stacks.clear()
+                self._stacks_checked_at = time.monotonic()
+            stacks = {}
+            for record in records:
+                for query_obj in record["queries"]:
+                    frames = query_obj['stack']
+                    key = stack_key(frames) if frames else None
+                    if key is not None and key not in self._stored_stacks:
+                        stacks[key] = frames
+                    query_obj['stack_key'] = key
+            with get_session() as db:
+                if stacks:
+                    existing = set(db.scalars(select(StackInfo.key).where(StackInfo.key.in_(list(stacks)))))
+                    stack_rows = [{"key": key, "frames": [list(frame) for frame in frames]}
+                                  for key, frames in stacks.items() if key not in existing]
+                    if stack_rows:
+                        db.execute(insert(StackInfo), stack_rows)
+                db.add_all(request_infos)
+                db.flush()
+                rows = []
+                statements = []
+                for record, request_info in zip(records, request_infos):
+                    for query_obj, query_row in query_rows(record):
+                        query_row["request_id"] = request_info.id
+                        query_row["stack_key"] = query_obj['stack_key']
+                        rows.append(query_row)
+                        statements.append(dict(query_row, statement=query_obj['statement']))
+                if rows:
+                    db.execute(insert(QueryInfo), rows)
+                    self._save_statements(db, aggregate_statements(statements))
+                    self._save_call_sites(db, *aggregate_call_sites(
+                        query_obj for record in records for query_obj in record["queries"]))
+                if spool_offset is not None:
+                    db.merge(SpoolOffsetInfo(spool_file=spool_offset[0], offset=spool_offset[1]))
+                db.commit()
+            if len(self._stored_stacks) >= MAX_STACK_KEYS:
+                self._stored_stacks.clear()
+            self._stored_stacks.update(stacks)
+
+    def _save_statements(self, db, stats):
+        """Merge the statement aggregates of a batch into `middleware_statement`.
+
+        The existing rows are locked, in fingerprint order so concurrent
+        writers cannot deadlock, before their counts and histograms are read
+        and merged, so batches saved by several processes at once add up
+        instead of overwriting each other. Concurrent inserts of a new
+        fingerprint are retried by :meth:`save`.
+        """
+        now = datetime.datetime.utcnow()
+        existing = {
+            statement_info.fingerprint: statement_info
+            for statement_info in db.scalars(
+                select(StatementInfo).where(StatementInfo.fingerprint.in_(list(stats)))
+                .order_by(StatementInfo.fingerprint).with_for_update())
+        }
+        for query_fingerprint, statement_stats in stats.items():
+            statement_info = existing.get(query_fingerprint)
+            if statement_info is None:
+                db.add(StatementInfo(fingerprint=query_fingerprint, statement=statement_stats.statement,
+                                     count=statement_stats.count, total_time=statement_stats.total_time,
+                                     min_time=statement_stats.min_time, max_time=statement_stats.max_time,
+                                     histogram=statement_stats.histogram.to_dict(), last_seen=now))
+                continue
+            statement_info.count += statement_stats.count
+            statement_info.total_time += statement_stats.total_time
+            statement_info.min_time = min(statement_info.min_time, statement_stats.min_time)
+            statement_info.max_time = max(statement_info.max_time, statement_stats.max_time)
+            statement_info.histogram = Histogram(statement_info.histogram).merge(statement_stats.histogram).to_dict()
+            statement_info.last_seen = now
+
+    def _save_call_sites(self, db, sites, paths):
+        """Merge the call site and call path aggregates of a batch into their tables.
+
+        As in :meth:`_save_statements`, the existing rows are locked in key
+        order before they are read and merged.
+        """
+        now = datetime.datetime.utcnow()
+        site_keys = {stack_key((frame,)): call_site for frame, call_site in sites.items()}
+        existing = {
+            call_site_info.key: call_site_info
+            for call_site_info in db.scalars(
+                select(CallSiteInfo).where(CallSiteInfo.key.in_(list(site_keys)))
+                .order_by(CallSiteInfo.key).with_for_update())
+        }
+        for key, call_site in site_keys.items():
+            call_site_info = existing.get(key)
+            if call_site_info is None:
+                db.add(CallSiteInfo(key=key, filename=call_site.filename, lineno=call_site.lineno,
+                                    function=call_site.function, count=call_site.count,
+                                    total_time=call_site.total_time, statements=sorted(call_site.statements),
+                                    last_seen=now))
+                continue
+            merged = CallSiteStats(*call_site.frame)
+            merged.add_statements(call_site_info.statements or ())
+            merged.add_statements(call_site.statements)
+            call_site_info.count += call_site.count
+            call_site_info.total_time += call_site.total_time
+            call_site_info.statements = sorted(merged.statements)
+            call_site_info.last_seen = now
+        path_keys = {stack_key(frames): call_path for frames, call_path in paths.items()}
+        existing = {
+            call_path_info.stack_key: call_path_info
+            for call_path_info in db.scalars(
+                select(CallPathInfo).where(CallPathInfo.stack_key.in_(list(path_keys)))
+                .order_by(CallPathInfo.stack_key).with_for_update())
+        }
+        for key, call_path in path_keys.items():
+            call_path_info = existing.get(key)
+            if call_path_info is None:
+                db.add(CallPathInfo(stack_key=key, count=call_path.count, total_time=call_path.total_time,
+                                    last_seen=now))
+                continue
+            call_path_info.count += call_path.count
+            call_path_info.total_time += call_path.total_time
+            call_path_info.last_seen = now
+
+    def filter_requests(self, request_query, path=None, method=None, min_time=None, min_queries=None,
+                        repeated=False, regressed=False, start=None, end=None):
+        """Apply the dashboard filters to a RequestInfo query or select."""
+        if path:
+            request_query = request_query.filter(RequestInfo.path.startswith(path, autoescape=True))
+        if method:
+            request_query = request_query.filter(RequestInfo.method == method.upper())
+        if min_time is not None:
+            request_query = request_query.filter(RequestInfo.time_taken >= min_time)
+        if min_queries is not None:
+            request_query = request_query.filter(RequestInfo.total_queries >= min_queries)
+        if repeated:
+            request_query = request_query.filter((RequestInfo.repeated_queries > 0) | (RequestInfo.duplicate_queries > 0))
+        if regressed:
+            request_query = request_query.filter(RequestInfo.regression.isnot(None))
+        if start is not None:
+            request_query = request_query.filter(RequestInfo.start_time >= start)
+        if end is not None:
+            request_query = request_query.filter(RequestInfo.start_time < end)
+        return request_query
+
+    def list_requests(self, sort="recent", limit=20, before=None, after=None, **filters):
+        """Return one page of requests, using keyset pagination on the sort column then id."""
+        sort_attribute = REQUEST_SORTS[sort]
+        sort_column = getattr(RequestInfo, sort_attribute)
+        with get_session() as db:
+            request_query = self.filter_requests(db.query(RequestInfo), **filters)
+            cursor = before or after
+            if cursor:
+                value, cursor_id = parse_cursor(cursor)
+                if before:
+                    request_query = request_query.filter(
+                        (sort_column < value) | ((sort_column == value) & (RequestInfo.id < cursor_id)))
+                else:
+                    request_query = request_query.filter(
+                        (sort_column > value) | ((sort_column == value) & (RequestInfo.id > cursor_id)))
+            if after:
+                rows = request_query.order_by(sort_column, RequestInfo.id).limit(limit + 1).all()
+                return rows[:limit][::-1], len(rows) > limit, True
+            rows = request_query.order_by(sort_column.desc(), RequestInfo.id.desc()).limit(limit + 1).all()
+            return rows[:limit], bool(before), len(rows) > limit
+
+    def count_requests(self, **filters):
+        """Count the requests matching `filters`, cached for `COUNT_CACHE_SECONDS`."""
+        key = tuple(sorted(filters.items()))
+        now = time.monotonic()
+        cached = self._count_cache.get(key)
+        if cached is not None and now - cached[0] < COUNT_CACHE_SECONDS:
+            return cached[1]
+        with get_session() as db:
+            total = self.filter_requests(db.query(RequestInfo), **filters).count()
+        if len(self._count_cache) > 100:
+            self._count_cache.clear()
+        self._count_cache[key] = (now, total)
+        return total
+
+    def get_request(self, request_id):
+        """Return a request, or None."""
+        with get_session() as db:
+            return db.get(RequestInfo, request_id)
+
+    def get_queries(self, request_id):
+        """Return the queries of a request in execution order."""
+        with get_session() as db:
+            return db.query(QueryInfo).filter_by(request_id=request_id).order_by(QueryInfo.id).all()
+
+    def query_time(self, request_id):
+        """Return the total time of a request's queries in ms, summed in SQL."""
+        with get_session() as db:
+            total = db.query(func.sum(QueryInfo.time_taken)).filter(QueryInfo.request_id == request_id).scalar()
+        return round(total or 0, 3)
+
+    def get_query(self, query_id):
+        """Return a query, or None."""
+        with get_session() as db:
+            return db.get(QueryInfo, query_id)
+
+    def get_stack(self, query):
+        """Return the captured frames of a query, or None."""
+        if not query.stack_key:
+            return None
+        with get_session() as db:
+            stack_info = db.get(StackInfo, query.stack_key)
+        return stack_info.frames if stack_info else None
+
+    def top_statements(self, limit=50):
+        """Return StatementStats ranked by total time."""
+        with get_session() as db:
+            statement_infos = db.query(StatementInfo).order_by(StatementInfo.total_time.desc()).limit(limit).all()
+        top = []
+        for statement_info in statement_infos:
+            statement_stats = StatementStats(statement_info.fingerprint, statement_info.statement)
+            statement_stats.count = statement_info.count
+            statement_stats.total_time = statement_info.total_time
+            statement_stats.min_time = statement_info.min_time
+            statement_stats.max_time = statement_info.max_time
+            statement_stats.histogram = Histogram(statement_info.histogram)
+            top.append(statement_stats)
+        return top
+
+    def top_call_sites(self, limit=50):
+        """Return CallSiteStats ranked by total time."""
+        with get_session() as db:
+            call_site_infos = db.scalars(select(CallSiteInfo).order_by(CallSiteInfo.total_time.desc())
+                                         .limit(limit)).all()
+        top = []
+        for call_site_info in call_site_infos:
+            call_site = CallSiteStats(call_site_info.filename, call_site_info.lineno, call_site_info.function)
+            call_site.count = call_site_info.count
+            call_site.total_time = call_site_info.total_time
+            call_site.add_statements(call_site_info.statements or ())
+            top.append(call_site)
+        return top
+
+    def top_call_paths(self, limit=500):
+        """Return CallPathStats ranked by total time."""
+        with get_session() as db:
+            rows = db.execute(select(CallPathInfo, StackInfo.frames)
+                              .join(StackInfo, StackInfo.key == CallPathInfo.stack_key)
+                              .order_by(CallPathInfo.total_time.desc()).limit(limit)).all()
+        top = []
+        for call_path_info, frames in rows:
+            call_path = CallPathStats(tuple(tuple(frame) for frame in frames))
+            call_path.count = call_path_info.count
+            call_path.total_time = call_path_info.total_time
+            top.append(call_path)
+        return top
+
+    def export(self, batch_size=1000, **filters):
+        """Yield the matching requests joined with their queries, oldest first.
+
+        Only the exported columns are selected, and rows are fetched
+        `batch_size` at a time from a server-side cursor where the driver
+        supports one, so memory stays constant however many rows match.
+        """
+        columns = (RequestInfo.id.label("request_id"), RequestInfo.path, RequestInfo.method, RequestInfo.start_time,
+                   RequestInfo.time_taken.label("request_time_taken"), RequestInfo.total_queries,
+                   QueryInfo.id.label("query_id"), QueryInfo.query, QueryInfo.time_taken, QueryInfo.compile_time,
+                   QueryInfo.rowcount, QueryInfo.batch_size, QueryInfo.params, QueryInfo.fingerprint)
+        export_query = select(*columns).outerjoin(QueryInfo, QueryInfo.request_id == RequestInfo.id)
+        export_query = self.filter_requests(export_query, **filters).order_by(RequestInfo.id, QueryInfo.id)
+        with get_session() as db:
+            for row in db.execute(export_query.execution_options(yield_per=batch_size)):
+                yield tuple(row)
+
+    def save_plan(self, fingerprint, plan):
+        """Store the query plan of a statement shape, replacing any earlier one."""
+        with get_session() as db:
+            db.merge(PlanInfo(fingerprint=fingerprint, plan=plan, explained_at=datetime.datetime.utcnow()))
+            db.commit()
+
+    def get_plan(self, fingerprint):
+        """Return the PlanInfo of a statement shape, or None."""
+        with get_session() as db:
+            return db.get(PlanInfo, fingerprint)
+
+    def save_baseline(self, name, routes):
+        """Store a named baseline as one row per route, replacing any earlier one of that name."""
+        now = datetime.datetime.utcnow()
+        rows = [baseline_row(name, key, stats, now) for key, stats in routes.items()]
+        with get_session() as db:
+            db.query(BaselineInfo).filter(BaselineInfo.name == name).delete()
+            baseline_set = db.get(BaselineSetInfo, name, with_for_update=True)
+            if baseline_set is None:
+                db.add(BaselineSetInfo(name=name, created_at=now, reference=False))
+            else:
+                baseline_set.created_at = now
+            if rows:
+                db.execute(insert(BaselineInfo), rows)
+            db.commit()
+            return db.get(BaselineSetInfo, name).created_at
+
+    def merge_baseline(self, name, created_at, routes):
+        """Add RouteStats to the rows of a saved baseline.
+
+        The baseline and its rows are locked, the rows in key order, before
+        their histograms are read and merged, so the processes contributing
+        at once all count.
+        """
+        with get_session() as db:
+            baseline_set = db.get(BaselineSetInfo, name, with_for_update=True)
+            if baseline_set is None or baseline_set.created_at != created_at:
+                return False
+            existing = {
+                (baseline_info.route, baseline_info.method): baseline_info
+                for baseline_info in db.scalars(
+                    select(BaselineInfo).where(BaselineInfo.name == name)
+                    .order_by(BaselineInfo.route, BaselineInfo.method).with_for_update())
+            }
+            for key, stats in routes.items():
+                baseline_info = existing.get(key)
+                if baseline_info is None:
+                    db.add(BaselineInfo(**baseline_row(name, key, stats, created_at)))
+                    continue
+                merged = baseline_stats(baseline_info).merge(stats)
+                baseline_info.count = merged.count
+                baseline_info.latency = merged.latency.to_dict()
+                baseline_info.db_time = merged.db_time.to_dict()
+                baseline_info.queries = merged.queries.to_dict()
+            db.commit()
+        return True
+
+    def get_baseline(self, name):
+        """Return the RouteStats of a named baseline keyed by `(route, method)`, empty if unknown."""
+        with get_session() as db:
+            return {
+                (baseline_info.route, baseline_info.method): baseline_stats(baseline_info)
+                for baseline_info in db.query(BaselineInfo).filter(BaselineInfo.name == name)
+            }
+
+    def list_baselines(self):
+        """Return `(name, created_at, routes)` tuples of the saved baselines, newest first."""
+        with get_session() as db:
+            baseline_query = (db.query(BaselineSetInfo.name, BaselineSetInfo.created_at, func.count(BaselineInfo.name))
+                              .outerjoin(BaselineInfo, BaselineInfo.name == BaselineSetInfo.name)
+                              .group_by(BaselineSetInfo.name, BaselineSetInfo.created_at)
+                              .order_by(BaselineSetInfo.created_at.desc()))
+            return [tuple(row) for row in baseline_query]
+
+    def set_reference_baseline(self, name):
+        """Flag a saved baseline as the reference, clearing the flag of the others."""
+        with get_session() as db:
+            if name is not None and db.get(BaselineSetInfo, name) is None:
+                return False
+            db.query(BaselineSetInfo).filter(BaselineSetInfo.reference.is_(True),
+                                             BaselineSetInfo.name != name).update({"reference": False})
+            if name is not None:
+                db.query(BaselineSetInfo).filter(BaselineSetInfo.name == name).update({"reference": True})
+            db.commit()
+        return True
+
+    def get_reference_baseline(self):
+        """Return the name of the reference baseline, or None."""
+        with get_session() as db:
+            return db.scalar(select(BaselineSetInfo.name).where(BaselineSetInfo.reference.is_(True)).limit(1))
+
+    def prune_cutoffs(self, policy):
+        """Return the bounds of the requests expired by `policy`, read once per pruning pass.
+
+        Returns
+        -------
+        dict: The start time before which requests are expired, the highest id
+            beyond `max_requests`, and for each path over `max_queries_per_path`
+            the highest id to delete.
+
+        """
+        cutoffs = {"time": policy.cutoff(), "id": None, "paths": {}}
+        with get_session() as db:
+            if policy.max_requests is not None:
+                cutoffs["id"] = db.scalar(select(RequestInfo.id).order_by(RequestInfo.id.desc())
+                                          .offset(policy.max_requests).limit(1))
+            if policy.max_queries_per_path is not None:
+                total_queries = func.sum(RequestInfo.total_queries)
+                over_limit = db.execute(select(RequestInfo.path, total_queries).group_by(RequestInfo.path)
+                                        .having(total_queries > policy.max_queries_per_path)).all()
+                for path, path_queries in over_limit:
+                    excess = path_queries - policy.max_queries_per_path
+                    oldest = db.execute(select(RequestInfo.id, RequestInfo.total_queries)
+                                        .where(RequestInfo.path == path).order_by(RequestInfo.id)
+                                        .execution_options(yield_per=1000))
+                    for request_id, request_queries in oldest:
+                        cutoffs["paths"][path] = request_id
+                        excess -= request_queries
+                        if excess <= 0:
+                            break
+                    oldest.close()
+        return cutoffs
+
+    def expired_requests(self, db, cutoffs, batch_size):
+        """Return the ids of the oldest requests expired by `cutoffs`, at most `batch_size`.
+
+        Each limit is looked up through an index: start time for the age,
+        id for the request count, and path for the per-path query rows. The
+        paths found done are dropped from `cutoffs` for the rest of the pass.
+        """
+        if cutoffs["time"] is not None:
+            request_ids = db.scalars(select(RequestInfo.id).where(RequestInfo.start_time < cutoffs["time"])
+                                     .order_by(RequestInfo.start_time).limit(batch_size)).all()
+            if request_ids:
+                return request_ids
+        if cutoffs["id"] is not None:
+            request_ids = db.scalars(select(RequestInfo.id).where(RequestInfo.id <= cutoffs["id"])
+                                     .order_by(RequestInfo.id).limit(batch_size)).all()
+            if request_ids:
+                return request_ids
+        request_ids = []
+        for path, boundary in list(cutoffs["paths"].items()):
+            limit = batch_size - len(request_ids)
+            path_ids = db.scalars(select(RequestInfo.id).where(RequestInfo.path == path, RequestInfo.id <= boundary)
+                                  .order_by(RequestInfo.id).limit(limit)).all()
+            request_ids.extend(path_ids)
+            if len(path_ids) < limit:
+                del cutoffs["paths"][path]
+            if len(request_ids) >= batch_size:
+                break
+        return request_ids
+
+    def delete_requests(self, db, request_ids):
+        """Delete requests and their queries by id, in the current transaction."""
+        db.query(QueryInfo).filter(QueryInfo.request_id.in_(request_ids)).delete(synchronize_session=False)
+        db.query(RequestInfo).filter(RequestInfo.id.in_(request_ids)).delete(synchronize_session=False)
+
+    def prune(self, policy, batch_size=500, cutoffs=None):
+        """Delete one batch of expired requests and their queries in a short transaction."""
+        if cutoffs is None:
+            cutoffs = self.prune_cutoffs(policy)
+        with get_session() as db:
+            request_ids = self.expired_requests(db, cutoffs, batch_size)
+            if request_ids:
+                self.delete_requests(db, request_ids)
+                db.commit()
+        if request_ids:
+            self._count_cache.clear()
+        return len(request_ids)
+
+    def prune_unused(self, policy, batch_size=500):
+        """Delete one batch of the stacks no query uses, and of the aggregates older than `max_age`.
+
+        The statement, call site and call path aggregates are deleted once not
+        seen for `max_age`, and so are the plans captured before then. Without
+        `max_age` they are kept, one row per distinct statement shape, source
+        line and call path.
+
+        Stacks are deleted while no save of this store is in progress, and
+        only if still unused when deleted, so queries saved by this process
+        never lose their stack.
+        """
+        cutoff = policy.cutoff()
+        with self._stacks_lock:
+            with get_session() as db:
+                unused = (~select(QueryInfo.id).where(QueryInfo.stack_key == StackInfo.key).exists())
+                keys = db.scalars(select(StackInfo.key).where(unused).limit(batch_size)).all()
+                if keys:
+                    db.query(StackInfo).filter(StackInfo.key.in_(keys), unused).delete(synchronize_session=False)
+                    db.commit()
+                    self._stored_stacks.clear()
+        if keys:
+            return len(keys)
+        if cutoff is None:
+            return 0
+        with get_session() as db:
+            for column in (StatementInfo.last_seen, CallSiteInfo.last_seen, CallPathInfo.last_seen,
+                           PlanInfo.explained_at):
+                primary_key = column.class_.__mapper__.primary_key[0]
+                keys = db.scalars(select(primary_key).where(column < cutoff).limit(batch_size)).all()
+                if keys:
+                    db.query(column.class_).filter(primary_key.in_(keys)).delete(synchronize_session=False)
+                    db.commit()
+                    return len(keys)
+        return 0
+
+    def clear(self, batch_size=1000):
+        """Delete every stored record.
+
+        Requests are deleted in batches of `batch_size`, each in its own
+        transaction, so clearing a large history does not hold table locks
+        for the whole operation.
+        """
+        while True:
+            with get_session() as db:
+                request_ids = db.scalars(select(RequestInfo.id).order_by(RequestInfo.id).limit(batch_size)).all()
+                if not request_ids:
+                    break
+                self.delete_requests(db, request_ids)
+                db.commit()
+        with get_session() as db:
+            db.query(QueryInfo).delete()
+            db.query(StackInfo).delete()
+            db.query(StatementInfo).delete()
+            db.query(PlanInfo).delete()
+            db.query(CallSiteInfo).delete()
+            db.query(CallPathInfo).delete()
+            db.commit()
+        self._stored_stacks.clear()
+        self._count_cache.clear()
+
+
+class RequestRecord(object):
+    """A captured request held by :class:`MemoryStore`."""
+
+    __slots__ = ("id", "path", "query_params", "raw_body", "body", "method", "start_time", "end_time",
+                 "time_taken", "total_queries", "headers", "n_plus_one", "repeated_queries",
+                 "duplicate_queries", "wasted_time", "regression", "queries")
+
+    def __init__(self, request_id, record, queries):
+        """Initialize a RequestRecord object from a middleware record."""
+        self.id = request_id
+        self.path = record["path"]
+        self.query_params = record["query_params"]
+        self.raw_body = record["raw_body"]
+        self.body = record["body"]
+        self.method = record["method"]
+        self.start_time = record["start_time"]
+        self.end_time = record["end_time"]
+        self.time_taken = record["time_taken"]
+        self.total_queries = len(queries)
+        self.headers = record["headers"]
+        self.n_plus_one = record["n_plus_one"]
+        self.repeated_queries = record["repeated_queries"]
+        self.duplicate_queries = record["duplicate_queries"]
+        self.wasted_time = record["wasted_time"]
+        self.regression = record.get("regression")
+        self.queries = queries
+
+
+class QueryRecord(object):
+    """A captured query held by :class:`MemoryStore`."""
+
+    __slots__ = ("id", "request_id", "query", "time_taken", "compile_time", "rowcount", "batch_size", "params",
+                 "fingerprint", "stack")
+
+    traceback = None
+    stack_key = None
+
+    def __init__(self, query_id, request_id, query_row, stack):
+        """Initialize a QueryRecord object from the stored fields of a query."""
+        self.id = query_id
+        self.request_id = request_id
+        self.query = query_row["query"]
+        self.time_taken = query_row["time_taken"]
+        self.compile_time = query_row["compile_time"]
+        self.rowcount = query_row["rowcount"]
+        self.batch_size = query_row["batch_size"]
+        self.params = query_row["params"]
+        self.fingerprint = query_row["fingerprint"]
+        self.stack = stack
+
+
+class MemoryStore(BaseStore):
+    """Keep the most recent profiling records in a fixed-size ring buffer.
+
+    Records are appended in O(1) and the oldest request, with its queries,
+    is evicted once `capacity` requests are held. Nothing is written to a
+    database, so records are saved directly from the request rather than
+    through the writer thread. Statement and call site aggregates cover every
+    saved request, including evicted ones, up to `max_statements` entries each.
+
+    Args:
+    ----
+        capacity (int): Maximum number of requests kept.
+        max_statements (int): Maximum number of statement fingerprints, call sites and
+            call paths aggregated.
+
+    """
+
+    write_behind = False
+
+    def __init__(self, capacity=1000, max_statements=10000):
+        """Initialize a MemoryStore object."""
+        self.capacity = capacity
+        self.max_statements = max_statements
+        self._requests = collections.deque()
+        self._requests_by_id = {}
+        self._queries_by_id = {}
+        self._statements = {}
+        self._plans = {}
+        self._call_sites = {}
+        self._call_paths = {}
+        self._baselines = {}
+        self._reference_baseline = None
+        self._request_ids = itertools.count(1)
+        self._query_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def save(self, records):
+        """Append records to the buffer, evicting the oldest ones."""
+        with self._lock:
+            for record in records:
+                self._append(record)
+
+    def _append(self, record):
+        """Append one record; the caller holds the lock."""
+        request_id = next(self._request_ids)
+        queries = []
+        for query_obj, query_row in query_rows(record):
+            query = QueryRecord(next(self._query_ids), request_id, query_row, query_obj['stack'])
+            queries.append(query)
+            self._queries_by_id[query.id] = query
+            statement_stats = self._statements.get(query.fingerprint)
+            if statement_stats is None:
+                if len(self._statements) >= self.max_statements:
+                    continue
+                statement_stats = self._statements[query.fingerprint] = StatementStats(query.fingerprint,
+                                                                                       query_obj['statement'])
+            statement_stats.add(query.time_taken)
+        sites, paths = aggregate_call_sites(record["queries"])
+        for frame, call_site in sites.items():
+            if frame in self._call_sites:
+                self._call_sites[frame].merge(call_site)
+            elif len(self._call_sites) < self.max_statements:
+                self._call_sites[frame] = call_site
+        for frames, call_path in paths.items():
+            if frames in self._call_paths:
+                self._call_paths[frames].count += call_path.count
+                self._call_paths[frames].total_time += call_path.total_time
+            elif len(self._call_paths) < self.max_statements:
+                self._call_paths[frames] = call_path
+        request_record = RequestRecord(request_id, record, queries)
+        self._requests.append(request_record)
+        self._requests_by_id[request_id] = request_record
+        if len(self._requests) > self.capacity:
+            self._forget(self._requests.popleft())
+
+    def _forget(self, request_record):
+        """Drop the indexes of a request removed from the buffer; the caller holds the lock."""
+        del self._requests_by_id[request_record.id]
+        for query in request_record.queries:
+            del self._queries_by_id[query.id]
+
+    def _matching(self, path=None, method=None, min_time=None, min_queries=None, repeated=False,
+                  regressed=False, start=None, end=None):
+        """Return the held requests matching the dashboard filters, oldest first."""
+        with self._lock:
+            requests = list(self._requests)
+        method = method.upper() if method else None
+        return [
+            request_record for request_record in requests
+            if (not path or request_record.path.startswith(path))
+            and (not method or request_record.method == method)
+            and (min_time is None or request_record.time_taken >= min_time)
+            and (min_queries is None or request_record.total_queries >= min_queries)
+            and (not repeated or request_record.repeated_queries or request_record.duplicate_queries)
+            and (not regressed or request_record.regression)
+            and (start is None or request_record.start_time >= start)
+            and (end is None or request_record.start_time < end)
+        ]
+
+    def list_requests(self, sort="recent", limit=20, before=None, after=None, **filters):
+        """Return one page of requests, using the same cursors as :class:`SQLStore`."""
+        sort_attribute = REQUEST_SORTS[sort]
+
+        def sort_key(request_record):
+            return (getattr(request_record, sort_attribute) or 0, request_record.id)
+
+        requests = sorted(self._matching(**filters), key=sort_key, reverse=True)
+        if after:
+            cursor = parse_cursor(after)
+            preceding = [request_record for request_record in requests if sort_key(request_record) > cursor]
+            return preceding[-limit:], len(preceding) > limit, True
+        if before:
+            cursor = parse_cursor(before)
+            requests = [request_record for request_record in requests if sort_key(request_record) < cursor]
+        return requests[:limit], bool(before), len(requests) > limit
+
+    def count_requests(self, **filters):
+        """Return the number of held requests matching `filters`."""
+        if not any(filters.values()):
+            return len(self._requests)
+        return len(self._matching(**filters))
+
+    def get_request(self, request_id):
+        """Return a request, or None."""
+        return self._requests_by_id.get(request_id)
+
+    def get_queries(self, request_id):
+        """Return the queries of a request in execution order."""
+        request_record = self._requests_by_id.get(request_id)
+        return list(request_record.queries) if request_record else []
+
+    def query_time(self, request_id):
+        """Return the total time of a request's queries in ms."""
+        return round(sum(query.time_taken for query in self.get_queries(request_id)), 3)
+
+    def get_query(self, query_id):
+        """Return a query, or None."""
+        return self._queries_by_id.get(query_id)
+
+    def get_stack(self, query):
+        """Return the captured frames of a query, or None."""
+        return query.stack
+
+    def top_statements(self, limit=50):
+        """Return StatementStats ranked by total time."""
+        with self._lock:
+            statements = list(self._statements.values())
+        return sorted(statements, key=lambda statement_stats: statement_stats.total_time, reverse=True)[:limit]
+
+    def top_call_sites(self, limit=50):
+        """Return CallSiteStats ranked by total time."""
+        with self._lock:
+            call_sites = list(self._call_sites.values())
+        return sorted(call_sites, key=lambda call_site: call_site.total_time, reverse=True)[:limit]
+
+    def top_call_paths(self, limit=500):
+        """Return CallPathStats ranked by total time."""
+        with self._lock:
+            call_paths = list(self._call_paths.values())
+        return sorted(call_paths, key=lambda call_path: call_path.total_time, reverse=True)[:limit]
+
+    def export(self, batch_size=1000, **filters):  # noqa: ARG002
+        """Yield the held requests matching `filters` joined with their queries, oldest first."""
+        for request_record in self._matching(**filters):
+            request_fields = (request_record.id, request_record.path, request_record.method,
+                              request_record.start_time, request_record.time_taken, request_record.total_queries)
+            if not request_record.queries:
+                yield request_fields + (None,) * 8
+            for query in request_record.queries:
+                yield request_fields + (query.id, query.query, query.time_taken, query.compile_time, query.rowcount,
+                                        query.batch_size, query.params, query.fingerprint)
+
+    def save_plan(self, fingerprint, plan):
+        """Keep the query plan of a statement shape, up to `max_statements` shapes."""
+        with self._lock:
+            if fingerprint in self._plans or len(self._plans) < self.max_statements:
+                self._plans[fingerprint] = PlanInfo(fingerprint=fingerprint, plan=plan,
+                                                    explained_at=datetime.datetime.utcnow())
+
+    def get_plan(self, fingerprint):
+        """Return the PlanInfo of a statement shape, or None."""
+        return self._plans.get(fingerprint)
+
+    def save_baseline(self, name, routes):
+        """Keep a named baseline, replacing any earlier one of that name."""
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            self._baselines[name] = (now, {key: RouteStats().merge(stats) for key, stats in routes.items()})
+        return now
+
+    def merge_baseline(self, name, created_at, routes):
+        """Add RouteStats to a kept baseline."""
+        with self._lock:
+            baseline = self._baselines.get(name)
+            if baseline is None or baseline[0] != created_at:
+                return False
+            for key, stats in routes.items():
+                baseline[1].setdefault(key, RouteStats()).merge(stats)
+        return True
+
+    def get_baseline(self, name):
+        """Return the RouteStats of a named baseline keyed by `(route, method)`, empty if unknown."""
+        with self._lock:
+            routes = self._baselines.get(name, (None, {}))[1]
+            return {key: RouteStats().merge(stats) for key, stats in routes.items()}
+
+    def list_baselines(self):
+        """Return `(name, created_at, routes)` tuples of the saved baselines, newest first."""
+        with self._lock:
+            baselines = [(name, created_at, len(routes)) for name, (created_at, routes) in self._baselines.items()]
+        return sorted(baselines, key=lambda baseline: baseline[1], reverse=True)
+
+    def set_reference_baseline(self, name):
+        """Make a kept baseline the reference, or none."""
+        with self._lock:
+            if name is not None and name not in self._baselines:
+                return False
+            self._reference_baseline = name
+        return True
+
+    def get_reference_baseline(self):
+        """Return the name of the reference baseline, or None."""
+        return self._reference_baseline
+
+    def prune(self, policy, batch_size=500, cutoffs=None):
+        """Evict one batch of the oldest requests expired by a retention policy."""
+        cutoff = policy.cutoff()
+        expired = set()
+        with self._lock:
+            excess = len(self._requests) - policy.max_requests if policy.max_requests is not None else 0
+            path_excess = {}
+            if policy.max_queries_per_path is not None:
+                for request_record in self._requests:
+                    path_excess[request_record.path] = (path_excess.get(request_record.path, 0)
+                                                        + request_record.total_queries)
+                path_excess = {path: total - policy.max_queries_per_path for path, total in path_excess.items()}
+            for index, request_record in enumerate(self._requests):
+                if len(expired) >= batch_size:
+                    break
+                if (index < excess or (cutoff is not None and request_record.start_time < cutoff)
+                        or path_excess.get(request_record.path, 0) > 0):
+                    expired.add(request_record.id)
+                    if request_record.path in path_excess:
+                        path_excess[request_record.path] -= request_record.total_queries
+            if expired:
+                kept = collections.deque()
+                for request_record in self._requests:
+                    if request_record.id in expired:
+                        self._forget(request_record)
+                    else:
+                        kept.append(request_record)
+                self._requests = kept
+        return len(expired)
+
+    def clear(self):
+        """Delete every held record."""
+        with self._lock:
+            self._requests.clear()
+            self._requests_by_id.clear()
+            self._queries_by_id.clear()
+            self._statements.clear()
+            self._plans.clear()
+            self._call_sites.clear()
+            self._call_paths.clear()
+
+
+_store = None
+
+
+def get_store():
+    """Return the store used by the dashboard, creating a SQLStore by default."""
+    global _store
+    if _store is None:
+        _store = SQLStore()
+    return _store
+
+
+def set_store(store):
+    """Set the store used by the dashboard."""
+    global _store
+    _store = store
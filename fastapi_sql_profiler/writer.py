@@ -0,0 +1,164 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Queued by `ProfileWriter.stop` behind the pending records to end the worker thread.
+_STOP = object()
+
+
+class ProfileWriter(object):
+    """Write-behind queue for captured profiling records.
+
+    The middleware hands finished request records to :meth:`put`, which never
+    blocks. A daemon thread drains the queue and passes batches to `persist`,
+    flushing whenever `batch_size` records are pending or `flush_interval`
+    seconds have elapsed since the first pending record.
+
+    Args:
+    ----
+        persist (callable): Called with a list of records from the worker thread.
+        maxsize (int): Maximum number of records waiting to be persisted.
+        batch_size (int): Maximum number of records passed to `persist` at once.
+        flush_interval (float): Maximum seconds a record waits before a flush.
+
+    Attributes:
+    ----------
+        enqueued (int): Number of records accepted by :meth:`put`.
+        dropped (int): Number of records rejected because the queue was full.
+        flushed (int): Number of records handed to `persist`.
+        batches (int): Number of calls made to `persist`.
+        errors (int): Number of batches for which `persist` raised.
+
+    """
+
+    def __init__(self, persist, maxsize=10000, batch_size=100, flush_interval=1.0):
+        """Initialize a ProfileWriter object."""
+        self.persist = persist
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.enqueued = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.batches = 0
+        self.errors = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def start(self):
+        """Start the worker thread if it is not already running."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="sql-profiler-writer", daemon=True)
+            self._thread.start()
+
+    def put(self, record):
+        """Queue a record for persistence without blocking.
+
+        Returns
+        -------
+        bool: False if the queue was full and the record was dropped.
+
+        """
+        if self._thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def flush(self, timeout=None):
+        """Block until every queued record has been persisted.
+
+        Args:
+        ----
+        timeout (float, optional): Give up after this many seconds.
+
+        Returns
+        -------
+        bool: True if the queue was fully drained.
+
+        """
+        if self._thread is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        """Persist pending records now, without waiting for `flush_interval`, and stop the worker thread."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopping = True
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        """Return the writer counters as a dictionary."""
+        return {
+            "pending": self.queue.qsize(),
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+    def _run(self):
+        """Drain the queue in batches until the stop marker is reached."""
+        while True:
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            if first is _STOP:
+                self.queue.task_done()
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 and not self._stopping:
+                    break
+                try:
+                    record = self.queue.get_nowait() if self._stopping else self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    self._write(batch)
+                    self.queue.task_done()
+                    return
+                batch.append(record)
+            self._write(batch)
+
+    def _write(self, batch):
+        """Persist a batch and mark its records as done."""
+        try:
+            self.persist(batch)
+            self.flushed += len(batch)
+        except Exception:
+            self.errors += 1
+            logger.exception("Failed to persist %d profiling records", len(batch))
+        finally:
+            self.batches += 1
+            for _ in batch:
+                self.queue.task_done()
@@ -1,16 +1,88 @@
-import unittest
+import asyncio
+import datetime
 import json
-from sqlalchemy import Column, Integer, String, text
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import httpx
+from sqlalchemy import Column, Integer, String, bindparam, create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker
-from fastapi_sql_profiler.middleware import SQLProfilerMiddleware
-from fastapi import FastAPI
+from fastapi_sql_profiler.middleware import SessionHandler, SQLProfilerMiddleware, install_listeners
+from fastapi_sql_profiler.add_request import router
+from fastapi_sql_profiler.fingerprint import normalize
+from fastapi_sql_profiler.add_request import live_events
+from fastapi_sql_profiler.baselines import BaselineTracker, RouteStats
+from fastapi_sql_profiler.explain import ExplainCapture
+from fastapi_sql_profiler.hotspots import CallPathStats, build_call_tree
+from fastapi_sql_profiler.live import LiveFeed
+from fastapi_sql_profiler.retention import Pruner, RetentionPolicy
+from fastapi_sql_profiler.sampling import Sampler
+from fastapi_sql_profiler.spool import SpoolCollector, SpoolStore, encode_record
+from fastapi_sql_profiler.stack import StackCapture
+from fastapi_sql_profiler.stats import Histogram
+from fastapi_sql_profiler.storage import REQUEST_SORTS, MemoryStore, SQLStore, page_cursor, set_store
+from fastapi_sql_profiler.writer import ProfileWriter
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
 from fastapi.testclient import TestClient
 from pydantic import BaseModel
-from fastapi_sql_profiler.database import Base, engine
-from fastapi_sql_profiler.models import RequestInfo  
+from fastapi_sql_profiler import database
+from fastapi_sql_profiler.database import Base
+from fastapi_sql_profiler.models import QueryInfo, RequestInfo, SpoolOffsetInfo, StackInfo, StatementInfo
+
+# The profiler database, opened by setUpModule so importing the tests opens nothing.
+engine = None
+_database_directory = None
+
+
+def setUpModule():
+    """Open the database set by SQLALCHEMY_DATABASE_URL, or else a temporary SQLite file."""
+    global engine, _database_directory
+    url = os.getenv("SQLALCHEMY_DATABASE_URL")
+    if not url:
+        _database_directory = tempfile.mkdtemp()
+        url = "sqlite:///" + os.path.join(_database_directory, "profiler.db")
+    engine = database.init(url)
+
+
+def tearDownModule():
+    """Close the database, removing the temporary SQLite file if one was created."""
+    engine.dispose()
+    if _database_directory is not None:
+        shutil.rmtree(_database_directory)
+
+
+def clear_profiler_tables():
+    """Delete every row of the profiler tables and of the tables the tests define on Base."""
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+
+
+class ProfilerTestCase(unittest.TestCase):
+    """Test case leaving the profiler tables empty and the default store in place."""
+
+    def tearDown(self):
+        clear_profiler_tables()
+        set_store(SQLStore())
+
+
+def get_profiler(app):
+    """Return the SQLProfilerMiddleware instance built into the app's middleware stack."""
+    node = app.middleware_stack
+    while not isinstance(node, SQLProfilerMiddleware):
+        node = node.app
+    return node
 
 
-class TestSQLTap(unittest.TestCase):
+class TestSQLTap(ProfilerTestCase):
 
     def setUp(self):
         self.app = FastAPI()
@@ -34,7 +106,15 @@ class TestSQLTap(unittest.TestCase):
 
         Base.metadata.create_all(bind=self.engine)
         self.Session = sessionmaker(bind=self.engine)
-        self.app.add_middleware(SQLProfilerMiddleware, engine=self.engine)
+        self.app.add_middleware(SQLProfilerMiddleware, engine=self.engine, flush_interval=0.01)
+
+    def last_request_info(self):
+        """Wait for the profiler writer and return the latest captured request."""
+        get_profiler(self.app).writer.flush(timeout=5)
+        session = self.Session()
+        request_info = session.query(RequestInfo).order_by(-RequestInfo.id).first()
+        session.close()
+        return request_info
 
     def insert_api(self):
         @self.app.post('/item_create')
@@ -43,30 +123,28 @@ class TestSQLTap(unittest.TestCase):
             item_data = self.Item(name=itemschema.name, description=itemschema.description)
             session.add(item_data)
             session.commit()
-            request_info = session.query(RequestInfo).order_by(-RequestInfo.id).first()
-            assert request_info.path == '/item_create'
-            assert request_info.method == 'POST'
-            assert request_info.body == json.dumps(itemschema.dict())
-            assert request_info.total_queries == 1
-            return item_data
+            return {"name": itemschema.name}
         payload = {
             'name':'item1',
             'description':'first item'
         }
         response = self.client.post('/item_create', json=payload)
+        request_info = self.last_request_info()
+        self.assertEqual(request_info.path, '/item_create')
+        self.assertEqual(request_info.method, 'POST')
+        self.assertEqual(json.loads(request_info.body), payload)
+        self.assertEqual(request_info.total_queries, 1)
         return response
 
     def display_api(self):
         @self.app.get("/item_get")
         def show():
             session = self.Session()
-            request_infos = session.query(RequestInfo).all()
-            for request_info in request_infos:
-                assert request_info.query_params == "test"
-                assert request_info.path == '/item_get'
-
-            return session.query(self.Item).all()
-        response = self.client.get('/item_get')
+            return [{"id": item.id, "name": item.name} for item in session.query(self.Item).all()]
+        response = self.client.get('/item_get?q=test')
+        request_info = self.last_request_info()
+        self.assertEqual(request_info.query_params, "q=test")
+        self.assertEqual(request_info.path, '/item_get')
         return response
 
     def update_api(self):
@@ -80,17 +158,17 @@ class TestSQLTap(unittest.TestCase):
             item.description = itemschema.description
             session.add(item)
             session.commit()
-            request_info = session.query(RequestInfo).order_by(-RequestInfo.id).first()
-            assert request_info.path == '/item_update/24'
-            assert request_info.method == 'PUT'
-            assert request_info.body == json.dumps(itemschema.dict())
-            assert request_info.total_queries == 1
-            return item
+            return {"id": item.id}
         payload = {
             'name':'itemupdate',
             'description':'updateditem'
         }
         response = self.client.put('/item_update/24', json=payload)
+        request_info = self.last_request_info()
+        self.assertEqual(request_info.path, '/item_update/24')
+        self.assertEqual(request_info.method, 'PUT')
+        self.assertEqual(json.loads(request_info.body), payload)
+        self.assertEqual(request_info.total_queries, 1)
         return response
 
     def delete_api(self):
@@ -123,11 +201,1372 @@ class TestSQLTap(unittest.TestCase):
 
 
     def tearDown(self):
-        """Clean up the database"""
+        get_profiler(self.app).writer.flush(timeout=5)
+        super().tearDown()
+
+
+class TestDashboardExclusion(ProfilerTestCase):
+
+    def test_dashboard_routes_not_profiled(self):
+        """The dashboard router's routes are skipped under any prefix; the application's own routes are not."""
+        store = MemoryStore()
+        app = FastAPI()
+        app.add_middleware(SQLProfilerMiddleware, engine=engine, store=store)
+        app.include_router(router, prefix="/profiler")
+
+        @app.get("/export")
+        def export():
+            return {}
+
+        client = TestClient(app)
+        self.assertEqual(client.get("/profiler/all_request").status_code, 200)
+        client.get("/profiler/regressions")
+        client.post("/profiler/baselines/test-v1")
+        client.get("/favicon.ico")
+        client.get("/export")
+        self.assertEqual([request_record.path for request_record in store.list_requests()[0]], ["/export"])
+
+
+class TestConcurrentCapture(ProfilerTestCase):
+
+    def setUp(self):
+        self.app = FastAPI()
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, flush_interval=0.01)
+        self.Session = sessionmaker(bind=engine)
+
+        @self.app.get("/async_queries")
+        async def async_queries():
+            for _ in range(3):
+                with engine.connect() as conn:
+                    conn.execute(text("SELECT 1"))
+                await asyncio.sleep(0.01)
+            return {}
+
+        @self.app.get("/sync_queries")
+        def sync_queries():
+            for _ in range(2):
+                with engine.connect() as conn:
+                    conn.execute(text("SELECT 1"))
+                time.sleep(0.01)
+            return {}
+
+    async def run_concurrently(self):
+        transport = httpx.ASGITransport(app=self.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            paths = ["/async_queries", "/sync_queries"] * 5
+            return await asyncio.gather(*(client.get(path) for path in paths))
+
+    def test_queries_attributed_to_their_request(self):
+        """Concurrent async and threadpool requests only record their own queries."""
+        responses = asyncio.run(self.run_concurrently())
+        self.assertTrue(all(response.status_code == 200 for response in responses))
+        get_profiler(self.app).writer.flush(timeout=5)
+        session = self.Session()
+        request_infos = session.query(RequestInfo).all()
+        session.close()
+        self.assertEqual(len(request_infos), 10)
+        for request_info in request_infos:
+            expected = 3 if request_info.path == "/async_queries" else 2
+            self.assertEqual(request_info.total_queries, expected)
+
+    def test_listeners_installed_once(self):
+        """Profiling sessions do not add or remove engine listeners."""
+        install_listeners(engine)
+        handler = SessionHandler(engine)
+        handler.start()
+        handler.stop()
+        self.assertEqual(len(engine.dispatch.before_execute), 1)
+        self.assertEqual(len(engine.dispatch.before_cursor_execute), 1)
+        self.assertEqual(len(engine.dispatch.after_cursor_execute), 1)
+
+
+class TestAsyncEngine(ProfilerTestCase):
+
+    async def run_concurrently(self):
+        from sqlalchemy.ext.asyncio import create_async_engine
+        async_engine = create_async_engine("sqlite+aiosqlite://")
+        store = MemoryStore()
+        app = FastAPI()
+        app.add_middleware(SQLProfilerMiddleware, engine=async_engine, store=store)
+        app.include_router(router)
+
+        @app.get("/async_engine/{count}")
+        async def async_engine_queries(count: int):
+            async with async_engine.connect() as conn:
+                for _ in range(count):
+                    await conn.execute(text("SELECT 1"))
+                    await asyncio.sleep(0.01)
+            return {}
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            responses = await asyncio.gather(*(client.get("/async_engine/%d" % (index % 3 + 1))
+                                               for index in range(9)))
+            dashboard = await client.get("/all_request")
+        await async_engine.dispose()
+        return store, responses, dashboard
+
+    def test_async_engine_queries_attributed_to_their_request(self):
+        """AsyncEngine queries are recorded per request, with the awaiting application frames."""
+        store, responses, dashboard = asyncio.run(self.run_concurrently())
+        self.assertTrue(all(response.status_code == 200 for response in responses))
+        self.assertEqual(dashboard.status_code, 200)
+        request_records, _, _ = store.list_requests(limit=20)
+        self.assertEqual(len(request_records), 9)
+        for request_record in request_records:
+            self.assertEqual(request_record.total_queries, int(request_record.path.rsplit("/", 1)[1]))
+        query = request_records[0].queries[0]
+        self.assertIn("async_engine_queries", [name for _, _, name in query.stack])
+
+
+class TestQueryTiming(ProfilerTestCase):
+
+    def setUp(self):
+        self.store = MemoryStore()
+        self.app = FastAPI()
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, store=self.store, capture_params=True)
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE IF NOT EXISTS timing_user (name VARCHAR, password VARCHAR)"))
+
+        @self.app.get("/timing")
+        def timing():
+            with engine.begin() as conn:
+                conn.execute(text("INSERT INTO timing_user (name, password) VALUES (:name, :password)"),
+                             [{"name": "user%d" % index, "password": "hunter2"} for index in range(4)])
+                conn.execute(text("UPDATE timing_user SET name = :name WHERE password = :password"),
+                             {"name": "renamed", "password": "hunter2"})
+            return {}
+
+    def test_cursor_level_fields(self):
+        """Queries record driver and compile time, row counts, batch size and redacted parameters."""
+        TestClient(self.app).get("/timing")
+        request_record = self.store.list_requests()[0][0]
+        insert_query, update_query = self.store.get_queries(request_record.id)
+        self.assertEqual(insert_query.batch_size, 4)
+        self.assertEqual(update_query.batch_size, 1)
+        self.assertEqual(update_query.rowcount, 4)
+        for query in (insert_query, update_query):
+            self.assertGreater(query.time_taken, 0)
+            self.assertGreaterEqual(query.compile_time, 0)
+            self.assertIn("<redacted>", query.params)
+            self.assertNotIn("hunter2", query.params)
+        self.assertIn("'name': 'renamed'", update_query.params)
+
+    def test_statement_cache(self):
+        """Repeated statements reuse the cached text and fingerprint of their compiled object."""
+        client = TestClient(self.app)
+        client.get("/timing")
+        statement_cache = get_profiler(self.app).statement_cache
+        self.assertEqual(statement_cache.stats(), {"size": 2, "hits": 0, "misses": 2})
+        client.get("/timing")
+        self.assertEqual(statement_cache.stats(), {"size": 2, "hits": 2, "misses": 2})
+        request_record = self.store.list_requests()[0][0]
+        self.assertTrue(self.store.get_queries(request_record.id)[1].query.startswith("UPDATE timing_user"))
+        statement_cache.maxsize = 1
+        statement_cache.lookup(None, "SELECT 1")
+        self.assertEqual(statement_cache.stats()["size"], 1)
+
+    def tearDown(self):
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE timing_user"))
+        super().tearDown()
+
+
+class TestBodyCapture(ProfilerTestCase):
+
+    def setUp(self):
+        self.app = FastAPI()
+        self.Session = sessionmaker(bind=engine)
+
+        @self.app.post("/echo_size")
+        async def echo_size(request: Request):
+            return {"size": len(await request.body())}
+
+        @self.app.get("/stream")
+        def stream():
+            return StreamingResponse(iter([b"chunk-%d;" % i for i in range(100)]))
+
+        @self.app.post("/upload")
+        async def upload(request: Request):
+            form = await request.form()
+            return {"fields": sorted(form.keys())}
+
+    def captured(self, client, method, path, **kwargs):
+        response = client.request(method, path, **kwargs)
+        get_profiler(self.app).writer.flush(timeout=5)
+        session = self.Session()
+        request_info = session.query(RequestInfo).order_by(-RequestInfo.id).first()
+        session.close()
+        return response, request_info
+
+    def test_body_capture_is_capped(self):
+        """The application receives the full body while only max_body_size bytes are recorded."""
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, flush_interval=0.01, max_body_size=10)
+        payload = {"name": "x" * 1000}
+        response, request_info = self.captured(TestClient(self.app), "POST", "/echo_size", json=payload)
+        self.assertEqual(response.json()["size"], len(json.dumps(payload)))
+        self.assertEqual(request_info.body, json.dumps(payload)[:10])
+
+    def test_streaming_response_passthrough(self):
+        """Streaming responses reach the client unchanged."""
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, flush_interval=0.01)
+        response, request_info = self.captured(TestClient(self.app), "GET", "/stream")
+        self.assertEqual(response.content, b"".join(b"chunk-%d;" % i for i in range(100)))
+        self.assertEqual(request_info.path, "/stream")
+        self.assertEqual(request_info.body, "")
+
+    def test_multipart_parsed_on_demand(self):
+        """Multipart bodies are only parsed into fields when parse_multipart is set."""
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, flush_interval=0.01, parse_multipart=True)
+        response, request_info = self.captured(TestClient(self.app), "POST", "/upload",
+                                               data={"title": "report"}, files={"file": ("a.txt", b"hello")})
+        self.assertEqual(response.json()["fields"], ["file", "title"])
+        self.assertIn("'title': 'report'", request_info.body)
+        self.assertIn("a.txt", request_info.raw_body)
+
+
+class TestSampling(ProfilerTestCase):
+
+    def setUp(self):
+        self.app = FastAPI()
+        self.Session = sessionmaker(bind=engine)
+
+        @self.app.get("/queries/{count}")
+        def queries(count: int):
+            with engine.connect() as conn:
+                for _ in range(count):
+                    conn.execute(text("SELECT 1"))
+            return {}
+
+    def test_rate_lookup(self):
+        """Path prefixes take precedence over methods, which take precedence over the default rate."""
+        sampler = Sampler(rate=0.5, path_rates={"/api": 0, "/api/orders": 1}, method_rates={"post": 0.25})
+        self.assertEqual(sampler.rate_for("GET", "/api/orders/1"), 1)
+        self.assertEqual(sampler.rate_for("GET", "/api/users"), 0)
+        self.assertEqual(sampler.rate_for("POST", "/other"), 0.25)
+        self.assertEqual(sampler.rate_for("GET", "/other"), 0.5)
+        self.assertFalse(sampler.tail_enabled)
+
+    def test_tail_rules_keep_only_slow_requests(self):
+        """With a zero head rate, only requests matching a tail rule are persisted."""
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, flush_interval=0.01,
+                                sampler=Sampler(rate=0, min_queries=3))
+        client = TestClient(self.app)
+        client.get("/queries/1")
+        client.get("/queries/5")
+        profiler = get_profiler(self.app)
+        profiler.writer.flush(timeout=5)
+        session = self.Session()
+        request_infos = session.query(RequestInfo).all()
+        session.close()
+        self.assertEqual([request_info.path for request_info in request_infos], ["/queries/5"])
+        self.assertEqual(profiler.sampled_out, 1)
+
+    def test_unsampled_requests_are_not_captured(self):
+        """Without tail rules, requests outside the head sample are passed straight through."""
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, flush_interval=0.01,
+                                sampler=Sampler(rate=0))
+        TestClient(self.app).get("/queries/2")
+        profiler = get_profiler(self.app)
+        self.assertEqual(profiler.writer.enqueued, 0)
+        self.assertEqual(profiler.sampled_out, 0)
+
+    def test_unsampled_requests_are_counted(self):
+        """Requests outside the head sample are counted in the metrics and baselines with their queries."""
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, flush_interval=0.01,
+                                sampler=Sampler(rate=0))
+        client = TestClient(self.app)
+        client.get("/queries/2")
+        client.get("/queries/3")
+        profiler = get_profiler(self.app)
+        self.assertEqual(profiler.writer.enqueued, 0)
+        route_metrics = profiler.metrics.routes[("/queries/{count}", "GET")]
+        self.assertEqual(route_metrics.queries.count, 2)
+        self.assertEqual(route_metrics.queries.sum, 5)
+        self.assertEqual(route_metrics.latency.count, 2)
+        stats = profiler.baselines.snapshot()[("/queries/{count}", "GET")]
+        self.assertEqual(stats.count, 2)
+        profiler.close()
+
+
+class TestStackCapture(ProfilerTestCase):
+
+    def setUp(self):
+        self.app = FastAPI()
+        self.app.include_router(router)
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, flush_interval=0.01)
+        self.Session = sessionmaker(bind=engine)
+
+        @self.app.get("/repeat")
+        def repeat():
+            with engine.connect() as conn:
+                for _ in range(3):
+                    conn.execute(text("SELECT 1"))
+            return {}
+
+    def test_application_frames_only(self):
+        """Only application frames are kept, innermost last."""
+        frames = StackCapture().capture()
+        self.assertEqual(frames[-1][2], "test_application_frames_only")
+        self.assertTrue(all(not frame[0].startswith(sys.prefix) for frame in frames))
+        self.assertEqual(len(StackCapture(max_depth=1).capture()), 1)
+
+    def test_identical_stacks_stored_once(self):
+        """Queries issued from one call site share a single stored stack, formatted on display."""
+        client = TestClient(self.app)
+        client.get("/repeat")
+        get_profiler(self.app).writer.flush(timeout=5)
+        session = self.Session()
+        query_infos = session.query(QueryInfo).all()
+        self.assertEqual(len(query_infos), 3)
+        self.assertEqual(len({query_info.stack_key for query_info in query_infos}), 1)
+        self.assertEqual(session.query(StackInfo).count(), 1)
+        session.close()
+        response = client.get("/request_query_details/%d" % query_infos[0].id)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("conn.execute(text(&#34;SELECT 1&#34;))", response.text)
+
+
+class TestStatementStats(ProfilerTestCase):
+
+    def setUp(self):
+        self.app = FastAPI()
+        self.app.include_router(router)
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, flush_interval=0.01)
+        self.Session = sessionmaker(bind=engine)
+
+        @self.app.get("/lookup")
+        def lookup():
+            with engine.connect() as conn:
+                for value in range(3):
+                    conn.execute(text("SELECT %d WHERE 1 IN (1, 2, %d)" % (value, value)))
+            return {}
+
+    def test_normalize(self):
+        """Literals, parameters and IN lists are collapsed."""
+        self.assertEqual(normalize("SELECT * FROM t WHERE a = 'x' AND b IN (1, 2, 3) AND c = :c_1"),
+                         "SELECT * FROM t WHERE a = ? AND b IN (...) AND c = ?")
+        self.assertEqual(normalize("INSERT INTO t (a) VALUES (?), (?), (?)"), "INSERT INTO t (a) VALUES (?)")
+
+    def test_expanding_in_displayed_as_executed(self):
+        """Expanding IN statements show the rendered parameters, under one cached fingerprint."""
+        store = MemoryStore()
+        app = FastAPI()
+        app.add_middleware(SQLProfilerMiddleware, engine=engine, store=store)
+        statement = text("SELECT 1 WHERE 1 IN :ids").bindparams(bindparam("ids", expanding=True))
+
+        @app.get("/expanding")
+        def expanding(size: int):
+            with engine.connect() as conn:
+                conn.execute(statement, {"ids": list(range(size))})
+            return {}
+
+        client = TestClient(app)
+        client.get("/expanding", params={"size": 2})
+        client.get("/expanding", params={"size": 3})
+        queries = [request_record.queries[0] for request_record in reversed(store.list_requests()[0])]
+        self.assertEqual([query.query.count("?") for query in queries], [2, 3])
+        self.assertNotIn("POSTCOMPILE", queries[0].query)
+        self.assertEqual(queries[0].fingerprint, queries[1].fingerprint)
+
+    def test_histogram_merge(self):
+        """Histograms merge by adding bucket counts and estimate percentiles."""
+        first, second = Histogram(), Histogram()
+        for value in range(1, 51):
+            first.add(value)
+        for value in range(51, 101):
+            second.add(value)
+        merged = Histogram(first.to_dict()).merge(second)
+        self.assertEqual(merged.count, 100)
+        self.assertAlmostEqual(merged.percentile(50), 50, delta=5)
+        self.assertAlmostEqual(merged.percentile(99), 99, delta=10)
+
+    def test_statements_aggregated_across_requests(self):
+        """Executions of one statement shape accumulate into a single aggregate."""
+        client = TestClient(self.app)
+        client.get("/lookup")
+        client.get("/lookup")
+        get_profiler(self.app).writer.flush(timeout=5)
+        session = self.Session()
+        statement_infos = session.query(StatementInfo).all()
+        session.close()
+        self.assertEqual(len(statement_infos), 1)
+        self.assertEqual(statement_infos[0].statement, "SELECT ? WHERE ? IN (...)")
+        self.assertEqual(statement_infos[0].count, 6)
+        self.assertEqual(Histogram(statement_infos[0].histogram).count, 6)
+        response = client.get("/statements")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("SELECT ? WHERE ? IN (...)", response.text)
+
+    def test_concurrent_writers_add_up(self):
+        """Batches saved at once by several stores, as by several worker processes, all count."""
+        def save_batches():
+            store = SQLStore()
+            for _ in range(10):
+                store.save([make_record("/concurrent", 3)])
+
+        threads = [threading.Thread(target=save_batches) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        session = self.Session()
+        statement_info = session.get(StatementInfo, "retention")
+        session.close()
+        self.assertEqual(statement_info.count, 120)
+        self.assertEqual(Histogram(statement_info.histogram).count, 120)
+
+
+class TestRepeatedQueries(ProfilerTestCase):
+
+    def setUp(self):
+        self.app = FastAPI()
+        self.app.include_router(router)
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, flush_interval=0.01)
+        self.Session = sessionmaker(bind=engine)
+
+        @self.app.get("/n_plus_one")
+        def n_plus_one():
+            with engine.connect() as conn:
+                for value in range(4):
+                    conn.execute(text("SELECT :value"), {"value": value})
+                conn.execute(text("SELECT 'once'"))
+                conn.execute(text("SELECT 'once'"))
+            return {}
+
+    def test_repeats_recorded_on_request(self):
+        """N+1 patterns and exact duplicates are counted while queries are captured."""
+        client = TestClient(self.app)
+        client.get("/n_plus_one")
+        get_profiler(self.app).writer.flush(timeout=5)
         session = self.Session()
-        session.execute(text('DELETE FROM item'))
-        session.execute(text('DELETE FROM middleware_query'))
-        session.execute(text('DELETE FROM middleware_requests'))
+        request_info = session.query(RequestInfo).one()
+        session.close()
+        self.assertEqual(request_info.total_queries, 6)
+        self.assertEqual(request_info.n_plus_one, 1)
+        self.assertEqual(request_info.repeated_queries, 3)
+        self.assertEqual(request_info.duplicate_queries, 1)
+        self.assertGreater(request_info.wasted_time, 0)
+        response = client.get("/all_request?sort=repeated&repeated=true")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("/n_plus_one", response.text)
+
+    def test_executemany_not_flagged_as_duplicate(self):
+        """Identical executemany batches count in their group but are not compared parameter by parameter."""
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE repeat_item (value INTEGER)"))
+        handler = SessionHandler(engine)
+        handler.start()
+        try:
+            with engine.begin() as conn:
+                for _ in range(2):
+                    conn.execute(text("INSERT INTO repeat_item (value) VALUES (:value)"),
+                                 [{"value": 1}, {"value": 1}])
+        finally:
+            handler.stop()
+            with engine.begin() as conn:
+                conn.execute(text("DROP TABLE repeat_item"))
+        self.assertEqual([query_obj["batch_size"] for query_obj in handler.query_objs], [2, 2])
+        self.assertEqual(handler.repeats()["duplicate_queries"], 0)
+
+
+def load_user(conn, user_id):
+    """Issue a query from a call site of its own."""
+    return conn.execute(text("SELECT :user_id"), {"user_id": user_id}).scalar()
+
+
+class TestHotspots(ProfilerTestCase):
+
+    def setUp(self):
+        self.app = FastAPI()
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, flush_interval=0.01)
+        self.app.include_router(router)
+
+        @self.app.get("/hotspot_users")
+        def hotspot_users():
+            with engine.connect() as conn:
+                for user_id in range(3):
+                    load_user(conn, user_id)
+                conn.execute(text("SELECT 2"))
+            return {}
+
+    def test_call_sites_and_tree(self):
+        """Queries are aggregated by innermost application line and merged into a call tree."""
+        client = TestClient(self.app)
+        client.get("/hotspot_users")
+        client.get("/hotspot_users")
+        get_profiler(self.app).writer.flush(timeout=5)
+        store = SQLStore()
+        call_sites = {call_site.function: call_site for call_site in store.top_call_sites()}
+        self.assertEqual(call_sites["load_user"].count, 6)
+        self.assertEqual(len(call_sites["load_user"].statements), 1)
+        self.assertEqual(call_sites["hotspot_users"].count, 2)
+        call_tree = build_call_tree(store.top_call_paths())
+        self.assertEqual(call_tree["count"], 8)
+        endpoint = call_tree["children"][0]
+        self.assertEqual(endpoint["frame"][2], "hotspot_users")
+        self.assertEqual([child["frame"][2] for child in endpoint["children"]], ["load_user"])
+        self.assertEqual(endpoint["children"][0]["count"], 6)
+        response = client.get("/hotspots")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("load_user", response.text)
+        self.assertIn("test_sql_profiler.py", response.text)
+
+    def test_concurrent_writers_add_up(self):
+        """Call site and call path counts saved at once by several stores all count."""
+        frames = (("app.py", 1, "outer"), ("app.py", 2, "inner"))
+
+        def save_batches():
+            store = SQLStore()
+            for _ in range(10):
+                record = make_record("/concurrent", 3)
+                for query_obj in record["queries"]:
+                    query_obj["stack"] = frames
+                store.save([record])
+
+        threads = [threading.Thread(target=save_batches) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        store = SQLStore()
+        self.assertEqual({call_site.function: call_site.count for call_site in store.top_call_sites()},
+                         {"inner": 120})
+        self.assertEqual([call_path.count for call_path in store.top_call_paths()], [120])
+
+    def test_build_call_tree(self):
+        """Paths sharing a prefix are merged and children are sorted by time."""
+        outer, first, second = ("app.py", 1, "outer"), ("app.py", 2, "first"), ("app.py", 3, "second")
+        paths = [CallPathStats((outer, first)), CallPathStats((outer, second)), CallPathStats((outer,))]
+        for call_path, time_taken in zip(paths, (1.0, 3.0, 0.5)):
+            call_path.add(time_taken)
+        call_tree = build_call_tree(paths)
+        (root,) = call_tree["children"]
+        self.assertEqual((root["total_time"], root["self_time"], root["count"]), (4.5, 0.5, 3))
+        self.assertEqual([child["frame"] for child in root["children"]], [second, first])
+
+
+class TestRequestPagination(ProfilerTestCase):
+
+    def setUp(self):
+        self.app = FastAPI()
+        self.app.include_router(router)
+        self.store = SQLStore()
+        set_store(self.store)
+        self.Session = sessionmaker(bind=engine)
+        session = self.Session()
+        for index in range(25):
+            session.add(RequestInfo(path="/orders/%d" % index if index % 2 else "/users", method="GET",
+                                    time_taken=float(index % 5), total_queries=index,
+                                    start_time=datetime.datetime(2026, 1, 1, 0, index)))
+        session.commit()
+        session.close()
+
+    def walk(self, sort, **filters):
+        """Follow `before` cursors through every page and return the visited rows."""
+        rows, cursor = [], None
+        while True:
+            page, has_previous, has_next = self.store.list_requests(sort, 4, before=cursor, **filters)
+            rows.extend(page)
+            self.assertEqual(has_previous, cursor is not None)
+            if not has_next:
+                break
+            cursor = page_cursor(page[-1], REQUEST_SORTS[sort])
+        return rows
+
+    def test_keyset_pages_cover_every_row_once(self):
+        """Pages follow the sort order without gaps or repeats, including ties."""
+        rows = self.walk("slowest")
+        self.assertEqual(len({row.id for row in rows}), 25)
+        keys = [(row.time_taken, row.id) for row in rows]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    def test_previous_page(self):
+        """An `after` cursor returns the page preceding a row, in display order."""
+        first, _, _ = self.store.list_requests("recent", 4)
+        second, _, _ = self.store.list_requests("recent", 4, before=page_cursor(first[-1], "id"))
+        previous, has_previous, has_next = self.store.list_requests("recent", 4, after=page_cursor(second[0], "id"))
+        self.assertEqual([row.id for row in previous], [row.id for row in first])
+        self.assertFalse(has_previous)
+        self.assertTrue(has_next)
+
+    def test_filters(self):
+        """Filters are applied in SQL."""
+        rows = self.walk("recent", path="/orders", min_queries=10,
+                         start=datetime.datetime(2026, 1, 1, 0, 0), end=datetime.datetime(2026, 1, 1, 0, 20))
+        self.assertEqual(sorted(row.total_queries for row in rows), [11, 13, 15, 17, 19])
+        response = TestClient(self.app).get("/all_request?path=/orders&min_time=4&sort=slowest&limit=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("2 requests", response.text)
+        self.assertIn("before=4.0:20", response.text.replace("%3A", ":"))
+
+    def test_form_with_blank_fields(self):
+        """The filter form sends its blank fields, which mean no filter; invalid values are rejected."""
+        client = TestClient(self.app)
+        response = client.get("/all_request", params={
+            "sort": "recent", "limit": 20, "path": "/orders", "method": "", "min_time": "", "min_queries": "",
+            "start": "", "end": "2026-01-01T00:20:00"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("10 requests", response.text)
+        self.assertEqual(client.get("/all_request", params={"min_time": "abc"}).status_code, 400)
+
+    def test_invalid_cursor(self):
+        """A malformed page cursor is a client error, not a server error."""
+        client = TestClient(self.app)
+        for cursor in ("abc", "1.5:x", "12"):
+            self.assertEqual(client.get("/all_request", params={"before": cursor}).status_code, 400)
+            self.assertEqual(client.get("/all_request", params={"after": cursor}).status_code, 400)
+
+    def test_page_size_bounded(self):
+        """Page sizes outside 1 to MAX_PAGE_SIZE are rejected instead of reaching the store."""
+        client = TestClient(self.app)
+        for url in ("/all_request", "/statements", "/hotspots", "/regressions"):
+            for limit in (0, -1, 501):
+                self.assertEqual(client.get(url, params={"limit": limit}).status_code, 422, (url, limit))
+        self.assertEqual(client.get("/all_request", params={"limit": 500}).status_code, 200)
+        self.assertEqual(client.get("/hotspots", params={"paths": 0}).status_code, 422)
+
+
+class TestMemoryStore(ProfilerTestCase):
+
+    def setUp(self):
+        self.store = MemoryStore(capacity=3)
+        self.app = FastAPI()
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, store=self.store)
+        self.app.include_router(router)
+        self.Session = sessionmaker(bind=engine)
+
+        @self.app.get("/users/{user_id}")
+        def user(user_id: int):
+            session = self.Session()
+            session.execute(text("SELECT :user_id"), {"user_id": user_id})
+            session.close()
+            return {}
+
+    def test_ring_buffer_evicts_oldest(self):
+        """Only the last `capacity` requests and their queries are kept."""
+        client = TestClient(self.app)
+        for user_id in range(5):
+            client.get("/users/%d" % user_id)
+        self.assertIsNone(get_profiler(self.app).writer)
+        self.assertEqual(self.store.count_requests(), 3)
+        rows, has_previous, has_next = self.store.list_requests("recent", 2)
+        self.assertEqual([row.path for row in rows], ["/users/4", "/users/3"])
+        self.assertFalse(has_previous)
+        self.assertTrue(has_next)
+        rows, _, has_next = self.store.list_requests("recent", 2, before=page_cursor(rows[-1], "id"))
+        self.assertEqual([row.path for row in rows], ["/users/2"])
+        self.assertFalse(has_next)
+        self.assertIsNone(self.store.get_request(1))
+        self.assertEqual(self.store.get_queries(1), [])
+        self.assertEqual(self.store.top_statements()[0].count, 5)
+
+    def test_dashboard_reads_from_memory(self):
+        """Profiled requests are served by the dashboard without touching the profiler tables."""
+        client = TestClient(self.app)
+        client.get("/users/1")
+        session = self.Session()
+        self.assertEqual(session.query(RequestInfo).count(), 0)
+        session.close()
+        request_record = self.store.list_requests()[0][0]
+        query = self.store.get_queries(request_record.id)[0]
+        self.assertIn("/users/1", client.get("/all_request").text)
+        self.assertEqual(client.get("/request_query/%d" % request_record.id).status_code, 200)
+        response = client.get("/request_query_details/%d" % query.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("test_sql_profiler.py", response.text)
+        self.assertEqual(client.get("/statements").status_code, 200)
+        client.delete("/clear_db")
+        self.assertEqual(self.store.count_requests(), 0)
+
+
+def make_record(path, queries, start_time=None):
+    """Build a captured request record holding `queries` queries."""
+    start_time = start_time or datetime.datetime.utcnow()
+    return {
+        "path": path, "query_params": "", "raw_body": "", "body": "", "method": "GET",
+        "start_time": start_time, "end_time": start_time, "time_taken": 1.0, "headers": {},
+        "n_plus_one": 0, "repeated_queries": 0, "duplicate_queries": 0, "wasted_time": 0.0,
+        "queries": [{"time_taken": 0.1, "compile_time": 0.01, "rowcount": None, "batch_size": 1, "params": None,
+                     "text": "SELECT %d" % index, "stack": (), "statement": "SELECT ?", "fingerprint": "retention"}
+                    for index in range(queries)],
+    }
+
+
+class TestRetention(ProfilerTestCase):
+
+    def setUp(self):
+        self.Session = sessionmaker(bind=engine)
+        old = datetime.datetime.utcnow() - datetime.timedelta(days=2)
+        self.records = ([make_record("/old", 1, old) for _ in range(3)]
+                        + [make_record("/users", 2) for _ in range(4)]
+                        + [make_record("/orders", 1) for _ in range(2)])
+
+    def counts(self):
+        session = self.Session()
+        counts = (session.query(RequestInfo).count(), session.query(QueryInfo).count())
+        session.close()
+        return counts
+
+    def test_sql_store_prunes_in_batches(self):
+        """Expired requests and their queries are deleted oldest first, one bounded batch at a time."""
+        store = SQLStore()
+        store.save(self.records)
+        policy = RetentionPolicy(max_age=datetime.timedelta(days=1))
+        self.assertEqual(store.prune(policy, batch_size=2), 2)
+        self.assertEqual(store.prune(policy, batch_size=2), 1)
+        self.assertEqual(store.prune(policy, batch_size=2), 0)
+        self.assertEqual(self.counts(), (6, 10))
+        self.assertEqual(store.prune(RetentionPolicy(max_queries_per_path=5), batch_size=10), 2)
+        self.assertEqual(store.count_requests(path="/users"), 2)
+        self.assertEqual(store.prune(RetentionPolicy(max_requests=2), batch_size=10), 2)
+        rows, _, _ = store.list_requests()
+        self.assertEqual([row.path for row in rows], ["/orders", "/orders"])
+        self.assertEqual(self.counts(), (2, 2))
+
+    def test_sql_store_prunes_unused_rows(self):
+        """Stacks no query uses and aggregates not seen within max_age are deleted after the requests."""
+        store = SQLStore()
+        for index, record in enumerate(self.records):
+            for query_obj in record["queries"]:
+                query_obj["stack"] = (("app.py", index, record["path"]),)
+        store.save(self.records)
+        session = self.Session()
+        session.query(StatementInfo).update({"last_seen": datetime.datetime.utcnow() - datetime.timedelta(days=2)})
         session.commit()
+        policy = RetentionPolicy(max_age=datetime.timedelta(days=1))
+        cutoffs = store.prune_cutoffs(policy)
+        self.assertEqual(store.prune(policy, batch_size=10, cutoffs=cutoffs), 3)
+        self.assertEqual(store.prune_unused(policy, batch_size=2), 2)
+        self.assertEqual(store.prune_unused(policy, batch_size=2), 1)
+        self.assertEqual(store.prune_unused(policy, batch_size=2), 1)
+        self.assertEqual(store.prune_unused(policy, batch_size=2), 0)
+        self.assertEqual(session.query(StackInfo).count(), 6)
+        self.assertEqual(session.query(StatementInfo).count(), 0)
+        self.assertEqual(len(store.top_call_sites()), 9)
+        store.clear()
+        self.assertEqual(session.query(StackInfo).count(), 0)
+        session.close()
+
+    def test_unused_stacks_not_deleted_under_a_save(self):
+        """A stack skipped by a save because it is cached is not deleted before that save commits."""
+        store = SQLStore()
+        records = [self.records[0], make_record("/users", 1)]
+        for record in records:
+            record["queries"][0]["stack"] = (("app.py", 1, "view"),)
+        store.save(records[:1])
+        policy = RetentionPolicy(max_age=datetime.timedelta(days=1))
+        self.assertEqual(store.prune(policy), 1)
+        entered = threading.Event()
+        release = threading.Event()
+        save_statements = store._save_statements
+
+        def blocked_save_statements(db, stats):
+            entered.set()
+            release.wait(5)
+            save_statements(db, stats)
+        with unittest.mock.patch.object(store, "_save_statements", blocked_save_statements):
+            saving = threading.Thread(target=store.save, args=(records[1:],))
+            saving.start()
+            self.assertTrue(entered.wait(5))
+            pruning = threading.Thread(target=store.prune_unused, args=(policy,))
+            pruning.start()
+            time.sleep(0.2)
+            release.set()
+            saving.join(5)
+            pruning.join(5)
+        session = self.Session()
+        stack_key = session.query(QueryInfo.stack_key).scalar()
+        self.assertIsNotNone(stack_key)
+        self.assertEqual(session.query(StackInfo).filter(StackInfo.key == stack_key).count(), 1)
+        session.close()
+
+    def test_cutoffs_read_once_per_pass(self):
+        """The per-path limits are computed once and the batches of a pass only delete below them."""
+        store = SQLStore()
+        store.save(self.records)
+        policy = RetentionPolicy(max_queries_per_path=5)
+        cutoffs = store.prune_cutoffs(policy)
+        self.assertEqual(list(cutoffs["paths"]), ["/users"])
+        store.save([make_record("/users", 2) for _ in range(4)])
+        self.assertEqual(store.prune(policy, batch_size=1, cutoffs=cutoffs), 1)
+        self.assertEqual(store.prune(policy, batch_size=1, cutoffs=cutoffs), 1)
+        self.assertEqual(store.prune(policy, batch_size=1, cutoffs=cutoffs), 0)
+        self.assertEqual(cutoffs["paths"], {})
+        self.assertEqual(store.count_requests(path="/users"), 6)
+
+    def test_memory_store_prunes(self):
+        """The in-memory store enforces the same limits."""
+        store = MemoryStore()
+        store.save(self.records)
+        self.assertEqual(store.prune(RetentionPolicy(max_age=3600), batch_size=2), 2)
+        self.assertEqual(store.prune(RetentionPolicy(max_age=3600, max_queries_per_path=5)), 3)
+        self.assertEqual(store.count_requests(), 4)
+        self.assertEqual(store.prune(RetentionPolicy(max_requests=2)), 2)
+        self.assertEqual([row.path for row in store.list_requests()[0]], ["/orders", "/orders"])
+        self.assertEqual(len(store._queries_by_id), 2)
+
+    def test_pruner_thread(self):
+        """The pruner deletes every expired batch in the background."""
+        SQLStore().save(self.records)
+        pruner = Pruner(SQLStore(), RetentionPolicy(max_requests=4), batch_size=2, pause=0, interval=60)
+        pruner.start()
+        deadline = time.monotonic() + 5
+        while pruner.runs == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        pruner.stop(timeout=5)
+        self.assertEqual(pruner.deleted, 5)
+        self.assertEqual(pruner.errors, 0)
+        self.assertEqual(self.counts()[0], 4)
+
+
+class TestExport(ProfilerTestCase):
+
+    def setUp(self):
+        self.app = FastAPI()
+        self.app.include_router(router)
+        old = datetime.datetime(2026, 1, 1)
+        self.records = [make_record("/old", 1, old), make_record("/users", 2), make_record("/empty", 0)]
+
+    def test_streams_ndjson(self):
+        """Requests are exported joined with their queries, one JSON object per line."""
+        store = SQLStore()
+        store.save(self.records)
+        set_store(store)
+        response = TestClient(self.app).get("/export", params={"start": "2026-01-02T00:00:00"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("application/x-ndjson"))
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([(row["path"], row["query"]) for row in rows],
+                         [("/users", "SELECT 0"), ("/users", "SELECT 1"), ("/empty", None)])
+        self.assertEqual(rows[0]["time_taken"], 0.1)
+        self.assertEqual(len(list(store.export(batch_size=1))), 4)
+
+    def test_streams_csv(self):
+        """The CSV export starts with a header and applies the filters."""
+        store = MemoryStore()
+        store.save(self.records)
+        set_store(store)
+        client = TestClient(self.app)
+        response = client.get("/export", params={"format": "csv", "path": "/old"})
+        self.assertTrue(response.headers["content-type"].startswith("text/csv"))
+        lines = response.text.splitlines()
+        self.assertTrue(lines[0].startswith("request_id,path,method,start_time"))
+        self.assertEqual(len(lines), 2)
+        self.assertIn("/old,GET,2026-01-01T00:00:00", lines[1])
+        self.assertEqual(client.get("/export", params={"format": "xml"}).status_code, 400)
+
+
+class TestSpool(ProfilerTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.Session = sessionmaker(bind=engine)
+
+    def count(self):
+        session = self.Session()
+        total = session.query(RequestInfo).count()
         session.close()
+        return total
+
+    def test_spooled_records_are_collected(self):
+        """Workers append to spool files and the collector bulk-loads complete lines once."""
+        store = SpoolStore(self.directory, collect=False)
+        app = FastAPI()
+        app.add_middleware(SQLProfilerMiddleware, engine=engine, store=store, flush_interval=0.01)
+
+        @app.get("/spooled")
+        def spooled():
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            return {}
+
+        client = TestClient(app)
+        for _ in range(3):
+            client.get("/spooled")
+        get_profiler(app).writer.flush(timeout=5)
+        self.assertEqual(self.count(), 0)
+        active = [name for name in os.listdir(self.directory) if name.endswith(".active")]
+        self.assertEqual(len(active), 1)
+        # A worker which exited in the middle of a write.
+        with open(os.path.join(self.directory, "999999999-1.active"), "wb") as spool_file:
+            spool_file.write(encode_record(make_record("/exited", 1)) + b'{"path": "/partial"')
+
+        collector = SpoolCollector(self.directory, store, batch_size=2)
+        self.assertEqual(collector.collect(), 4)
+        self.assertEqual(collector.collect(), 0)
+        self.assertEqual(collector.errors, 1)
+        self.assertEqual(collector.files, 1)
+        self.assertEqual(self.count(), 4)
+        query = store.get_queries(store.list_requests(path="/spooled")[0][0].id)[0]
+        self.assertTrue(store.get_stack(query))
+
+        store.save([make_record("/sealed", 1)])
+        store.close()
+        restarted = SpoolCollector(self.directory, store)
+        self.assertEqual(restarted.collect(), 1)
+        self.assertEqual(restarted.files, 1)
+        self.assertEqual(self.count(), 5)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_single_collector_per_directory(self):
+        """Only the first process taking the directory lock runs the collector thread, until it exits."""
+        first = SpoolStore(self.directory, collect_interval=0.01)
+        second = SpoolStore(self.directory, collect_interval=0.01)
+        first.save([make_record("/first", 1)])
+        second.save([make_record("/second", 1)])
+        self.assertIsNotNone(first.collector)
+        self.assertIsNone(second.collector)
+        deadline = time.monotonic() + 5
+        while first.collector.loaded < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        first.close()
+        time.sleep(0.02)
+        second.save([make_record("/second", 1)])
+        self.assertIsNotNone(second.collector)
+        second.close()
+        self.assertEqual(self.count(), 3)
+
+    def test_offset_stored_with_batch(self):
+        """A collector restarted after a failed batch resumes after the last batch stored."""
+        store = SpoolStore(self.directory, collect=False)
+        store.save([make_record("/spooled", 1) for _ in range(3)])
+        store.close()
+        failing = SpoolCollector(self.directory, store, batch_size=2)
+        with unittest.mock.patch.object(store, "_save_statements", side_effect=[None, RuntimeError("disk full")]):
+            failing.collect()
+        self.assertEqual((self.count(), failing.loaded, failing.errors), (2, 2, 1))
+        restarted = SpoolCollector(self.directory, store, batch_size=2)
+        self.assertEqual(restarted.collect(), 1)
+        self.assertEqual(self.count(), 3)
+        self.assertEqual(os.listdir(self.directory), [])
+        session = self.Session()
+        self.assertEqual(session.query(SpoolOffsetInfo).count(), 0)
+        session.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+
+class TestMetrics(ProfilerTestCase):
+
+    def setUp(self):
+        self.app = FastAPI()
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, store=MemoryStore())
+        self.app.include_router(router)
+
+        @self.app.get("/metric_users/{user_id}")
+        def metric_user(user_id: int):
+            with engine.connect() as conn:
+                for _ in range(user_id):
+                    conn.execute(text("SELECT 1"))
+            return {}
+
+    def test_route_histograms(self):
+        """Requests are aggregated per route template and method and exposed in the Prometheus format."""
+        client = TestClient(self.app)
+        client.get("/metric_users/1")
+        client.get("/metric_users/3")
+        client.get("/missing")
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain; version=0.0.4"))
+        labels = 'route="/metric_users/{user_id}",method="GET"'
+        self.assertIn("# TYPE sql_profiler_request_duration_seconds histogram", response.text)
+        self.assertIn("sql_profiler_request_queries_count{%s} 2" % labels, response.text)
+        self.assertIn("sql_profiler_request_queries_sum{%s} 4" % labels, response.text)
+        self.assertIn('sql_profiler_request_queries_bucket{%s,le="1.0"} 1' % labels, response.text)
+        self.assertIn('sql_profiler_request_queries_bucket{%s,le="+Inf"} 2' % labels, response.text)
+        self.assertIn('sql_profiler_request_db_duration_seconds_count{%s} 2' % labels, response.text)
+        self.assertIn('route="<unmatched>",method="GET"', response.text)
+        self.assertNotIn('route="/metrics"', client.get("/metrics").text)
+
+    def test_mounted_routes_keep_their_prefix(self):
+        """Routes of a sub-application mounted twice are told apart by their mount prefix."""
+        items = FastAPI()
+
+        @items.get("/items/{item_id}")
+        def item(item_id: int):
+            return {}
+        self.app.mount("/v1", items)
+        self.app.mount("/v2", items)
+        client = TestClient(self.app, root_path="/api")
+        client.get("/api/v1/items/1")
+        client.get("/api/v2/items/2")
+        client.get("/api/v2/items/3")
+        text_metrics = client.get("/api/metrics").text
+        self.assertIn('sql_profiler_request_queries_count{route="/v1/items/{item_id}",method="GET"} 1',
+                      text_metrics)
+        self.assertIn('sql_profiler_request_queries_count{route="/v2/items/{item_id}",method="GET"} 2',
+                      text_metrics)
+        self.assertNotIn('route="/items/{item_id}"', text_metrics)
+
+
+class TestExplainCapture(ProfilerTestCase):
+
+    def setUp(self):
+        self.store = MemoryStore()
+        self.app = FastAPI()
+        self.app.add_middleware(SQLProfilerMiddleware, engine=engine, store=self.store, explain_slow_ms=0)
+        self.app.include_router(router)
+
+        @self.app.get("/explained")
+        def explained(path: str):
+            with engine.connect() as conn:
+                conn.execute(text("SELECT id FROM middleware_requests WHERE path = :path"), {"path": path}).all()
+            return {}
+
+    def test_plans_slow_statements_once_per_shape(self):
+        """Slow statements are explained off the request path, once per shape, and shown with the query."""
+        client = TestClient(self.app)
+        client.get("/explained", params={"path": "/a"})
+        client.get("/explained", params={"path": "/b"})
+        explain_capture = get_profiler(self.app).explain_capture
+        self.assertTrue(explain_capture.flush(timeout=5))
+        self.assertEqual(explain_capture.submitted, 1)
+        self.assertEqual(explain_capture.explained, 1)
+
+        query = self.store.get_queries(1)[0]
+        plan_info = self.store.get_plan(query.fingerprint)
+        self.assertIn("middleware_requests", plan_info.plan)
+        self.assertIn("USING", plan_info.plan)
+        response = client.get("/request_query_details/%d" % query.id)
+        self.assertIn("Query Plan", response.text)
+        self.assertIn("middleware_requests", response.text)
+        explain_capture.stop(timeout=5)
+
+    def test_concurrent_submits_never_raise(self):
+        """Statements submitted from many threads while the queue is full are dropped without raising."""
+        explain_capture = ExplainCapture(engine, self.store, maxsize=1)
+        errors = []
+
+        def submit(thread_index):
+            try:
+                for index in range(2000):
+                    explain_capture.submit("%d-%d" % (thread_index, index % 5), "SELECT 1", ())
+            except Exception as error:
+                errors.append(error)
+        with unittest.mock.patch.object(ExplainCapture, "start"), \
+                unittest.mock.patch("fastapi_sql_profiler.explain.MAX_SHAPES", 3):
+            threads = [threading.Thread(target=submit, args=(index,)) for index in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(explain_capture.submitted, 1)
+        self.assertGreater(explain_capture.dropped, 0)
+
+
+class TestDatabaseInit(ProfilerTestCase):
+
+    def test_lazy_initialization(self):
+        """Importing the profiler opens nothing; the database is opened by init or the first unit of work."""
+        directory = tempfile.mkdtemp()
+        script = """
+import os
+from sqlalchemy import inspect
+import fastapi_sql_profiler
+from fastapi_sql_profiler import database
+assert database._engine is None
+try:
+    database.get_session()
+except RuntimeError:
+    pass
+else:
+    raise AssertionError("no URL configured")
+url = "sqlite:///" + os.path.join(%r, "profiler.db")
+engine = database.init(url, pool_size=2, create_schema=False)
+assert engine.pool.size() == 2
+assert inspect(engine).get_table_names() == []
+database.configure(create_schema=True)
+assert database._engine is None
+with database.get_session() as db:
+    assert "middleware_requests" in inspect(db.get_bind()).get_table_names()
+""" % directory
+        env = {key: value for key, value in os.environ.items() if key != "SQLALCHEMY_DATABASE_URL"}
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        try:
+            result = subprocess.run([sys.executable, "-c", script], env=env, cwd=directory,
+                                    capture_output=True, text=True, timeout=60)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_upgrade_older_schema(self):
+        """Tables created by an older version get the missing columns and indexes, keeping their rows."""
+        directory = tempfile.mkdtemp()
+        old_engine = create_engine("sqlite:///" + os.path.join(directory, "old.db"))
+        try:
+            with old_engine.begin() as conn:
+                conn.execute(text("CREATE TABLE middleware_requests (id INTEGER PRIMARY KEY, path VARCHAR(200), "
+                                  "query_params TEXT, raw_body TEXT, body TEXT, method VARCHAR(10), "
+                                  "start_time DATETIME, end_time DATETIME, time_taken FLOAT, total_queries INTEGER, "
+                                  "headers JSON, n_plus_one INTEGER)"))
+                conn.execute(text("INSERT INTO middleware_requests (path, method, time_taken, total_queries) "
+                                  "VALUES ('/old', 'GET', 1.5, 2), ('/unfinished', 'GET', NULL, NULL)"))
+            missing = ["%s.%s" % (column.table.name, column.name) for column in database.missing_columns(old_engine)]
+            self.assertIn("middleware_requests.regression", missing)
+            with self.assertRaisesRegex(RuntimeError, "middleware_requests.wasted_time"):
+                database.check_schema(old_engine)
+            database.upgrade_schema(old_engine)
+            self.assertEqual(database.missing_columns(old_engine), [])
+            database.check_schema(old_engine)
+            inspector = inspect(old_engine)
+            indexes = [index["name"] for index in inspector.get_indexes("middleware_requests")]
+            self.assertIn("ix_middleware_requests_regression", indexes)
+            self.assertIn("ix_middleware_requests_time_taken_id", indexes)
+            with old_engine.connect() as conn:
+                self.assertEqual(conn.execute(text("SELECT path, n_plus_one, time_taken, total_queries, wasted_time "
+                                                   "FROM middleware_requests ORDER BY id")).all(),
+                                 [("/old", 0, 1.5, 2, 0), ("/unfinished", 0, 0, 0, 0)])
+        finally:
+            old_engine.dispose()
+            shutil.rmtree(directory)
+
+
+class TestLiveFeed(ProfilerTestCase):
+
+    def test_middleware_publishes_to_matching_subscribers(self):
+        """Saved requests are delivered to the subscriptions whose filters they match."""
+        app = FastAPI()
+        app.add_middleware(SQLProfilerMiddleware, engine=engine, store=MemoryStore())
+        app.include_router(router)
+
+        @app.get("/live_users")
+        def live_users(queries: int = 1):
+            with engine.connect() as conn:
+                for _ in range(queries):
+                    conn.execute(text("SELECT 1"))
+            return {}
+
+        async def scenario():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                await client.get("/live_users")
+                live_feed = get_profiler(app).live_feed
+                everything = live_feed.subscribe()
+                busy = live_feed.subscribe(path="/live_users", min_queries=2)
+                await client.get("/live_users", params={"queries": 1})
+                await client.get("/live_users", params={"queries": 3})
+                await client.get("/all_request")
+                all_events, _ = await everything.get(timeout=1)
+                busy_events, _ = await busy.get(timeout=1)
+                live_feed.unsubscribe(everything)
+                live_feed.unsubscribe(busy)
+                return all_events, busy_events, live_feed.subscriptions
+
+        all_events, busy_events, subscriptions = asyncio.run(scenario())
+        self.assertEqual([summary["total_queries"] for summary in all_events], [1, 3])
+        self.assertEqual([summary["total_queries"] for summary in busy_events], [3])
+        self.assertEqual(busy_events[0]["route"], "/live_users")
+        self.assertGreater(busy_events[0]["db_time"], 0)
+        self.assertEqual(subscriptions, [])
+
+    def test_slow_subscribers_drop_oldest_events(self):
+        """A full buffer drops its oldest events, which the stream reports before the rest."""
+        async def scenario():
+            live_feed = LiveFeed(max_subscribers=1)
+            subscription = live_feed.subscribe(maxsize=2)
+            self.assertIsNone(live_feed.subscribe())
+            for index in range(5):
+                live_feed.publish({"path": "/%d" % index, "method": "GET", "time_taken": 1.0, "total_queries": 0})
+            stream = live_events(live_feed, subscription, heartbeat=0.01)
+            messages = [await stream.__anext__() for _ in range(5)]
+            await stream.aclose()
+            return messages, live_feed.subscriptions
+
+        messages, subscriptions = asyncio.run(scenario())
+        self.assertEqual(messages[0], ": connected\n\n")
+        self.assertEqual(messages[1], 'event: dropped\ndata: {"dropped": 3}\n\n')
+        self.assertIn('"path": "/3"', messages[2])
+        self.assertIn('"path": "/4"', messages[3])
+        self.assertEqual(messages[4], ": heartbeat\n\n")
+        self.assertEqual(subscriptions, [])
+
+
+class TestBaselines(ProfilerTestCase):
+
+    def observe(self, tracker, now, count, queries, db_time):
+        """Observe `count` requests to `/orders` and return the flags of the last one."""
+        flags = ()
+        for _ in range(count):
+            flags = tracker.observe("/orders", "GET", db_time + 1, db_time, queries, now=now)
+        return flags
+
+    def test_requests_flagged_against_rolling_windows(self):
+        """Requests are compared to the completed windows once they hold `min_samples` requests."""
+        tracker = BaselineTracker(window=60, windows=2, min_samples=5)
+        self.assertEqual(self.observe(tracker, 0, 10, 2, 1.0), ())
+        self.assertEqual(self.observe(tracker, 30, 1, 20, 100.0), ())
+        self.assertEqual(self.observe(tracker, 45, 9, 2, 1.0), ())
+        self.assertEqual(self.observe(tracker, 61, 1, 3, 2.0), ())
+        self.assertEqual(self.observe(tracker, 62, 1, 10, 2.0), ("queries",))
+        self.assertEqual(self.observe(tracker, 63, 1, 10, 50.0), ("queries", "db_time"))
+        self.assertEqual(tracker.flagged, 2)
+        self.assertEqual(tracker.report()[0]["flags"], [])
+        self.observe(tracker, 64, 5, 10, 50.0)
+        report = tracker.report()[0]
+        self.assertEqual((report["route"], report["method"]), ("/orders", "GET"))
+        self.assertEqual(report["flags"], ["queries", "db_time"])
+        self.assertEqual(report["baseline"]["count"], 20)
+        self.assertEqual(report["current"]["count"], 8)
+
+    def test_report_copies_current_window(self):
+        """A report is not changed by the requests observed after it was taken."""
+        tracker = BaselineTracker(window=60, windows=2, min_samples=5)
+        self.observe(tracker, 0, 3, 2, 1.0)
+        with unittest.mock.patch.object(RouteStats, "summary", autospec=True,
+                                        side_effect=lambda stats: self.observe(tracker, 1, 1, 2, 1.0)
+                                        or {"count": stats.count}):
+            report = tracker.report()
+        self.assertEqual(report[0]["current"]["count"], 3)
+        self.assertEqual(tracker.report()[0]["current"]["count"], 4)
+
+    def test_saved_baseline_as_reference(self):
+        """A snapshot saved in a store is loaded by name and used instead of the rolling baseline."""
+        before = BaselineTracker(min_samples=5)
+        self.observe(before, 0, 10, 2, 1.0)
+        for store in (MemoryStore(), SQLStore()):
+            self.assertEqual(before.save(store, "test-v1"), 1)
+            self.assertEqual(before.save(store, "test-v1"), 1)
+            routes = store.get_baseline("test-v1")
+            self.assertEqual(list(routes), [("/orders", "GET")])
+            self.assertEqual(routes[("/orders", "GET")].count, 10)
+            self.assertEqual(routes[("/orders", "GET")].queries.percentile(95), before.snapshot()[
+                ("/orders", "GET")].queries.percentile(95))
+            self.assertIn(("test-v1", 1), [(name, count) for name, _, count in store.list_baselines()])
+            self.assertEqual(store.get_baseline("test-missing"), {})
+
+            after = BaselineTracker(min_samples=5)
+            self.assertFalse(after.load_reference(store, "test-missing"))
+            self.assertTrue(after.load_reference(store, "test-v1"))
+            self.assertEqual(after.reference_name, "test-v1")
+            self.assertEqual(store.get_reference_baseline(), "test-v1")
+            self.assertEqual(self.observe(after, 0, 1, 12, 1.0), ("queries",))
+            self.assertTrue(after.load_reference(store, None))
+            self.assertIsNone(store.get_reference_baseline())
+            self.assertEqual(self.observe(after, 0, 1, 12, 1.0), ())
+
+    def test_workers_share_baselines_through_the_store(self):
+        """A baseline saved by one worker is completed by the others, which all follow the reference."""
+        for store in (MemoryStore(), SQLStore()):
+            workers = [BaselineTracker(min_samples=5) for _ in range(3)]
+            for worker in workers:
+                self.observe(worker, 0, 10, 2, 1.0)
+            self.assertEqual(workers[0].save(store, "test-v2"), 1)
+            late = BaselineTracker(min_samples=5)
+            self.observe(late, 0, 10, 2, 1.0)
+            for worker in workers + [late]:
+                worker.sync(store)
+                worker.sync(store)
+            self.assertEqual(store.get_baseline("test-v2")[("/orders", "GET")].count, 30)
+            self.assertEqual(store.get_baseline("test-v2")[("/orders", "GET")].queries.count, 30)
+
+            self.assertTrue(workers[1].load_reference(store, "test-v2"))
+            for worker in workers + [late]:
+                worker.sync(store)
+                self.assertEqual(worker.reference_name, "test-v2")
+                self.assertEqual(worker.reference[("/orders", "GET")].count, 30)
+            workers[2].load_reference(store, None)
+            workers[0].sync(store)
+            self.assertIsNone(workers[0].reference_name)
+
+            workers[0].save(store, "test-v2")
+            self.assertFalse(store.merge_baseline("test-v2", late.started_at, late.snapshot()))
+
+    def test_middleware_flags_and_reports_regressions(self):
+        """Regressed requests are stored with their flags, filtered on the dashboard and listed as JSON."""
+        store = MemoryStore()
+        app = FastAPI()
+        app.add_middleware(SQLProfilerMiddleware, engine=engine, store=store,
+                           baselines=BaselineTracker(window=0, windows=10, min_samples=3))
+        app.include_router(router)
+
+        @app.get("/baseline_orders")
+        def baseline_orders(queries: int = 1):
+            with engine.connect() as conn:
+                for _ in range(queries):
+                    conn.execute(text("SELECT 1"))
+            return {}
+
+        client = TestClient(app)
+        for _ in range(5):
+            client.get("/baseline_orders")
+        client.get("/baseline_orders", params={"queries": 8})
+        self.assertEqual(store.count_requests(regressed=True), 1)
+
+        response = client.get("/regressions")
+        self.assertEqual(response.status_code, 200)
+        content = response.json()
+        self.assertIsNone(content["reference"])
+        self.assertEqual(content["flagged"], 1)
+        self.assertEqual([(item["total_queries"], item["regression"]) for item in content["requests"]],
+                         [(8, ["queries"])])
+        self.assertIn("bg-danger", client.get("/all_request", params={"regressed": True}).text)
+
+        self.assertEqual(client.post("/baselines/test-deploy").json()["routes"], 1)
+        self.assertEqual(client.post("/baselines/test-deploy/load").status_code, 200)
+        self.assertEqual(client.post("/baselines/test-unknown/load").status_code, 404)
+        page = client.get("/baselines")
+        self.assertEqual(page.status_code, 200)
+        self.assertIn("/baseline_orders", page.text)
+        self.assertIn("test-deploy", page.text)
+        self.assertEqual(get_profiler(app).baselines.reference_name, "test-deploy")
+        client.delete("/baselines/reference")
+        self.assertIsNone(get_profiler(app).baselines.reference_name)
+        self.assertEqual(store.count_requests(), 6)
+
+
+class TestProfileWriter(ProfilerTestCase):
+
+    def test_batches_and_drops(self):
+        """Records are persisted in batches and counted as dropped when the queue is full."""
+        batches = []
+        entered = threading.Event()
+        release = threading.Event()
+
+        def persist(batch):
+            entered.set()
+            release.wait(5)
+            batches.append(batch)
+
+        writer = ProfileWriter(persist, maxsize=2, batch_size=2, flush_interval=0.01)
+        self.assertTrue(writer.put("a"))
+        self.assertTrue(entered.wait(5))
+        self.assertTrue(writer.put("b"))
+        self.assertTrue(writer.put("c"))
+        self.assertFalse(writer.put("d"))
+        self.assertEqual(writer.dropped, 1)
+        release.set()
+        writer.stop(timeout=5)
+        self.assertEqual(batches, [["a"], ["b", "c"]])
+        self.assertEqual(writer.stats()["flushed"], 3)
+
+    def test_middleware_persists_queue_at_shutdown(self):
+        """Records still queued when the application shuts down are persisted and the store is closed."""
+        closed = []
+
+        class RecordingStore(MemoryStore):
+            write_behind = True
+
+            def close(self):
+                closed.append(True)
+
+        store = RecordingStore()
+        app = FastAPI()
+        app.add_middleware(SQLProfilerMiddleware, engine=engine, store=store, flush_interval=60.0, batch_size=1000)
+
+        @app.get("/shutdown_item")
+        def shutdown_item():
+            return {}
 
+        with TestClient(app) as client:
+            client.get("/shutdown_item")
+            client.get("/shutdown_item")
+            writer = get_profiler(app).writer
+            self.assertEqual(store.count_requests(), 0)
+        self.assertEqual(store.count_requests(), 2)
+        self.assertEqual(closed, [True])
+        self.assertIsNone(writer._thread)